@@ -1,19 +1,20 @@
 import os
 import glob
-import pickle
-import numpy as np
-import geopandas as gpd
-import rasterio
+import time
 from module import (
-    fc_label_mask_and_identify_goodd_nov20,
-    fc_get_mask_metadata_func_nov20,
+    fc_tile_pipeline_nov20,
+    fc_tile_scheduler_nov20,
+    fc_shared_manifest_nov20,
+    fc_prefetch_pipeline_nov20,
+    fc_granule_index_nov20,
     fc_get_merit_heights_nov20,
-    fc_get_IS2_water_data_nov20,
-    fc_organize_IS2_data_nov20,
-    inpoly
+    fc_lake_stitching_nov20,
+    fc_geoid_nov20,
+    fc_metrics_nov20
 )
 
 # STEP 0: 配置路径
+atl08_path = r"F:\ATL08_006-20250418_031619"
 atl08_metadata_path = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main\ICESat_2_metadata"
 gswo_mask_path = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main\SWO"
 gdw_path = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main\Global Dam Watch database version 1.0\GDW_v1_0_shp\GDW_v1_0_shp"
@@ -22,89 +23,161 @@ mask_output_path = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main
 results_output_path = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main\results"
 merit_path = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main"
 
-# 加载 ATL08 metadata（假设是 pickle 格式）
-with open(os.path.join(atl08_metadata_path, 'atl_metadata_optimized.pkl'), 'rb') as f:
-    metadata = pickle.load(f)
-
-# 获取 GSWO water mask 文件列表
-mask_files = glob.glob(os.path.join(gswo_mask_path, '*.tif'))
-mask_files = [f for f in mask_files if os.path.getsize(f) > 10000]
-
-# 读取 GDW dam dataset
-gdw = gpd.read_file(os.path.join(gdw_path, 'GDW_barriers_v1_0.shp'))
-glat = gdw['LAT_RIV'].values
-glon = gdw['LONG_RIV'].values
-
-# 读取海岸线
-coast = gpd.read_file(os.path.join(coast_path, 'GSHHS_i_L1.shp'))
-
-# 遍历 GSWO water masks
-for n, mask_file in enumerate(mask_files, start=1):
-    print("Reading in mask:", os.path.basename(mask_file))
-
-    with rasterio.open(mask_file) as src:
-        mask = src.read(1)
-        shape = src.shape
-        R = src.transform
-        profile = src.profile
-        bounds = src.bounds  # 左下右上
-        R1 = {
-            'lon_limits': (bounds.left, bounds.right),
-            'lat_limits': (bounds.bottom, bounds.top),
-            'shape': src.shape  # (rows, cols)
+paths = {
+    'atl08': atl08_path,
+    'mask_output': mask_output_path,
+    'results_output': results_output_path,
+    'merit': merit_path
+}
+
+# 处理模式: 'tile' 逐瓦片读取 ICESat-2；'granule' 每个 granule 只打开一次，分配到同一批的所有瓦片；
+# 'incremental' 增量更新: 沿用已保存的 labeled mask、统计量和 MERIT 高程，只读取每个瓦片尚未读取的新 granule，
+# 并重新整理有新过境的水体（需先运行 1_organize_icesat2_metadata_nov20.py 更新 granule 目录，不支持 stitch_lakes）
+processing_mode = 'tile'
+granule_batch_size = 50
+edit = 0
+
+# 执行方式: 'serial' 单进程顺序执行；'pool' 进程池并行，记录每个瓦片状态，重启时跳过已完成的瓦片；
+# 'shard' 多节点执行: 每个节点运行本脚本，通过共享目录 job_dir 中的任务清单和租约文件分配瓦片；
+# 'prefetch' I/O 线程预读下一个瓦片的输入，同时计算进程处理当前瓦片（仅 tile 处理模式）
+execution_mode = 'serial'
+max_workers = 8
+prefetch_io_threads = 2
+prefetch_queue_depth = 2
+prefetch_memory_limit = 16 * 2 ** 30  # 字节
+status_path = os.path.join(results_output_path, 'tile_status.sqlite')
+job_dir = os.path.join(results_output_path, 'job')
+lease_ttl = 1800  # 秒，租约超过该时间未续期视为 worker 已失效
+
+# ICESat-2 日期过滤 (start, end)，datetime.date，None 表示不过滤
+date_range = None
+
+# 水体标记的分块参数: block_size 为 None 时整幅计算；给定时按块读取 mask 并分块腐蚀、膨胀和标记，
+# 整幅中间数组存放在 scratch_dir（None 时为系统临时目录）的临时文件中，需要相应的磁盘空间；
+# MERIT 拼接高程仍整幅读入内存，prefetch 模式下 mask 由 I/O 线程整幅预读；
+# coast_backend 为海岸线判断的点在多边形内算法: 'shapely' 或 'inpoly'（向量化交叉数算法，所有候选多边形一次计算）
+label_options = {'block_size': None, 'scratch_dir': None, 'coast_backend': 'shapely'}
+
+# 跨瓦片水体合并: 所有瓦片完成 STEP 1-3 后，按相邻瓦片的边界像元建立全局水体编号，再按全局水体执行 STEP 4
+# （shard 模式下由整个任务清单结束后的一个节点执行；不支持 incremental 处理模式）
+stitch_lakes = False
+lake_table_path = os.path.join(mask_output_path, 'lake_table.pkl')
+
+# 结果文件格式: 'hdf5' 每个瓦片一个按列压缩的 results_<tag>_v1.h5（水体汇总、逐次观测、过境和原始点四个表，
+# 可只读取部分列和水体，见 fc_result_store_nov20）；'pickle' 为原来的 results_<tag>_v1.pkl
+result_format = 'hdf5'
+
+# MERIT 高程块缓存（每个进程一个）: 内存上限（字节）；disk_dir 给定时解码后的块保存为 .npy，供所有 worker 共享
+merit_cache = {'max_bytes': 2 * 2 ** 30, 'disk_dir': None}
+
+# STEP 1-2 输出缓存: 每个瓦片的 labeled mask、统计量和 MERIT 高程旁保存输入指纹（大小、修改时间、SHA-256）、
+# 代码版本和参数（75% 阈值、edit、label_options）的清单，均未改变时直接读取；force 为 True（或阶段名列表，
+# 如 ['merit']）时重新计算；hash_files 为 False 时只比较大小和修改时间；None 时不使用缓存
+stage_cache = {'force': False, 'hash_files': True}
+
+# 分阶段指标: 每个瓦片各阶段（label、reservoir、coastline、merit、is2_read、organize）的墙钟时间、CPU 时间、峰值 RSS
+# 和计数（granule、波束、点、水体数）以 JSON lines 写入 metrics_dir，运行结束时打印汇总；
+# profile_tiles 中的瓦片（mask 文件名）另外用 cProfile 和 tracemalloc 分析；None 时不记录
+metrics = {'metrics_dir': os.path.join(results_output_path, 'metrics'), 'profile_tiles': [], 'memory_frames': 10}
+
+# 每个进程加载一次的输入: GDW dam dataset、海岸线、ATL08 granule 空间索引（由 1_organize_icesat2_metadata_nov20.py 生成）、
+# EGM96 大地水准面格网（GeoTIFF 或 NGA 的 WW15MGH.GRD，第一次使用时在 mask 输出目录生成 .npy 供内存映射）
+gdw_file = os.path.join(gdw_path, 'GDW_barriers_v1_0.shp')
+coast_file = os.path.join(coast_path, 'GSHHS_i_L1.shp')
+granule_index_path = os.path.join(atl08_metadata_path, 'atl_granule_index.pkl')
+geoid_file = os.path.join(merit_path, 'us_nga_egm96_15.tif')
+worker_args = (paths, gdw_file, coast_file, granule_index_path, edit, date_range, label_options, stitch_lakes,
+               merit_cache, geoid_file, result_format, stage_cache, metrics)
+
+
+
+def run_stitching():
+    """跨瓦片水体合并: 按相邻瓦片的边界像元建立全局水体编号，再按全局水体执行 STEP 4"""
+    fc_geoid_nov20.set_geoid_file(geoid_file, cache_dir=mask_output_path)
+    headers = fc_lake_stitching_nov20.load_tile_headers(mask_output_path)
+    lake_table = fc_lake_stitching_nov20.stitch_tiles(headers)
+    fc_lake_stitching_nov20.save_lake_table(lake_table, lake_table_path)
+    if metrics is not None:
+        fc_metrics_nov20.configure(**metrics)
+    for header in headers:
+        with fc_metrics_nov20.tile_metrics(f"stitch_{header['tag']}"):
+            fc_lake_stitching_nov20.organize_stitched_tile(header, lake_table, paths, result_format)
+
+
+if __name__ == "__main__":
+    if not os.path.exists(geoid_file):
+        raise FileNotFoundError(f"EGM96 grid file not found: {geoid_file}")
+    if stitch_lakes and processing_mode == 'incremental':
+        raise ValueError("stitch_lakes is not supported in incremental processing mode")
+    if execution_mode == 'prefetch' and processing_mode != 'tile':
+        raise ValueError(f"prefetch execution only supports the 'tile' processing mode, not '{processing_mode}'")
+    run_start = time.time()
+    # 获取 GSWO water mask 文件列表
+    mask_files = glob.glob(os.path.join(gswo_mask_path, '*.tif'))
+    mask_files = [f for f in mask_files if os.path.getsize(f) > 10000]
+
+    if processing_mode == 'granule':
+        batches = fc_tile_pipeline_nov20.granule_major_batches(mask_files, granule_batch_size)
+        tasks = {
+            f"{os.path.basename(b[0])}..{os.path.basename(b[-1])}": ((b,), sum(os.path.getsize(f) for f in b))
+            for b in batches
         }
-    edit = 0
-
-    # STEP 1: CREATE WATER MASK
-    mask_l, lake_area, goodd_res, lat, lon, extent = fc_label_mask_and_identify_goodd_nov20.label_mask_and_identify_goodd(
-        mask, R, glon, glat, coast, edit
-    )
-
-    if len(lat) > 0 and (lat[0] != 0 or len(lat) > 1):
-        output_name1 = os.path.basename(mask_file).replace('.tif', 'labeled.tif')
-        output_name2 = os.path.basename(mask_file).replace('.tif', 'stats.pkl')
-
-        print("Writing mask...")
-        # 保存 GeoTIFF
-        labeled_tif_path = os.path.join(mask_output_path, output_name1)
-        with rasterio.open(labeled_tif_path, 'w', **profile) as dst:
-            dst.write(mask_l, 1)
-
-        # 保存统计数据
-        stats = {
-            'lake_area': lake_area,
-            'goodd_res': goodd_res,
-            'lat': lat,
-            'lon': lon,
-            'extent': extent
-        }
-        with open(os.path.join(mask_output_path, output_name2), 'wb') as f:
-            pickle.dump(stats, f)
-
-        print(os.path.basename(mask_file))
-
-        # STEP 2: GET HEIGHT FROM MERIT HYDROGRAPHY DATASET
-        print("Getting merit heights...")
-        mask_metadata = fc_get_mask_metadata_func_nov20.get_mask_metadata_func_nov20(os.path.basename(mask_file))
-
-        merit_heights = fc_get_merit_heights_nov20.get_merit_heights_nov20(merit_path, mask_metadata, mask_l, shape)
-        merit_output_name = f"merit_heights_{mask_metadata['lonstr']}{mask_metadata['ew']}_{mask_metadata['latstr']}{mask_metadata['ns']}_v1.pkl"
-        with open(os.path.join(mask_output_path, merit_output_name), 'wb') as f:
-            pickle.dump(merit_heights, f)
-
-        # STEP 3: READ IN ICESAT-2 DATA
-        print("Reading in IS2...")
-        water_data, count = fc_get_IS2_water_data_nov20.get_IS2_water_data_nov20(mask_l, metadata, R1, R)
-
-        # STEP 4: ORGANIZE ICESAT-2 DATA BY WATER BODY
-        print("Organizing IS2...")
-        if count > 1:
-            complete_output = fc_organize_IS2_data_nov20.organize_IS2_data(water_data, merit_heights, extent, goodd_res, lake_area)
-            if complete_output:
-                result_output_name = f"results_{mask_metadata['lonstr']}{mask_metadata['ew']}_{mask_metadata['latstr']}{mask_metadata['ns']}_v1.pkl"
-                with open(os.path.join(results_output_path, result_output_name), 'wb') as f:
-                    pickle.dump({'complete_output': complete_output, 'water_data': water_data}, f)
-
-        print(f"Finished {os.path.basename(mask_file)} ({n}/{len(mask_files)})")
-
-print("All done!")
+        func = fc_tile_pipeline_nov20.run_granule_batch
+    elif processing_mode == 'incremental':
+        # 每次 granule 索引更新为一批新任务（瓦片状态和 shard 任务清单按索引的修改时间区分）
+        update_batch = int(os.path.getmtime(granule_index_path))
+        tasks = {f"{os.path.basename(f)}@update{update_batch}": ((f,), os.path.getsize(f)) for f in mask_files}
+        func = fc_tile_pipeline_nov20.run_update_tile
+        job_dir = os.path.join(job_dir, f"update{update_batch}")
+    else:
+        tasks = {os.path.basename(f): ((f,), os.path.getsize(f)) for f in mask_files}
+        func = fc_tile_pipeline_nov20.run_tile
+
+    if execution_mode == 'prefetch':
+        # granule 索引只在预读线程中使用，计算进程不需要加载
+        granule_index = fc_granule_index_nov20.load_granule_index(granule_index_path)
+        compute_args = (paths, gdw_file, coast_file, None, edit, date_range, label_options, stitch_lakes, None,
+                        geoid_file, result_format, stage_cache, metrics)
+        results = fc_prefetch_pipeline_nov20.run_prefetch_pipeline(
+            mask_files, paths, granule_index, compute_args, date_range,
+            io_threads=prefetch_io_threads, compute_workers=max_workers,
+            queue_depth=prefetch_queue_depth, memory_limit=prefetch_memory_limit,
+            merit_cache=fc_get_merit_heights_nov20.MeritCache(**merit_cache)
+        )
+        for mask_file, error in results.items():
+            if error is not None:
+                print(f"{os.path.basename(mask_file)} failed:\n{error}")
+    elif execution_mode == 'pool':
+        counts = fc_tile_scheduler_nov20.run_scheduled(
+            tasks, func, status_path, max_workers,
+            initializer=fc_tile_pipeline_nov20.init_worker, initargs=worker_args
+        )
+        print(counts)
+    elif execution_mode == 'shard':
+        fc_shared_manifest_nov20.create_manifest(job_dir, tasks)
+        dead = fc_shared_manifest_nov20.run_workers(
+            job_dir, func, max_workers,
+            initializer=fc_tile_pipeline_nov20.init_worker, initargs=worker_args, lease_ttl=lease_ttl
+        )
+        if dead:
+            print(f"{len(dead)} worker(s) exited abnormally (pid, exit code): {dead}")
+        print(fc_shared_manifest_nov20.job_progress(job_dir))
+    else:
+        fc_tile_pipeline_nov20.init_worker(*worker_args)
+        for n, (name, (args, _)) in enumerate(tasks.items(), start=1):
+            func(*args)
+            print(f"Finished {name} ({n}/{len(tasks)})")
+
+    print("All done!")
+
+    if stitch_lakes:
+        if execution_mode == 'shard':
+            # 每个节点都运行到这里: 只有整个任务清单结束后，由一个节点执行一次合并
+            if not fc_shared_manifest_nov20.run_final_task(job_dir, 'stitch_lakes', run_stitching,
+                                                           lease_ttl=lease_ttl):
+                print("Lake stitching skipped on this node (job not finished, or run by another node)")
+        else:
+            run_stitching()
+
+    if metrics is not None:
+        fc_metrics_nov20.print_summary(fc_metrics_nov20.summarize(metrics['metrics_dir'], since=run_start))
@@ -0,0 +1,23 @@
+import os
+from datetime import date
+from module import fc_lake_query_nov20
+
+
+def query_lakes(results_output, index_path, lon_limits, lat_limits, date_range=None):
+    """更新水体索引（只读取新增或改变的结果文件），返回范围内的水体汇总"""
+    index = fc_lake_query_nov20.update_lake_index(index_path, results_output)
+    rows = fc_lake_query_nov20.query_bbox(index, lon_limits, lat_limits, date_range)
+    print(f"{len(index['lakes'])} lakes in index, {len(rows)} matched")
+    return index, rows
+
+# 使用方法
+if __name__ == "__main__":
+    results_output = r"D:\Code\icesat2-water-levels-main\icesat2-water-levels-main\results"
+    index_path = os.path.join(results_output, 'lake_index.pkl')
+
+    index, rows = query_lakes(results_output, index_path, (-100, -90), (40, 50), (date(2020, 1, 1), date(2023, 12, 31)))
+    for record in fc_lake_query_nov20.lake_records(index, rows[:10]):
+        print(record)
+
+    # 本地 HTTP 查询服务，如 http://127.0.0.1:8765/lakes?bbox=-100,40,-90,50&start=2020-01-01&end=2023-12-31
+    fc_lake_query_nov20.serve_lake_index(index, port=8765)
@@ -0,0 +1,109 @@
+import numpy as np
+from module import fc_granule_catalog_nov20
+
+# ATL08 land_segments 下常用数据集的路径
+DATASETS = {
+    'longitude': 'land_segments/longitude',
+    'latitude': 'land_segments/latitude',
+    'h_te_mean': 'land_segments/terrain/h_te_mean',
+    'terrain_flg': 'land_segments/terrain_flg',
+    'h_te_uncertainty': 'land_segments/terrain/h_te_uncertainty',
+}
+
+DEFAULT_FIELDS = ('longitude', 'latitude', 'h_te_mean', 'terrain_flg', 'h_te_uncertainty')
+
+
+def read_beam_window(f, laser, lon_limits, lat_limits, fields=DEFAULT_FIELDS,
+                     max_uncertainty=None, terrain_flag=None):
+    """
+    按窗口读取单个波束落在经纬度范围内的 segment
+
+    1. 由波束元数据（包围盒 + 沿轨纬度索引）确定粗略的 segment 区间；
+    2. 在该区间的纬度上二分查找，得到与 lat_limits 相交的连续区间；
+    3. 只读取该连续区间（hyperslab）内的各数据集；
+    4. 先读取谓词所需的字段并过滤（经度范围、max_uncertainty、terrain_flag），
+       其余字段只保留通过过滤的点。
+
+    参数:
+        f : 打开的 h5py.File
+        laser : 元数据中的波束记录（至少包含 'Name'）
+        lon_limits, lat_limits : (min, max)，闭区间
+        fields : 需要返回的字段（DATASETS 的键）
+        max_uncertainty : 只保留 h_te_uncertainty <= 该值的点
+        terrain_flag : 只保留 terrain_flg == 该值的点
+
+    返回:
+        dict: 各字段数组 + 'index'（点在整条波束中的 segment 下标）；
+        波束不存在或没有点落在范围内时返回 None
+    """
+    window = fc_granule_catalog_nov20.beam_window(laser, lon_limits, lat_limits)
+    if window is None:
+        return None
+
+    laser_name = laser['Name']
+    try:
+        lat_ds = f[f"{laser_name}/{DATASETS['latitude']}"]
+    except KeyError:
+        return None
+
+    start, stop = window
+    if stop is None:
+        stop = lat_ds.shape[0]
+    lat = lat_ds[start:stop]
+
+    i0, i1 = _lat_range(lat, lat_limits)
+    if i1 <= i0:
+        return None
+    lat = lat[i0:i1]
+    start, stop = start + i0, start + i1
+
+    def read(name):
+        return f[f"{laser_name}/{DATASETS[name]}"][start:stop]
+
+    values = {'latitude': lat, 'longitude': read('longitude')}
+    keep = ((values['latitude'] >= lat_limits[0]) & (values['latitude'] <= lat_limits[1]) &
+            (values['longitude'] >= lon_limits[0]) & (values['longitude'] <= lon_limits[1]))
+
+    if max_uncertainty is not None:
+        values['h_te_uncertainty'] = read('h_te_uncertainty')
+        keep &= values['h_te_uncertainty'] <= max_uncertainty
+    if terrain_flag is not None:
+        values['terrain_flg'] = read('terrain_flg')
+        keep &= values['terrain_flg'] == terrain_flag
+
+    index = np.nonzero(keep)[0]
+    if len(index) == 0:
+        return None
+
+    # 只截取过滤后点所在的子区间，再按掩膜取值
+    j0, j1 = index[0], index[-1] + 1
+    keep = keep[j0:j1]
+    out = {'index': start + index}
+    for name in fields:
+        if name in values:
+            arr = values[name][j0:j1]
+        else:
+            arr = f[f"{laser_name}/{DATASETS[name]}"][start + j0:start + j1]
+        out[name] = arr[keep]
+    return out
+
+
+def _lat_range(lat, lat_limits):
+    """在纬度序列中确定与 lat_limits 相交的连续下标区间；单调时用二分查找"""
+    if len(lat) == 0:
+        return 0, 0
+    d = np.diff(lat)
+    if np.all(d >= 0):
+        return (int(np.searchsorted(lat, lat_limits[0], side='left')),
+                int(np.searchsorted(lat, lat_limits[1], side='right')))
+    if np.all(d <= 0):
+        n = len(lat)
+        rev = lat[::-1]
+        return (n - int(np.searchsorted(rev, lat_limits[1], side='right')),
+                n - int(np.searchsorted(rev, lat_limits[0], side='left')))
+
+    # 非单调（如轨道转折处）: 取所有落在范围内的点的外包区间
+    inside = np.nonzero((lat >= lat_limits[0]) & (lat <= lat_limits[1]))[0]
+    if len(inside) == 0:
+        return 0, 0
+    return int(inside[0]), int(inside[-1]) + 1
@@ -0,0 +1,206 @@
+import tempfile
+import numpy as np
+from skimage.measure import label
+from skimage.morphology import binary_erosion, binary_dilation
+
+
+def smallest_uint(n):
+    """能容纳 0..n 的最小无符号整数类型"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def empty_array(shape, dtype, scratch_dir=None):
+    """分配整幅数组: scratch_dir（None 时为系统临时目录）下的临时文件（np.memmap），不占用内存"""
+    return np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=dtype, mode='w+', shape=shape)
+
+
+def block_slices(shape, block_size):
+    """按行优先顺序遍历 block_size × block_size 的分块，返回 (行切片, 列切片)"""
+    n_rows, n_cols = shape
+    for r0 in range(0, n_rows, block_size):
+        for c0 in range(0, n_cols, block_size):
+            yield slice(r0, min(r0 + block_size, n_rows)), slice(c0, min(c0 + block_size, n_cols))
+
+
+def binary_erosion_blocks(image, footprint, block_size, scratch_dir=None):
+    """分块腐蚀（每块带 footprint 半径宽的重叠边），结果与整幅 binary_erosion 相同"""
+    return _morphology_blocks(binary_erosion, image, footprint, block_size, scratch_dir)
+
+
+def binary_dilation_blocks(image, footprint, block_size, scratch_dir=None):
+    """分块膨胀（每块带 footprint 半径宽的重叠边），结果与整幅 binary_dilation 相同"""
+    return _morphology_blocks(binary_dilation, image, footprint, block_size, scratch_dir)
+
+
+def _morphology_blocks(func, image, footprint, block_size, scratch_dir):
+    halo = max(footprint.shape) // 2
+    n_rows, n_cols = image.shape
+    out = empty_array(image.shape, bool, scratch_dir)
+    for rs, cs in block_slices(image.shape, block_size):
+        r0, r1 = max(rs.start - halo, 0), min(rs.stop + halo, n_rows)
+        c0, c1 = max(cs.start - halo, 0), min(cs.stop + halo, n_cols)
+        result = func(np.asarray(image[r0:r1, c0:c1]), footprint)
+        out[rs, cs] = result[rs.start - r0:rs.stop - r0, cs.start - c0:cs.stop - c0]
+    return out
+
+
+def label_blocks(image, block_size, scratch_dir=None):
+    """
+    分块 8 连通标记，结果与整幅 label(image, connectivity=2) 相同（按连通区首个像元的行优先顺序编号）
+
+    1. 逐块标记，块内编号加上偏移量得到临时编号（数组类型随编号数增大）；
+    2. 比较相邻块边界两侧的像元（含对角），用并查集表合并跨块的连通区；
+    3. 按连通区首个像元的位置重新编号，写入最小可用整数类型的数组。
+
+    返回: (labels, n)
+    """
+    provisional = empty_array(image.shape, np.uint16, scratch_dir)
+    first_pixel = [np.zeros(1, dtype=np.int64)]
+    n = 0
+    n_cols = image.shape[1]
+
+    for rs, cs in block_slices(image.shape, block_size):
+        local = label(np.asarray(image[rs, cs]), connectivity=2).astype(np.int64)
+        n_local = int(local.max())
+        if n_local == 0:
+            provisional[rs, cs] = 0
+            continue
+
+        if n + n_local > np.iinfo(provisional.dtype).max:
+            provisional = astype_blocks(provisional, smallest_uint(n + n_local), block_size, scratch_dir)
+
+        # 块内每个连通区首个像元（块内行优先）在整幅中的一维下标
+        ids, first = np.unique(local.ravel(), return_index=True)
+        first = first[ids > 0]
+        block_cols = cs.stop - cs.start
+        first_pixel.append((rs.start + first // block_cols) * n_cols + cs.start + first % block_cols)
+
+        local[local > 0] += n
+        provisional[rs, cs] = local
+        n += n_local
+
+    first_pixel = np.concatenate(first_pixel)
+    parent = union_find(_boundary_pairs(provisional, block_size), n)
+
+    # 连通区的首个像元 = 其所有临时编号首个像元的最小值
+    comp_first = np.full(n + 1, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(comp_first, parent, first_pixel)
+    roots = np.unique(parent[1:])
+    roots = roots[np.argsort(comp_first[roots], kind='stable')]
+    n_final = len(roots)
+
+    lut = np.zeros(n + 1, dtype=smallest_uint(n_final))
+    final = np.zeros(n + 1, dtype=lut.dtype)
+    final[roots] = np.arange(1, n_final + 1)
+    lut[1:] = final[parent[1:]]
+
+    return relabel_blocks(provisional, lut, block_size, scratch_dir), n_final
+
+
+def relabel_blocks(labels, lut, block_size, scratch_dir=None):
+    """逐块按查找表 lut（原编号 -> 新编号）重新编号，输出类型为 lut 的类型"""
+    out = empty_array(labels.shape, lut.dtype, scratch_dir)
+    for rs, cs in block_slices(labels.shape, block_size):
+        out[rs, cs] = lut[labels[rs, cs]]
+    return out
+
+
+def astype_blocks(array, dtype, block_size, scratch_dir=None):
+    """逐块转换数组类型"""
+    out = empty_array(array.shape, dtype, scratch_dir)
+    for rs, cs in block_slices(array.shape, block_size):
+        out[rs, cs] = array[rs, cs]
+    return out
+
+
+def region_stats_blocks(labels, n, block_size, intensity=None):
+    """
+    逐块累计每个 label（1..n）的像元数、行列坐标和、外包框和 intensity 最大值
+
+    返回 dict，各数组长度为 n + 1（下标即 label）:
+        'area', 'row_sum', 'col_sum', 'min_row', 'max_row', 'min_col', 'max_col', 'max_intensity'
+    """
+    big = np.iinfo(np.int64).max
+    stats = {
+        'area': np.zeros(n + 1, dtype=np.int64),
+        'row_sum': np.zeros(n + 1),
+        'col_sum': np.zeros(n + 1),
+        'min_row': np.full(n + 1, big, dtype=np.int64),
+        'max_row': np.full(n + 1, -1, dtype=np.int64),
+        'min_col': np.full(n + 1, big, dtype=np.int64),
+        'max_col': np.full(n + 1, -1, dtype=np.int64),
+    }
+    if intensity is not None:
+        stats['max_intensity'] = np.zeros(n + 1)
+
+    for rs, cs in block_slices(labels.shape, block_size):
+        block = np.asarray(labels[rs, cs])
+        flat = np.flatnonzero(block)
+        if len(flat) == 0:
+            continue
+        lab = block.ravel()[flat].astype(np.intp)
+        rows = rs.start + flat // block.shape[1]
+        cols = cs.start + flat % block.shape[1]
+
+        stats['area'] += np.bincount(lab, minlength=n + 1)
+        stats['row_sum'] += np.bincount(lab, weights=rows, minlength=n + 1)
+        stats['col_sum'] += np.bincount(lab, weights=cols, minlength=n + 1)
+        np.minimum.at(stats['min_row'], lab, rows)
+        np.maximum.at(stats['max_row'], lab, rows)
+        np.minimum.at(stats['min_col'], lab, cols)
+        np.maximum.at(stats['max_col'], lab, cols)
+        if intensity is not None:
+            np.maximum.at(stats['max_intensity'], lab, np.asarray(intensity[rs, cs]).ravel()[flat])
+
+    return stats
+
+
+def _boundary_pairs(provisional, block_size):
+    """相邻块边界两侧（8 邻域）都为前景的临时编号对"""
+    n_rows, n_cols = provisional.shape
+    a, b = [], []
+
+    def add(x, y):
+        keep = (x > 0) & (y > 0) & (x != y)
+        a.append(x[keep])
+        b.append(y[keep])
+
+    for r in range(block_size, n_rows, block_size):
+        up, down = np.asarray(provisional[r - 1]), np.asarray(provisional[r])
+        add(up, down)
+        add(up[1:], down[:-1])
+        add(up[:-1], down[1:])
+    for c in range(block_size, n_cols, block_size):
+        left, right = np.asarray(provisional[:, c - 1]), np.asarray(provisional[:, c])
+        add(left, right)
+        add(left[1:], right[:-1])
+        add(left[:-1], right[1:])
+
+    if not a:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.stack([np.concatenate(a), np.concatenate(b)], axis=1).astype(np.int64)
+    return np.unique(pairs, axis=0)
+
+
+def union_find(pairs, n):
+    """并查集表: 合并 pairs 中的编号对，返回 parent（每个编号指向其连通区内最小的编号）"""
+    parent = np.arange(n + 1, dtype=np.int64)
+    a, b = pairs[:, 0], pairs[:, 1]
+    while True:
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        if not np.any(differ):
+            return parent
+        ra, rb = ra[differ], rb[differ]
+        low = np.minimum(ra, rb)
+        np.minimum.at(parent, ra, low)
+        np.minimum.at(parent, rb, low)
+        # 路径压缩
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
@@ -0,0 +1,117 @@
+import os
+import socket
+import threading
+import numpy as np
+import rasterio
+
+# 本进程使用的大地水准面格网文件和 .npy 缓存目录（init_worker 中设置），以及已加载的格网
+_GEOID = {'file': None, 'cache_dir': None}
+_GRIDS = {}
+_LOCK = threading.Lock()
+
+
+def set_geoid_file(path, cache_dir=None):
+    """设置本进程默认的 EGM96 格网文件（及 .npy 缓存目录，见 load_geoid_grid）并加载（每个进程只加载一次）"""
+    _GEOID['file'] = path
+    _GEOID['cache_dir'] = cache_dir
+    if path is not None:
+        load_geoid_grid(path, cache_dir)
+
+
+def geoid_file():
+    """本进程默认的 EGM96 格网文件（未设置时为 None）"""
+    return _GEOID['file']
+
+
+def load_geoid_grid(path, cache_dir=None):
+    """
+    读取大地水准面格网，返回 dict: 'values'（np.memmap，只读）, 'lat0', 'lon0', 'dlat', 'dlon'
+
+    支持 GeoTIFF（如 PROJ 的 us_nga_egm96_15.tif）和 NGA 的 ASCII 格网（WW15MGH.GRD）。
+    第一次使用时把格网值保存为 cache_dir 下的 <文件名>.npy（cache_dir 为 None 时与格网文件同目录），
+    之后以 np.memmap 只读方式打开，所有 worker 进程共享同一份操作系统页缓存，不各自复制；
+    缓存无法写出时（如只读的数据目录）每个进程读入内存使用
+    """
+    cache_dir = cache_dir if cache_dir is not None else _GEOID['cache_dir']
+    with _LOCK:
+        if path not in _GRIDS:
+            if path.lower().endswith('.grd'):
+                geometry, read_values = _grd_geometry(path), lambda: _read_grd(path)
+            else:
+                geometry, read_values = _tif_geometry(path), lambda: _read_tif(path)
+
+            if cache_dir is not None:
+                cache_path = os.path.join(cache_dir, os.path.basename(path) + '.npy')
+            else:
+                cache_path = path + '.npy'
+            if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+                values = read_values()
+                tmp_path = f"{cache_path}.{socket.gethostname()}.{os.getpid()}.tmp.npy"
+                try:
+                    np.save(tmp_path, values)
+                    os.replace(tmp_path, cache_path)
+                except OSError as e:
+                    print(f"Cannot write geoid cache {cache_path} ({e}), keeping the grid in memory")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    _GRIDS[path] = dict(geometry, values=values)
+                    return _GRIDS[path]
+            _GRIDS[path] = dict(geometry, values=np.load(cache_path, mmap_mode='r'))
+    return _GRIDS[path]
+
+
+def geoid_heights(lats, lons, grid):
+    """
+    双线性插值的大地水准面高度（米），lats / lons 为任意形状的数组，经度可为 -180~180 或 0~360
+
+    按经度周期取模，纬度超出格网范围时取边界值
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    values = grid['values']
+    n_rows, n_cols = values.shape
+    period = int(round(360 / abs(grid['dlon'])))
+
+    r = np.clip((lats - grid['lat0']) / grid['dlat'], 0, n_rows - 1)
+    r0 = np.minimum(np.floor(r).astype(np.intp), n_rows - 2)
+    fr = r - r0
+    c = np.mod((lons - grid['lon0']) / grid['dlon'], period)
+    c0 = np.floor(c).astype(np.intp) % period
+    fc = c - np.floor(c)
+    c1 = (c0 + 1) % period
+
+    v00 = values[r0, c0]
+    v01 = values[r0, c1]
+    v10 = values[r0 + 1, c0]
+    v11 = values[r0 + 1, c1]
+    top = v00 + (v01 - v00) * fc
+    bottom = v10 + (v11 - v10) * fc
+    return top + (bottom - top) * fr
+
+
+def _tif_geometry(path):
+    with rasterio.open(path) as src:
+        t = src.transform
+    # 像元中心为格网节点
+    return {'lat0': t.f + t.e / 2, 'lon0': t.c + t.a / 2, 'dlat': t.e, 'dlon': t.a}
+
+
+def _read_tif(path):
+    with rasterio.open(path) as src:
+        return src.read(1).astype(np.float32)
+
+
+def _grd_geometry(path):
+    """WW15MGH.GRD 第一行: 南纬界 北纬界 西经界 东经界 纬度间隔 经度间隔（度），数据从北到南逐行"""
+    with open(path) as f:
+        south, north, west, east, dlat, dlon = map(float, f.readline().split())
+    return {'lat0': north, 'lon0': west, 'dlat': -dlat, 'dlon': dlon}
+
+
+def _read_grd(path):
+    with open(path) as f:
+        south, north, west, east, dlat, dlon = map(float, f.readline().split())
+        values = np.array(f.read().split(), dtype=np.float32)
+    n_rows = int(round((north - south) / dlat)) + 1
+    n_cols = int(round((east - west) / dlon)) + 1
+    return values.reshape(n_rows, n_cols)
@@ -3,98 +3,310 @@ import h5py
 import numpy as np
 import rasterio
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from rasterio.windows import Window
+from module import (
+    fc_granule_index_nov20,
+    fc_atl08_reader_nov20,
+    fc_grouped_stats_nov20,
+    fc_ragged_table_nov20,
+    fc_metrics_nov20
+)
+
+ATL08_FOLDER = r'F:\ATL08_006-20250418_031619'
+
+# water_data 每条记录（granule × 波束 × 水体）的字段
+WATER_DATA_FIELDS = [
+    'id', 'mask_id', 'raw_num_points', 'raw_x_pts', 'raw_y_pts', 'raw_heights', 'terrain_flag', 'uncertainty',
+    'height', 'std', 'num_points', 'med_x', 'med_y', 'laser', 'doy', 'month', 'year', 'filename'
+]
 
 
 def calendar_to_doy(year, month, day):
     return datetime(year, month, day).timetuple().tm_yday
 
 
-def get_IS2_water_data_nov20(mask, metadata, R, transform):
-    LonLimits = R['lon_limits']
-    LatLimits = R['lat_limits']
+def get_IS2_water_data_nov20(mask, metadata, R, transform, granule_index=None, date_range=None,
+                             atl08_folder=ATL08_FOLDER, max_uncertainty=None, terrain_flag=None, beams=None):
+    """
+    读取与瓦片相交的 ATL08 granule 并按水体统计
+
+    granule_index : fc_granule_index_nov20.build_granule_index 的输出（可选）
+        提供时直接从空间索引取候选 granule，忽略 metadata
+    date_range : (start, end)，datetime.date，可选的日期过滤
+    atl08_folder : ATL08 HDF5 文件所在目录
+    max_uncertainty / terrain_flag : 读取时下推的过滤条件，见 fc_atl08_reader_nov20.read_beam_window
+    beams : 预先读取的波束数据（iter_tile_beams 的输出），提供时不再读取 HDF5
 
-    water_data = []
+    返回: (water_data, count)，water_data 为 fc_ragged_table_nov20.RaggedTable（每条记录的字段见 WATER_DATA_FIELDS）
+    """
+    parts = []
     count = 1
 
-    os.chdir(r'F:\ATL08_006-20250418_031619\\')
+    if beams is None:
+        if granule_index is not None:
+            metadata = fc_granule_index_nov20.query_granule_index(granule_index, R, date_range)
+        beams = iter_tile_beams(metadata, R, transform, date_range, atl08_folder, max_uncertainty, terrain_flag)
+
+    # 同一 granule 的波束一起统计
+    granule_beams = []
+    for meta, laser_name, beam in beams:
+        if granule_beams and granule_beams[0][0]['filename'] != meta['filename']:
+            count = _add_granule_part(parts, count, granule_beams)
+            granule_beams = []
+
+        lon = beam['longitude']
+        lat = beam['latitude']
+        fc_metrics_nov20.count('beams_read')
+        fc_metrics_nov20.count('points_read', len(lon))
+
+        I, J, valid_mask = geographic_to_discrete(transform, mask.shape, lat, lon)
+        fc_metrics_nov20.count('points_in_tile', np.count_nonzero(valid_mask))
+        if np.any(valid_mask):
+            granule_beams.append((meta, laser_name, beam, valid_mask, mask[I, J]))
+    count = _add_granule_part(parts, count, granule_beams)
+    return fc_ragged_table_nov20.RaggedTable.concatenate(parts), count - 1
+
+
+def iter_tile_beams(metadata, R, transform, date_range=None, atl08_folder=ATL08_FOLDER,
+                    max_uncertainty=None, terrain_flag=None, opened=None):
+    """
+    逐个读取与瓦片相交的波束窗口，生成 (meta, laser_name, beam)
+
+    只做 I/O，不需要 labeled mask，可在标记水体之前预读
+    opened : list，给定时追加打开的 granule 文件名（在没有当前指标记录的线程中预读时由调用者计数）
+    """
+    LonLimits = R['lon_limits']
+    LatLimits = R['lat_limits']
+
+    # 读取窗口外扩一个像元，保证覆盖所有落在瓦片像元内的点
+    lon_window = (LonLimits[0] - abs(transform.a), LonLimits[1] + abs(transform.a))
+    lat_window = (LatLimits[0] - abs(transform.e), LatLimits[1] + abs(transform.e))
 
     for meta in metadata:
+        if date_range is not None and not _in_date_range(meta, date_range):
+            continue
         if (meta['lon_min'] < LonLimits[1] and meta['lon_max'] > LonLimits[0] and
                 meta['lat_min'] < LatLimits[1] and meta['lat_max'] > LatLimits[0]):
 
-            lasers = meta['lasers']
-            filename = meta['filename']
+            fc_metrics_nov20.count('granules_opened')
+            if opened is not None:
+                opened.append(meta['filename'])
+            with h5py.File(os.path.join(atl08_folder, meta['filename']), 'r') as f:
+                for laser in meta['lasers']:
+                    beam = fc_atl08_reader_nov20.read_beam_window(
+                        f, laser, lon_window, lat_window,
+                        max_uncertainty=max_uncertainty, terrain_flag=terrain_flag
+                    )
+                    if beam is not None:
+                        yield meta, laser['Name'], beam
+
+
+def get_IS2_water_data_by_granule(labeled_files, granule_index, date_range=None, atl08_folder=ATL08_FOLDER,
+                                  max_uncertainty=None, terrain_flag=None, max_open_masks=16):
+    """
+    以 granule 为主循环读取 ICESat-2 数据: 每个 granule 只打开、解压一次，
+    其波束点被分配到所有与之相交的 labeled mask（STEP 1 写出的 GeoTIFF）
+
+    labeled_files : labeled mask GeoTIFF 路径列表
+    granule_index : fc_granule_index_nov20.build_granule_index 的输出
+    max_open_masks : 同时保持打开的 labeled mask 数
+
+    返回: {labeled_file: (water_data, count)}，与逐瓦片调用 get_IS2_water_data_nov20 的结果一致
+    """
+    tiles = []
+    for path in labeled_files:
+        with rasterio.open(path) as src:
+            bounds = src.bounds
+            transform = src.transform
+            shape = src.shape
+        tiles.append({
+            'path': path,
+            'transform': transform,
+            'shape': shape,
+            'lon_limits': (bounds.left, bounds.right),
+            'lat_limits': (bounds.bottom, bounds.top),
+            'lon_window': (bounds.left - abs(transform.a), bounds.right + abs(transform.a)),
+            'lat_window': (bounds.bottom - abs(transform.e), bounds.top + abs(transform.e))
+        })
+
+    # granule -> 相交的瓦片
+    granule_tiles = defaultdict(list)
+    for t, tile in enumerate(tiles):
+        ids = fc_granule_index_nov20.query_granule_ids(granule_index, tile['lon_limits'], tile['lat_limits'], date_range)
+        for gid in ids:
+            granule_tiles[int(gid)].append(t)
+
+    parts = [[] for _ in tiles]
+    counts = [1] * len(tiles)
+    open_masks = OrderedDict()
+
+    try:
+        for gid in sorted(granule_tiles):
+            meta = fc_granule_index_nov20.granule_records(granule_index, [gid])[0]
+            tile_ids = granule_tiles[gid]
+            lon_window = (min(tiles[t]['lon_window'][0] for t in tile_ids), max(tiles[t]['lon_window'][1] for t in tile_ids))
+            lat_window = (min(tiles[t]['lat_window'][0] for t in tile_ids), max(tiles[t]['lat_window'][1] for t in tile_ids))
 
-            with h5py.File(filename, 'r') as f:
-                for laser in lasers:
+            granule_beams = {t: [] for t in tile_ids}
+            fc_metrics_nov20.count('granules_opened')
+            if opened is not None:
+                opened.append(meta['filename'])
+            with h5py.File(os.path.join(atl08_folder, meta['filename']), 'r') as f:
+                for laser in meta['lasers']:
                     laser_name = laser['Name']
-                    try:
-                        lon = f[f'{laser_name}/land_segments/longitude'][:]
-                        lat = f[f'{laser_name}/land_segments/latitude'][:]
-                    except KeyError:
+                    beam = fc_atl08_reader_nov20.read_beam_window(
+                        f, laser, lon_window, lat_window,
+                        max_uncertainty=max_uncertainty, terrain_flag=terrain_flag
+                    )
+                    if beam is None:
                         continue
+                    fc_metrics_nov20.count('beams_read')
+                    fc_metrics_nov20.count('points_read', len(beam['longitude']))
+
+                    for t in tile_ids:
+                        tile = tiles[t]
+                        lo, la = beam['longitude'], beam['latitude']
+                        sel = ((la >= tile['lat_window'][0]) & (la <= tile['lat_window'][1]) &
+                               (lo >= tile['lon_window'][0]) & (lo <= tile['lon_window'][1]))
+                        if not np.any(sel):
+                            continue
+                        tile_beam = {name: values[sel] for name, values in beam.items()}
+
+                        I, J, valid_mask = geographic_to_discrete(tile['transform'], tile['shape'],
+                                                                  tile_beam['latitude'], tile_beam['longitude'])
+                        fc_metrics_nov20.count('points_in_tile', np.count_nonzero(valid_mask))
+                        if np.any(valid_mask):
+                            mask_val = _read_mask_values(open_masks, tile['path'], I, J, max_open_masks)
+                            granule_beams[t].append((meta, laser_name, tile_beam, valid_mask, mask_val))
+
+            for t in tile_ids:
+                counts[t] = _add_granule_part(parts[t], counts[t], granule_beams[t])
+    finally:
+        for src in open_masks.values():
+            src.close()
+
+    return {
+        tile['path']: (fc_ragged_table_nov20.RaggedTable.concatenate(parts[t]), counts[t] - 1)
+        for t, tile in enumerate(tiles)
+    }
+
+
+def _add_granule_part(parts, count, beams):
+    """统计一个 granule 的波束，结果追加到 parts，返回更新后的 count"""
+    part = _granule_water_data(beams, count)
+    if part is None:
+        return count
+    fc_metrics_nov20.count('crossings', len(part))
+    fc_metrics_nov20.count('points_kept', part.column('raw_num_points').sum())
+    parts.append(part)
+    return count + len(part)
+
+
+def _granule_water_data(beams, first_id):
+    """
+    按 (波束, 水体) 统计同一 granule 各波束落在瓦片内的点，返回 water_data 表（RaggedTable），id 从 first_id 开始
+
+    beams : [(meta, laser_name, beam, valid_mask, mask_val), ...]
+    所有波束的点拼接后按 (波束, 水体) 排序一次，p10 / p90 去除异常值、中值、标准差和中值坐标对所有组一起计算；
+    各组的 raw_* 点按组拼接存放（offsets 索引），不为每个组复制
+    """
+    if not beams:
+        return None
+
+    fields = ('longitude', 'latitude', 'h_te_mean', 'terrain_flg', 'h_te_uncertainty')
+    data = {name: np.concatenate([beam[name][valid_mask] for _, _, beam, valid_mask, _ in beams]) for name in fields}
+    body = np.concatenate([np.asarray(mask_val, dtype=np.int64) for *_, mask_val in beams])
+    beam_no = np.repeat(np.arange(len(beams)), [len(mask_val) for *_, mask_val in beams])
+
+    # 与逐波束 np.unique(mask_val)[1:] 相同: 跳过每个波束中最小的编号（通常为背景 0）
+    beam_min = np.array([np.min(mask_val) for *_, mask_val in beams], dtype=np.int64)
+    sel = np.flatnonzero(body != beam_min[beam_no])
+    if len(sel) == 0:
+        return None
+
+    # 稳定排序，组内保持点的原始顺序；只保留点数 > 2 的组
+    order = sel[np.lexsort((body[sel], beam_no[sel]))]
+    _, starts, counts = fc_grouped_stats_nov20.group_bounds(beam_no[order] * (body.max() + 1) + body[order])
+    order = order[np.repeat(counts > 2, counts)]
+    counts = counts[counts > 2]
+    if len(counts) == 0:
+        return None
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+
+    data = {name: values[order] for name, values in data.items()}
+    group_beam = beam_no[order][starts]
+    group_body = body[order][starts]
+    member = np.repeat(np.arange(len(counts)), counts)
+
+    heights = data['h_te_mean']
+    _, sorted_heights, _ = fc_grouped_stats_nov20.sort_by_group(member, heights)
+    p90 = fc_grouped_stats_nov20.group_percentile(sorted_heights, starts, counts, 90)
+    p10 = fc_grouped_stats_nov20.group_percentile(sorted_heights, starts, counts, 10)
+    inliers = ~((heights > np.repeat(p90, counts)) | (heights < np.repeat(p10, counts)))
+
+    # p10 <= p90 之间至少有一个点，每组都有保留的点
+    kept_member = member[inliers]
+    _, kept_starts, kept_counts = fc_grouped_stats_nov20.group_bounds(kept_member)
+    _, kept_heights, _ = fc_grouped_stats_nov20.sort_by_group(kept_member, heights[inliers])
+    _, kept_x, _ = fc_grouped_stats_nov20.sort_by_group(kept_member, data['longitude'][inliers])
+    _, kept_y, _ = fc_grouped_stats_nov20.sort_by_group(kept_member, data['latitude'][inliers])
+    height = fc_grouped_stats_nov20.group_median(kept_heights, kept_starts, kept_counts)
+    std = fc_grouped_stats_nov20.group_mean_std(kept_heights, kept_starts, kept_counts)[1].astype(heights.dtype)
+    med_x = fc_grouped_stats_nov20.group_median(kept_x, kept_starts, kept_counts)
+    med_y = fc_grouped_stats_nov20.group_median(kept_y, kept_starts, kept_counts)
+
+    doys = np.array([calendar_to_doy(meta['year'], meta['month'], meta['day']) for meta, *_ in beams])
+    metas = [meta for meta, *_ in beams]
+    n = len(counts)
+    columns = {
+        'id': np.arange(first_id, first_id + n),
+        'mask_id': group_body,
+        'raw_num_points': counts,
+        'height': height,
+        'std': std,
+        'num_points': kept_counts,
+        'med_x': med_x,
+        'med_y': med_y,
+        'laser': np.array([name for _, name, *_ in beams])[group_beam],
+        'doy': doys[group_beam],
+        'month': np.array([meta['month'] for meta in metas])[group_beam],
+        'year': np.array([meta['year'] for meta in metas])[group_beam],
+        'filename': np.array([meta['filename'] for meta in metas])[group_beam]
+    }
+    ragged = {
+        'raw_x_pts': data['longitude'],
+        'raw_y_pts': data['latitude'],
+        'raw_heights': data['h_te_mean'],
+        'terrain_flag': data['terrain_flg'],
+        'uncertainty': data['h_te_uncertainty']
+    }
+    table = fc_ragged_table_nov20.RaggedTable(columns, ragged, np.r_[0, np.cumsum(counts)])
+    table.fields = WATER_DATA_FIELDS
+    return table
+
+
+def _read_mask_values(open_masks, path, I, J, max_open):
+    """只读取覆盖 (I, J) 的 labeled mask 窗口并取值"""
+    if path in open_masks:
+        open_masks.move_to_end(path)
+    else:
+        if len(open_masks) >= max_open:
+            _, oldest = open_masks.popitem(last=False)
+            oldest.close()
+        open_masks[path] = rasterio.open(path)
+    src = open_masks[path]
+
+    r0, c0 = int(I.min()), int(J.min())
+    window = Window(c0, r0, int(J.max()) - c0 + 1, int(I.max()) - r0 + 1)
+    block = src.read(1, window=window)
+    return block[I - r0, J - c0]
+
 
-                    I, J, valid_mask = geographic_to_discrete(transform, mask.shape, lat, lon)
-                    if np.sum(np.isnan(I)) < len(I):
-                        elev = f[f'{laser_name}/land_segments/terrain/h_te_mean'][:]
-                        terrain_flag = f[f'{laser_name}/land_segments/terrain_flg'][:]
-                        uncertainty = f[f'{laser_name}/land_segments/terrain/h_te_uncertainty'][:]
-                        elev = elev[valid_mask]
-                        lat = lat[valid_mask]
-                        lon = lon[valid_mask]
-                        terrain_flag = terrain_flag[valid_mask]
-                        uncertainty = uncertainty[valid_mask]
-
-                        mask_val = mask[I, J]
-
-                        year = meta['year']
-                        month = meta['month']
-                        day = meta['day']
-                        doy = calendar_to_doy(year, month, day)
-
-                        unique_bodies = np.unique(mask_val)
-
-                        if len(unique_bodies) > 1:
-                            for body in unique_bodies[1:]:
-                                ind = np.where(mask_val == body)[0]
-                                if len(ind) > 2:
-                                    heights = elev[ind]
-                                    p90 = np.percentile(heights, 90)
-                                    p10 = np.percentile(heights, 10)
-
-                                    all_X = lon[ind].copy()
-                                    all_Y = lat[ind].copy()
-
-                                    outliers = (heights > p90) | (heights < p10)
-                                    all_X = all_X[~outliers]
-                                    all_Y = all_Y[~outliers]
-                                    heights = heights[~outliers]
-
-                                    entry = {
-                                        'id': count,
-                                        'mask_id': int(body),
-                                        'raw_num_points': len(ind),
-                                        'raw_x_pts': lon[ind],
-                                        'raw_y_pts': lat[ind],
-                                        'raw_heights': elev[ind],
-                                        'terrain_flag': terrain_flag[ind],
-                                        'uncertainty': uncertainty[ind],
-                                        'height': np.median(heights),
-                                        'std': np.std(heights),
-                                        'num_points': len(heights),
-                                        'med_x': np.median(all_X),
-                                        'med_y': np.median(all_Y),
-                                        'laser': laser_name,
-                                        'doy': doy,
-                                        'month': month,
-                                        'year': year,
-                                        'filename': filename
-                                    }
-
-                                    water_data.append(entry)
-                                    count += 1
-    return water_data, count - 1
+def _in_date_range(meta, date_range):
+    d = datetime(meta['year'], meta['month'], meta['day']).date()
+    start, end = date_range
+    return (start is None or d >= start) and (end is None or d <= end)
 
 
 def geographic_to_discrete(transform, shape, lat, lon):
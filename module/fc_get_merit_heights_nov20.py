@@ -1,16 +1,41 @@
 import os
+import socket
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
 import rasterio
-from skimage.transform import resize
-from skimage.measure import regionprops, label
+from rasterio.windows import Window
+from scipy import ndimage
+from module import fc_grouped_stats_nov20
 
+# MERIT Hydro 5° 高程块的大小，以及四块拼接后的大小
+MERIT_TILE = 6000
+MOSAIC_SHAPE = (2 * MERIT_TILE, 2 * MERIT_TILE)
+MERIT_NODATA = -9999
+# 分批计算高程统计时每批的像元数
+STATS_CHUNK = 2 ** 24
 
 
-def get_merit_heights_nov20(path, mask_metadata, labeled, swo_shape):
+def get_merit_heights_nov20(path, mask_metadata, labeled, swo_shape, elev=None, pixels_for=None, cache=None):
     """
     获取 MERIT Hydro 数据对应的高程值
     mask_metadata: dict，包含 'lon', 'lat', 'ew', 'ns' 字段
     labeled: numpy array，水体mask的label图
+    elev: 预先读取的 MERIT 拼接高程（read_merit_mosaic 的输出），可选；
+        不提供时只按窗口读取水体所在的 MERIT 区域
+    pixels_for: 需要同时返回 MERIT 像元值的 label 集合，可选（见 merit_heights_from_mosaic）
+    cache: MeritCache，可选；多个瓦片共用时相邻瓦片不再重复解码同一 MERIT 文件
+    """
+    if elev is None:
+        reader = MeritWindowReader(merit_files(path, mask_metadata), cache)
+        return merit_heights_from_windows(reader.read, labeled, swo_shape, pixels_for)
+    return merit_heights_from_mosaic(elev, labeled, swo_shape, pixels_for)
+
+
+def merit_files(path, mask_metadata):
+    """
+    覆盖瓦片的四个 MERIT 高程块的文件路径，按拼接后的位置排列: [[左上, 右上], [左下, 右下]]
     """
 
     lonnum = mask_metadata['lon']
@@ -63,14 +88,13 @@ def get_merit_heights_nov20(path, mask_metadata, labeled, swo_shape):
 
 
     merit_folder = os.path.join(path, 'MERIT_Hydro_elv', f'elv_{folderlat}{folderlon}')
-    os.chdir(merit_folder)
 
     def format_lon_lat(lon, ew, lat, ns):
         lonstr = f"{int(lon):03d}"
         latstr = f"{int(lat):02d}"
         return f"{ns}{latstr}{ew}{lonstr}_elv.tif"
 
-    def read_elev_file(lon_offset, lat_offset):
+    def elev_file(lon_offset, lat_offset):
         if mask_metadata['ew'] == 'W':
             l = lonnum + lon_offset
             ew = 'w'
@@ -85,52 +109,225 @@ def get_merit_heights_nov20(path, mask_metadata, labeled, swo_shape):
             la = latnum + lat_offset
             ns = 's'
 
-        filename = format_lon_lat(l, ew, la, ns)
+        return os.path.join(merit_folder, format_lon_lat(l, ew, la, ns))
 
-        if os.path.exists(filename):
-            with rasterio.open(filename) as src:
-                elev = src.read(1)
-        else:
-            elev = np.full((6000, 6000), -9999, dtype=np.float32)
+    # 四个高程块
+    elev1 = elev_file(-5, +10)
+    elev2 = elev_file(0, +10)
+    elev3 = elev_file(-5, +5)
+    elev4 = elev_file(0, +5)
+
+    # 拼接后的位置
+    return [[elev4, elev3], [elev2, elev1]]
+
+
+def read_merit_mosaic(path, mask_metadata, cache=None):
+    """读取覆盖瓦片的四个 MERIT 高程块并拼接（只做 I/O，可在标记水体之前预读）；给定 cache 时经由 MeritCache 读取"""
+    files = merit_files(path, mask_metadata)
+    if cache is not None:
+        return MeritWindowReader(files, cache).read(0, MOSAIC_SHAPE[0], 0, MOSAIC_SHAPE[1])
+    return np.concatenate([np.concatenate([_read_merit_file(f) for f in row], axis=1) for row in files], axis=0)
+
+
+def _read_merit_file(filename):
+    if os.path.exists(filename):
+        with rasterio.open(filename) as src:
+            return src.read(1)
+    return np.full((MERIT_TILE, MERIT_TILE), MERIT_NODATA, dtype=np.float32)
+
+
+class MeritCache:
+    """
+    解码后的 MERIT 高程块缓存，可在相邻瓦片之间共享（同一个 MERIT 5° 文件被多个 GSWO 瓦片使用）
+
+    - 内存层: 按字节数限制（max_bytes）的 LRU，超出时淘汰最久未使用的块；
+    - 磁盘层（disk_dir，可选）: 解码后的块保存为 .npy，以 np.memmap 方式读取，
+      多个 worker 进程（或节点）共享同一目录时只需解码一次，且共享操作系统页缓存而不复制；
+    - counters: 'hits'（内存命中）、'disk_hits'（磁盘层命中）、'misses'（读取 GeoTIFF 解码）、'evictions'。
+
+    线程安全（prefetch 模式的多个 I/O 线程可共用一个实例）
+    """
+
+    def __init__(self, max_bytes=2 * 2 ** 30, disk_dir=None, block_size=500):
+        if MERIT_TILE % block_size:
+            raise ValueError(f"block_size must divide {MERIT_TILE}")
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.block_size = block_size
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._dtypes = {}
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def dtype(self, filename):
+        """文件的数据类型（文件不存在时为填充值的 float32）"""
+        if filename not in self._dtypes:
+            if os.path.exists(filename):
+                with rasterio.open(filename) as src:
+                    self._dtypes[filename] = np.dtype(src.dtypes[0])
+            else:
+                self._dtypes[filename] = np.dtype(np.float32)
+        return self._dtypes[filename]
+
+    def block(self, filename, br, bc):
+        """文件中第 (br, bc) 个 block_size × block_size 的块"""
+        key = (filename, br, bc)
+        with self._lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                self.counters['hits'] += 1
+                return self.blocks[key]
+
+        block = self._load(filename, br, bc)
+
+        with self._lock:
+            if key not in self.blocks:
+                self.blocks[key] = block
+                self.nbytes += block.nbytes
+            while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+                _, old = self.blocks.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.counters['evictions'] += 1
+        return block
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, blocks=len(self.blocks), nbytes=self.nbytes)
+
+    def _load(self, filename, br, bc):
+        bs = self.block_size
+        if not os.path.exists(filename):
+            return np.full((bs, bs), MERIT_NODATA, dtype=np.float32)
+
+        disk_path = self._disk_path(filename, br, bc) if self.disk_dir is not None else None
+        if disk_path is not None and os.path.exists(disk_path):
+            with self._lock:
+                self.counters['disk_hits'] += 1
+            return np.load(disk_path, mmap_mode='r')
 
-        return elev
+        with self._lock:
+            self.counters['misses'] += 1
+        with rasterio.open(filename) as src:
+            block = src.read(1, window=Window(bc * bs, br * bs, bs, bs))
 
-    # 读取四个高程块
-    elev1 = read_elev_file(-5, +10)
-    elev2 = read_elev_file(0, +10)
-    elev3 = read_elev_file(-5, +5)
-    elev4 = read_elev_file(0, +5)
+        if disk_path is not None:
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            tmp_path = f"{disk_path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+            np.save(tmp_path, block)
+            os.replace(tmp_path, disk_path)
+        return block
 
-    # 拼接成一个大图
-    elev12 = np.concatenate([elev2, elev1], axis=1)
-    elev34 = np.concatenate([elev4, elev3], axis=1)
-    elev = np.concatenate([elev34, elev12], axis=0)
+    def _disk_path(self, filename, br, bc):
+        # 文件名 + 大小 + 修改时间 确定一个文件版本
+        st = os.stat(filename)
+        version = hashlib.md5(f"{os.path.abspath(filename)}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.disk_dir, f"{name}_{version}", f"{self.block_size}_{br}_{bc}.npy")
 
-    # 重采样到 8806×19151
-    elev_resized = resize(elev, swo_shape, order=0, preserve_range=True, anti_aliasing=False)
 
-    # regionprops 获取每个label区内高程像元值
-    stats = regionprops(labeled, intensity_image=elev_resized)
+class MeritWindowReader:
+    """
+    按窗口读取四个 MERIT 高程块拼接后的区域，不生成整幅拼接数组
+
+    高程块由 MeritCache 提供（未指定时使用只属于本读取器的 256 MB 缓存）；
+    缺失的文件按 -9999 填充（与 read_merit_mosaic 相同）
+    """
+
+    def __init__(self, files, cache=None):
+        self.files = files
+        self.cache = cache if cache is not None else MeritCache(max_bytes=256 * 2 ** 20)
+        self.dtype = np.result_type(*[self.cache.dtype(f) for row in files for f in row])
+
+    def read(self, r0, r1, c0, c1):
+        """拼接坐标下 [r0, r1) × [c0, c1) 的高程"""
+        bs = self.cache.block_size
+        out = np.empty((r1 - r0, c1 - c0), dtype=self.dtype)
+        for br in range(r0 // bs, (r1 - 1) // bs + 1):
+            for bc in range(c0 // bs, (c1 - 1) // bs + 1):
+                qr, qc = br * bs // MERIT_TILE, bc * bs // MERIT_TILE
+                block = self.cache.block(self.files[qr][qc], br - qr * MERIT_TILE // bs, bc - qc * MERIT_TILE // bs)
+                rr0, rr1 = max(r0, br * bs), min(r1, (br + 1) * bs)
+                cc0, cc1 = max(c0, bc * bs), min(c1, (bc + 1) * bs)
+                out[rr0 - r0:rr1 - r0, cc0 - c0:cc1 - c0] = block[rr0 - br * bs:rr1 - br * bs, cc0 - bc * bs:cc1 - bc * bs]
+        return out
+
+
+def merit_index_map(n_in, n_out):
+    """
+    拼接高程重采样到瓦片大小时（最近邻，与 skimage resize(order=0) 相同），瓦片的每行/列对应的 MERIT 行/列
+    """
+    zoom = np.float64(n_in) / np.float64(n_out)
+    coord = (np.arange(n_out, dtype=np.float64) + 0.5) * zoom - 0.5
+    return np.clip(np.floor(coord + 0.5).astype(np.int64), 0, n_in - 1)
+
+
+def merit_heights_from_mosaic(elev, labeled, swo_shape, pixels_for=None):
+    """
+    由拼接高程计算每个水体的 MERIT 高程统计
+
+    pixels_for : label 集合（可选）；给定时同时返回这些水体的 MERIT 像元值 {label: px}，
+        用于跨瓦片水体合并后重新统计
+    """
+    def read(r0, r1, c0, c1):
+        return elev[r0:r1, c0:c1]
+
+    return merit_heights_from_windows(read, labeled, swo_shape, pixels_for, elev.shape)
+
+
+def merit_heights_from_windows(read, labeled, swo_shape, pixels_for=None, mosaic_shape=MOSAIC_SHAPE):
+    """
+    逐水体计算 MERIT 高程统计，不生成重采样到瓦片大小（8806×19151 等）的整幅高程
+
+    每个水体的像元按最近邻对应到拼接高程的行列号（与 resize(order=0) 相同），
+    只读取 read(r0, r1, c0, c1) 返回的对应窗口
+    """
+    row_map = merit_index_map(mosaic_shape[0], swo_shape[0])
+    col_map = merit_index_map(mosaic_shape[1], swo_shape[1])
 
     merit_heights = []
-    for region in stats:
-        px = region.intensity_image[region.image]
-        p90 = np.percentile(px, 90)
-        p10 = np.percentile(px, 10)
-        px_clipped = px[(px >= p10) & (px <= p90)]
-
-        if len(px_clipped) == 0 or np.all(np.isnan(px_clipped)):
-            merit_heights.append({
-                'height': np.nan,
-                'std': np.nan,
-                'mean': np.nan
-            })
+    pixels = {}
+    chunk_labels, chunk_px, chunk_size = [], [], 0
+    for i, sl in enumerate(ndimage.find_objects(labeled)):
+        if sl is None:
             continue
+        region_label = i + 1
+        image = labeled[sl] == region_label
+        rows, cols = row_map[sl[0]], col_map[sl[1]]
+        window = read(rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+        px = window[np.ix_(rows - rows[0], cols - cols[0])][image]
+
+        if pixels_for is not None and region_label in pixels_for:
+            pixels[region_label] = px
+        chunk_labels.append(region_label)
+        chunk_px.append(px)
+        chunk_size += len(px)
+        # 像元按水体分批统计，限制拼接后数组的大小
+        if chunk_size >= STATS_CHUNK:
+            merit_heights += _merit_stats_grouped(chunk_labels, chunk_px)
+            chunk_labels, chunk_px, chunk_size = [], [], 0
+    merit_heights += _merit_stats_grouped(chunk_labels, chunk_px)
+
+    if pixels_for is None:
+        return merit_heights
+    return merit_heights, pixels
+
+
+def merit_stats(px):
+    """单个水体 MERIT 像元值的统计: 去掉 nodata 以及 10% / 90% 分位数以外的值后取中值、标准差、均值"""
+    return _merit_stats_grouped([1], [px])[0]
 
-        merit_heights.append({
-            'height': np.nanmedian(px_clipped),
-            'std': np.nanstd(px_clipped),
-            'mean': np.nanmean(px_clipped)
-        })
 
-    return merit_heights
+def _merit_stats_grouped(region_labels, pxs):
+    """一次排序计算多个水体的 merit_stats，返回与 region_labels 顺序相同的 dict 列表"""
+    if not region_labels:
+        return []
+    ids = np.asarray(region_labels)
+    groups = np.repeat(ids, [len(px) for px in pxs])
+    stats = fc_grouped_stats_nov20.clipped_stats(groups, np.concatenate(pxs), ids, 10, 90, MERIT_NODATA)
+    return [
+        {'height': h, 'std': s, 'mean': m}
+        for h, s, m in zip(stats['height'], stats['std'], stats['mean'])
+    ]
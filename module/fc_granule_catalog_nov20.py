@@ -0,0 +1,273 @@
+import os
+import json
+import sqlite3
+import h5py
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+# 元数据格式版本，低于该版本的记录会被重新提取
+META_VERSION = 2
+
+# 沿轨纬度索引的纬度带宽（度）
+LAT_BAND = 1.0
+
+META_COLUMNS = ('filename', 'lon_min', 'lon_max', 'lat_min', 'lat_max', 'year', 'month', 'day', 'lasers')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS granules (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    lon_min REAL, lon_max REAL, lat_min REAL, lat_max REAL,
+    year INTEGER, month INTEGER, day INTEGER,
+    date INTEGER,
+    lasers TEXT,
+    version INTEGER
+);
+CREATE INDEX IF NOT EXISTS granules_lat ON granules (lat_min, lat_max);
+CREATE INDEX IF NOT EXISTS granules_date ON granules (date);
+CREATE TABLE IF NOT EXISTS failures (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    error TEXT
+);
+"""
+
+
+def extract_metadata(file_path):
+    """提取单个 HDF5 文件的元数据"""
+    try:
+        with h5py.File(file_path, 'r') as f:
+            lon_min = f.attrs['geospatial_lon_min']
+            lon_max = f.attrs['geospatial_lon_max']
+            lat_min = f.attrs['geospatial_lat_min']
+            lat_max = f.attrs['geospatial_lat_max']
+            start_time = f.attrs['time_coverage_start']
+            if isinstance(start_time, bytes):
+                start_time = start_time.decode()
+
+            laser_names = [group for group in f.keys() if 'gt' in group]
+            laser_out = [extract_beam_metadata(f, name) for name in laser_names]
+
+        meta = {
+            'filename': os.path.basename(file_path),
+            'lon_min': lon_min,
+            'lon_max': lon_max,
+            'lat_min': lat_min,
+            'lat_max': lat_max,
+            'year': int(start_time[0:4]),
+            'month': int(start_time[5:7]),
+            'day': int(start_time[8:10]),
+            'lasers': laser_out
+        }
+
+        return meta, None  # 返回元数据和无错误
+
+    except Exception as e:
+        return None, f"Error reading file: {os.path.basename(file_path)} - {str(e)}"
+
+
+def extract_beam_metadata(f, laser_name, lat_band=LAT_BAND):
+    """
+    提取单个波束的包围盒和粗粒度沿轨纬度索引
+
+    纬度索引: 第 k 个纬度带 [(band0 + k) * lat_band, (band0 + k + 1) * lat_band)
+    内的所有 segment 落在下标区间 [band_start[k], band_stop[k]) 内
+    """
+    beam = {'Name': laser_name, 'n_segments': 0}
+    try:
+        lon = f[f'{laser_name}/land_segments/longitude'][:]
+        lat = f[f'{laser_name}/land_segments/latitude'][:]
+    except KeyError:
+        return beam
+
+    beam['n_segments'] = int(len(lat))
+    valid = np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    if not np.any(valid):
+        return beam
+
+    beam['lon_min'] = float(lon[valid].min())
+    beam['lon_max'] = float(lon[valid].max())
+    beam['lat_min'] = float(lat[valid].min())
+    beam['lat_max'] = float(lat[valid].max())
+
+    seg = np.where(valid)[0]
+    band = np.floor(lat[valid] / lat_band).astype(np.int64)
+    band0 = int(band.min())
+    nband = int(band.max()) - band0 + 1
+    band_start = np.full(nband, len(lat), dtype=np.int64)
+    band_stop = np.zeros(nband, dtype=np.int64)
+    np.minimum.at(band_start, band - band0, seg)
+    np.maximum.at(band_stop, band - band0, seg + 1)
+    empty = band_stop == 0
+    band_start[empty] = 0
+
+    beam['lat_band'] = lat_band
+    beam['band0'] = band0
+    beam['band_start'] = band_start.tolist()
+    beam['band_stop'] = band_stop.tolist()
+    return beam
+
+
+def beam_window(laser, lon_limits, lat_limits):
+    """
+    根据波束元数据确定与瓦片相交的 segment 下标区间
+
+    返回 None 表示该波束与瓦片不相交（可直接跳过）；
+    否则返回 (start, stop)，stop 为 None 表示读到末尾。
+    旧版本元数据（没有波束包围盒）返回 (0, None)。
+    """
+    if laser.get('n_segments') == 0:
+        return None
+    if 'lat_min' not in laser:
+        return (0, None)
+
+    if (laser['lon_max'] < lon_limits[0] or laser['lon_min'] > lon_limits[1] or
+            laser['lat_max'] < lat_limits[0] or laser['lat_min'] > lat_limits[1]):
+        return None
+
+    lat_band = laser['lat_band']
+    band_start = laser['band_start']
+    band_stop = laser['band_stop']
+    k0 = max(int(np.floor(lat_limits[0] / lat_band)) - laser['band0'], 0)
+    k1 = min(int(np.floor(lat_limits[1] / lat_band)) - laser['band0'], len(band_start) - 1)
+
+    starts = [band_start[k] for k in range(k0, k1 + 1) if band_stop[k] > 0]
+    stops = [band_stop[k] for k in range(k0, k1 + 1) if band_stop[k] > 0]
+    if not starts:
+        return None
+    return (min(starts), max(stops))
+
+
+def update_catalog(input_folder, catalog_path, max_workers=8):
+    """
+    增量更新 SQLite granule 目录
+
+    以 (filename, size, mtime) 判断文件是否新增或改变，只重新打开这些文件；
+    磁盘上已删除的文件从目录中移除。读取失败的文件记录在 failures 表中，
+    文件未改变时不再重试。
+
+    返回: (更新数, 删除数, 错误列表)
+    """
+    if os.path.dirname(catalog_path):
+        os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+
+    # 搜索符合条件的文件
+    on_disk = {}
+    with os.scandir(input_folder) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith('.h5'):
+                st = entry.stat()
+                if st.st_size >= 10000:
+                    on_disk[entry.name] = (st.st_size, st.st_mtime)
+
+    con = sqlite3.connect(catalog_path)
+    try:
+        con.executescript(_SCHEMA)
+        if 'version' not in [row[1] for row in con.execute("PRAGMA table_info(granules)")]:
+            con.execute("ALTER TABLE granules ADD COLUMN version INTEGER DEFAULT 1")
+        known = {}
+        for name, size, mtime, version in con.execute("SELECT filename, size, mtime, version FROM granules"):
+            # 旧版本记录视为已改变，重新提取
+            known[name] = (size, mtime) if version == META_VERSION else None
+        for name, size, mtime in con.execute("SELECT filename, size, mtime FROM failures"):
+            known[name] = (size, mtime)
+
+        removed = [name for name in known if name not in on_disk]
+        todo = [name for name, stamp in on_disk.items() if known.get(name) != stamp]
+
+        with con:
+            con.executemany("DELETE FROM granules WHERE filename = ?", [(n,) for n in removed + todo])
+            con.executemany("DELETE FROM failures WHERE filename = ?", [(n,) for n in removed + todo])
+
+        errors = []
+        rows, failed = [], []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_file = {executor.submit(extract_metadata, os.path.join(input_folder, name)): name
+                              for name in todo}
+
+            for count, future in enumerate(as_completed(future_to_file), 1):
+                name = future_to_file[future]
+                size, mtime = on_disk[name]
+                result, error = future.result()
+                if result:
+                    rows.append(_meta_to_row(result, size, mtime))
+                if error:
+                    errors.append(error)
+                    failed.append((name, size, mtime, error))
+                print(f"Finished {count} of {len(todo)}")
+
+                # 分批写入，避免中断后全部丢失
+                if len(rows) >= 1000 or count == len(todo):
+                    _write_rows(con, rows, failed)
+                    rows, failed = [], []
+    finally:
+        con.close()
+
+    return len(todo), len(removed), errors
+
+
+def load_catalog(catalog_path, columns=None, lon_limits=None, lat_limits=None, date_range=None):
+    """
+    从 SQLite 目录读取 granule 元数据
+
+    columns : 需要的列（默认 META_COLUMNS）
+    lon_limits / lat_limits : 只返回包围盒与该范围相交的 granule
+    date_range : (start, end)，datetime.date，闭区间，任一端可为 None
+
+    返回与原 pickle 相同格式的 dict 列表（按 filename 排序）
+    """
+    columns = list(columns or META_COLUMNS)
+    for col in columns:
+        if col not in META_COLUMNS + ('size', 'mtime', 'date'):
+            raise ValueError(f"Unknown catalog column: {col}")
+
+    where, args = [], []
+    if lon_limits is not None:
+        where += ["lon_min < ?", "lon_max > ?"]
+        args += [lon_limits[1], lon_limits[0]]
+    if lat_limits is not None:
+        where += ["lat_min < ?", "lat_max > ?"]
+        args += [lat_limits[1], lat_limits[0]]
+    if date_range is not None:
+        start, end = date_range
+        if start is not None:
+            where.append("date >= ?")
+            args.append(start.toordinal())
+        if end is not None:
+            where.append("date <= ?")
+            args.append(end.toordinal())
+
+    sql = f"SELECT {', '.join(columns)} FROM granules"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY filename"
+
+    con = sqlite3.connect(catalog_path)
+    try:
+        metadata = []
+        for row in con.execute(sql, args):
+            meta = dict(zip(columns, row))
+            if 'lasers' in meta:
+                meta['lasers'] = json.loads(meta['lasers'])
+            metadata.append(meta)
+    finally:
+        con.close()
+
+    return metadata
+
+
+def _meta_to_row(meta, size, mtime):
+    return (meta['filename'], size, mtime,
+            float(meta['lon_min']), float(meta['lon_max']), float(meta['lat_min']), float(meta['lat_max']),
+            meta['year'], meta['month'], meta['day'],
+            date(meta['year'], meta['month'], meta['day']).toordinal(),
+            json.dumps(meta['lasers']), META_VERSION)
+
+
+def _write_rows(con, rows, failed):
+    with con:
+        con.executemany("INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        con.executemany("INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?)", failed)
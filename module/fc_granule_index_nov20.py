@@ -0,0 +1,146 @@
+import pickle
+from datetime import date
+
+import numpy as np
+
+
+def build_granule_index(metadata, cell_size=1.0, max_cells=4096):
+    """
+    基于经纬度分桶网格为 ATL08 granule 元数据建立空间索引
+
+    参数:
+        metadata : list of dict
+            batch_extract_metadata 的输出（每个 granule 一条记录）
+        cell_size : float
+            网格单元大小（度）
+        max_cells : int
+            单个 granule 覆盖的网格数超过该值时（如跨越日界线或极区），
+            放入溢出列表，每次查询都作为候选再做精确判断
+
+    返回:
+        dict: 列式存储的 granule 属性 + CSR 形式的网格成员表
+    """
+    n = len(metadata)
+    nx = int(np.ceil(360.0 / cell_size))
+    ny = int(np.ceil(180.0 / cell_size))
+
+    columns = {}
+    keys = list(metadata[0].keys()) if n else []
+    for key in keys:
+        values = [meta[key] for meta in metadata]
+        if key in ('lon_min', 'lon_max', 'lat_min', 'lat_max'):
+            columns[key] = np.array(values, dtype=np.float64)
+        elif key in ('year', 'month', 'day'):
+            columns[key] = np.array(values, dtype=np.int32)
+        else:
+            col = np.empty(n, dtype=object)
+            col[:] = values
+            columns[key] = col
+
+    if n:
+        dates = np.array([date(m['year'], m['month'], m['day']).toordinal() for m in metadata], dtype=np.int64)
+        ix0, iy0 = _cell_xy(columns['lon_min'], columns['lat_min'], cell_size, nx, ny)
+        ix1, iy1 = _cell_xy(columns['lon_max'], columns['lat_max'], cell_size, nx, ny)
+    else:
+        dates = np.zeros(0, dtype=np.int64)
+        ix0 = iy0 = ix1 = iy1 = np.zeros(0, dtype=np.int64)
+
+    ncx = ix1 - ix0 + 1
+    ncy = iy1 - iy0 + 1
+    ncell = ncx * ncy
+
+    overflow = np.where(ncell > max_cells)[0]
+    gid = np.where(ncell <= max_cells)[0]
+
+    # 展开每个 granule 覆盖的网格单元
+    counts = ncell[gid]
+    members = np.repeat(gid, counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cx = ix0[members] + local % ncx[members]
+    cy = iy0[members] + local // ncx[members]
+    cells = cy * nx + cx
+
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    members = members[order]
+    offsets = np.searchsorted(cells, np.arange(nx * ny + 1))
+
+    return {
+        'cell_size': cell_size,
+        'nx': nx,
+        'ny': ny,
+        'offsets': offsets.astype(np.int64),
+        'members': members.astype(np.int64),
+        'overflow': overflow.astype(np.int64),
+        'date': dates,
+        'keys': keys,
+        'columns': columns
+    }
+
+
+def query_granule_index(index, R, date_range=None):
+    """
+    查询与瓦片范围 R（lon_limits / lat_limits）相交的候选 granule
+
+    date_range : (start, end)，datetime.date，闭区间，任一端可为 None
+
+    返回与线性扫描相同顺序的元数据 dict 列表
+    """
+    hits = query_granule_ids(index, R['lon_limits'], R['lat_limits'], date_range)
+    return granule_records(index, hits)
+
+
+def query_granule_ids(index, lon_limits, lat_limits, date_range=None):
+    """返回相交 granule 在原始 metadata 中的位置（升序）"""
+    cs, nx, ny = index['cell_size'], index['nx'], index['ny']
+    cols = index['columns']
+    if len(index['date']) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ix0, iy0 = _cell_xy(np.array([lon_limits[0]]), np.array([lat_limits[0]]), cs, nx, ny)
+    ix1, iy1 = _cell_xy(np.array([lon_limits[1]]), np.array([lat_limits[1]]), cs, nx, ny)
+
+    offsets = index['offsets']
+    parts = [index['overflow']]
+    for cy in range(iy0[0], iy1[0] + 1):
+        c0 = cy * nx + ix0[0]
+        c1 = cy * nx + ix1[0]
+        parts.append(index['members'][offsets[c0]:offsets[c1 + 1]])
+    cand = np.unique(np.concatenate(parts))
+
+    # 精确包围盒判断（与原线性扫描条件一致）
+    keep = ((cols['lon_min'][cand] < lon_limits[1]) & (cols['lon_max'][cand] > lon_limits[0]) &
+            (cols['lat_min'][cand] < lat_limits[1]) & (cols['lat_max'][cand] > lat_limits[0]))
+
+    if date_range is not None:
+        start, end = date_range
+        d = index['date'][cand]
+        if start is not None:
+            keep &= d >= start.toordinal()
+        if end is not None:
+            keep &= d <= end.toordinal()
+
+    return cand[keep]
+
+
+def granule_records(index, ids):
+    """由列式存储还原指定位置的元数据 dict"""
+    cols = index['columns']
+    values = {key: cols[key][ids].tolist() for key in index['keys']}
+    return [{key: values[key][i] for key in index['keys']} for i in range(len(ids))]
+
+
+def save_granule_index(index, output_path):
+    with open(output_path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_granule_index(index_path):
+    with open(index_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _cell_xy(lon, lat, cell_size, nx, ny):
+    ix = np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / cell_size).astype(np.int64)
+    iy = np.floor((np.asarray(lat, dtype=np.float64) + 90.0) / cell_size).astype(np.int64)
+    return np.clip(ix, 0, nx - 1), np.clip(iy, 0, ny - 1)
@@ -0,0 +1,139 @@
+import numpy as np
+
+
+def sort_by_group(groups, values):
+    """
+    按 (group, value) 排序（一次 lexsort），NaN 排在各组末尾
+
+    返回: (sorted_groups, sorted_values, order)
+    """
+    order = np.lexsort((values, groups))
+    return groups[order], values[order], order
+
+
+def group_bounds(sorted_groups):
+    """已排序的组编号 -> (ids, starts, counts)"""
+    if len(sorted_groups) == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return sorted_groups[:0], empty, empty
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    counts = np.diff(np.r_[starts, len(sorted_groups)])
+    return sorted_groups[starts], starts, counts
+
+
+def group_percentile(sorted_values, starts, counts, q):
+    """
+    各组的 q 分位数（0-100），与 np.percentile(px, q)（linear 插值）逐组结果相同
+
+    sorted_values 须按组排序、组内升序；含 NaN 的组结果为 NaN
+    """
+    dtype = sorted_values.dtype
+    # 与 numpy 相同的虚拟下标和插值权重计算顺序
+    quantile = q / 100
+    virtual = counts * quantile + (1 + quantile * (1 - 1 - 1)) - 1
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = previous.astype(np.intp)
+    following = previous + 1
+    above = virtual >= counts - 1
+    previous[above] = following[above] = counts[above] - 1
+    below = virtual < 0
+    previous[below] = following[below] = 0
+
+    a = sorted_values[starts + previous]
+    b = sorted_values[starts + following]
+    diff_b_a = b - a
+    result = a + diff_b_a * gamma.astype(dtype)
+    upper = gamma >= 0.5
+    result[upper] = (b - diff_b_a * (1 - gamma).astype(dtype))[upper]
+
+    last = sorted_values[starts + counts - 1]
+    has_nan = np.isnan(last)
+    result[has_nan] = last[has_nan]
+    return result
+
+
+def percentile_clip(groups, values, lower=10, upper=90, nodata=None):
+    """
+    按组去掉 lower / upper 分位数以外的值（保留 p_lower <= v <= p_upper，与逐组 np.percentile 相同）
+
+    nodata : 不参与统计的填充值（如 MERIT 的 -9999），可选
+
+    返回 dict:
+        'groups', 'values' : 按 (group, value) 排序后的有效值
+        'order' : 排序后元素在输入中的下标
+        'keep' : 排序后元素是否保留
+        'ids', 'starts', 'counts' : 排序后各组的编号、起点和元素数
+    """
+    valid = np.ones(len(values), dtype=bool) if nodata is None else values != nodata
+    index = np.flatnonzero(valid)
+    sorted_groups, sorted_values, order = sort_by_group(groups[index], values[index])
+    ids, starts, counts = group_bounds(sorted_groups)
+
+    p_lower = np.repeat(group_percentile(sorted_values, starts, counts, lower), counts)
+    p_upper = np.repeat(group_percentile(sorted_values, starts, counts, upper), counts)
+    keep = (sorted_values >= p_lower) & (sorted_values <= p_upper)
+
+    return {
+        'groups': sorted_groups, 'values': sorted_values, 'order': index[order], 'keep': keep,
+        'ids': ids, 'starts': starts, 'counts': counts
+    }
+
+
+def clipped_stats(groups, values, ids=None, lower=10, upper=90, nodata=None):
+    """
+    每组去掉 lower / upper 分位数以外的值后的中值、标准差、均值和保留的元素数
+
+    等同于逐组执行:
+        px = values[groups == g]（去掉 nodata）
+        px = px[(px >= np.percentile(px, lower)) & (px <= np.percentile(px, upper))]
+        np.nanmedian(px), np.nanstd(px), np.nanmean(px)
+    标准差和均值用 float64 累加，与逐组结果的差别在浮点误差范围内。
+
+    ids : 需要返回结果的组编号（升序），默认为 groups 中出现的所有组；没有有效值的组结果为 NaN
+
+    返回 dict: 'ids', 'height', 'std', 'mean'（values 的类型）, 'count'
+    """
+    clip = percentile_clip(groups, values, lower, upper, nodata)
+    dtype = clip['values'].dtype if clip['values'].dtype.kind == 'f' else np.dtype(np.float64)
+    if ids is None:
+        ids = clip['ids']
+
+    # 保留的值（NaN 不参与，与 nan* 函数相同）在每组内仍连续、升序
+    keep = clip['keep'] & ~np.isnan(clip['values'])
+    kept_groups = clip['groups'][keep]
+    kept = clip['values'][keep]
+    kept_ids, starts, counts = group_bounds(kept_groups)
+
+    height = np.full(len(ids), np.nan, dtype=dtype)
+    std = np.full(len(ids), np.nan, dtype=dtype)
+    mean = np.full(len(ids), np.nan, dtype=dtype)
+    count = np.zeros(len(ids), dtype=np.int64)
+    if len(kept_ids) > 0:
+        at = np.searchsorted(ids, kept_ids)
+        avg, sd = group_mean_std(kept, starts, counts)
+        height[at] = group_median(kept, starts, counts)
+        std[at] = sd
+        mean[at] = avg
+        count[at] = counts
+
+    return {'ids': ids, 'height': height, 'std': std, 'mean': mean, 'count': count}
+
+
+def group_median(sorted_values, starts, counts):
+    """各组（非空、组内升序、不含 NaN）的中值，与 np.median 逐组结果相同"""
+    mid = starts + counts // 2
+    even = counts % 2 == 0
+    median = sorted_values[mid]
+    if sorted_values.dtype.kind != 'f':
+        median = median.astype(np.float64)
+    median[even] = ((sorted_values[mid - 1] + sorted_values[mid]) / 2)[even]
+    return median
+
+
+def group_mean_std(values, starts, counts):
+    """各组（非空、连续存放）的均值和标准差（ddof=0），float64 累加"""
+    values = values.astype(np.float64)
+    avg = np.add.reduceat(values, starts) / counts
+    dev = values - np.repeat(avg, counts)
+    return avg, np.sqrt(np.add.reduceat(dev * dev, starts) / counts)
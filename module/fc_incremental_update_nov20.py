@@ -0,0 +1,134 @@
+"""
+增量更新: 新一批 ATL08 数据加入 granule 目录后，只读取每个瓦片尚未读取的 granule
+
+每个瓦片处理 STEP 3 时记录读取过的 granule（ingested_<tag>_v1.pkl）。增量更新时:
+1. 用 granule 索引查询瓦片的候选 granule，去掉已读取的；
+2. 用已保存的 labeled mask 对新 granule 执行 STEP 3（get_IS2_water_data_nov20）；
+3. 新过境并入已有 water_data（按 granule 文件名和原编号排序后重新编号，与全部重算时的顺序一致），
+   只对有新过境的水体重新执行 organize_IS2_data，其他水体沿用已有结果。
+water mask、统计量和 MERIT 高程不重新计算。跨瓦片合并（stitch）模式的结果不支持增量更新。
+"""
+
+import os
+import pickle
+import numpy as np
+from module import (
+    fc_get_IS2_water_data_nov20,
+    fc_granule_index_nov20,
+    fc_organize_IS2_data_nov20,
+    fc_ragged_table_nov20,
+    fc_result_store_nov20,
+    fc_metrics_nov20
+)
+
+
+def ingested_path(mask_output, tag):
+    return os.path.join(mask_output, f"ingested_{tag}_v1.pkl")
+
+
+def save_ingested(mask_output, tag, granules):
+    """保存瓦片已读取的 granule 文件名（先写临时文件再改名）"""
+    path = ingested_path(mask_output, tag)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(sorted(set(granules)), f)
+    os.replace(tmp_path, path)
+
+
+def load_ingested(mask_output, tag, water_data=None):
+    """
+    瓦片已读取的 granule 文件名集合
+
+    没有记录时（记录功能加入前处理的瓦片）以已有 water_data 中出现过的 granule 代替，
+    没有过境的 granule 会在第一次增量更新时重新读取一次
+    """
+    path = ingested_path(mask_output, tag)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return set(pickle.load(f))
+    if water_data is not None and len(water_data):
+        return set(water_data.column('filename').tolist())
+    return set()
+
+
+def update_tile(tile, paths, granule_index, date_range=None, result_format='hdf5'):
+    """
+    增量更新一个瓦片的结果
+
+    tile : dict，包含 'tag', 'mask_l', 'R', 'R1', 'stats', 'merit_heights'（见 fc_tile_pipeline_nov20.load_labeled_tile）
+    返回新读取的过境数
+    """
+    tag = tile['tag']
+    path = _existing_result(paths['results_output'], tag)
+    old_co = old_wd = None
+    if path is not None:
+        old = fc_result_store_nov20.load_results(path)
+        old_co = _as_table(old['complete_output'], fc_organize_IS2_data_nov20.OBS_FIELDS)
+        old_wd = _as_table(old['water_data'], fc_organize_IS2_data_nov20.RAW_FIELDS)
+        if 'members' in old_co.fields:
+            raise ValueError(f"{tag}: stitched results cannot be updated incrementally")
+    recorded = load_ingested(paths['mask_output'], tag, old_wd)
+    ingested = set(recorded)
+    if old_wd is not None and len(old_wd):
+        # 结果已保存而 ingested 记录未写出时（中途终止或重试），结果中已有过境的 granule 不再读取，避免重复并入
+        ingested |= set(old_wd.column('filename').tolist())
+
+    candidates = fc_granule_index_nov20.query_granule_index(granule_index, tile['R1'], date_range)
+    new = [meta for meta in candidates if meta['filename'] not in ingested]
+    print(f"{tag}: {len(candidates)} candidate granules, {len(new)} new")
+    if not new:
+        if ingested != recorded:
+            save_ingested(paths['mask_output'], tag, ingested)
+        return 0
+
+    with fc_metrics_nov20.stage('is2_read', tag):
+        new_wd, count = fc_get_IS2_water_data_nov20.get_IS2_water_data_nov20(
+            tile['mask_l'], new, tile['R1'], tile['R'], atl08_folder=paths['atl08']
+        )
+    # 合并后只有一次过境时不保存结果（与 STEP 4 相同），也不记录新 granule，下次重新读取
+    with fc_metrics_nov20.stage('organize', tag):
+        merged = count == 0 or _merge_results(tile, paths, old_co, old_wd, new_wd, result_format)
+    if merged:
+        save_ingested(paths['mask_output'], tag, ingested | {meta['filename'] for meta in new})
+    return count
+
+
+def _merge_results(tile, paths, old_co, old_wd, new_wd, result_format):
+    """新过境并入 water_data，只重新整理有新过境的水体；合并后不足两次过境时返回 False"""
+    water_data = fc_ragged_table_nov20.RaggedTable.concatenate([t for t in (old_wd, new_wd) if t is not None])
+    order = np.lexsort((water_data.column('id'), water_data.column('filename')))
+    water_data = water_data.take(order).assign(id=np.arange(1, len(water_data) + 1))
+    if len(water_data) <= 1:
+        return False
+
+    affected = np.unique(new_wd.column('mask_id'))
+    stats = tile['stats']
+    updated = fc_organize_IS2_data_nov20.organize_IS2_data(
+        water_data.take(np.isin(water_data.column('mask_id'), affected)),
+        tile['merit_heights'], stats['extent'], stats['goodd_res'], stats['lake_area'], stats['mask_ids']
+    )
+
+    parts = [updated]
+    if old_co is not None and len(old_co):
+        parts.insert(0, old_co.take(~np.isin(old_co.column('mask_id'), affected)))
+    complete_output = fc_ragged_table_nov20.RaggedTable.concatenate(parts)
+    if complete_output:
+        complete_output = complete_output.take(np.argsort(complete_output.column('mask_id'), kind='stable'))
+        fc_result_store_nov20.save_results(paths['results_output'], tile['tag'], complete_output, water_data,
+                                           result_format)
+    return True
+
+
+def _existing_result(results_output, tag):
+    """已有的结果文件（优先 .h5），没有时返回 None"""
+    for result_format in ('hdf5', 'pickle'):
+        path = fc_result_store_nov20.result_path(results_output, tag, result_format)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _as_table(records, ragged_fields):
+    if isinstance(records, fc_ragged_table_nov20.RaggedTable):
+        return records
+    return fc_ragged_table_nov20.RaggedTable.from_records(records, ragged_fields)
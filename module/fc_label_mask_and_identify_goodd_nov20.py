@@ -7,10 +7,15 @@ from shapely.geometry import Point, Polygon, LineString
 from skimage.measure import label, regionprops
 from skimage.morphology import binary_erosion, binary_dilation
 from shapely.vectorized import contains
-from tqdm import tqdm
-from scipy.spatial import cKDTree
 from rasterio.transform import xy
-from shapely import covers
+from scipy import ndimage
+from module import fc_blockwise_label_nov20, inpoly, fc_metrics_nov20
+from shapely import covers, get_parts, get_rings
+
+# GSWO 水体出现频率阈值（%），不低于该值的像元为水体（255 为无数据）
+OCCURRENCE_THRESHOLD = 75
+
+
 def strel_disk_4(r):
     size = 2 * r + 1
     se = np.zeros((size, size), dtype=np.uint8)
@@ -22,11 +27,75 @@ def strel_disk_4(r):
                 se[i, j] = 1
 
     return se
-def label_mask_and_identify_goodd(mask, R, glon, glat, coast_gdf, edit):
+def reservoir_mask(mask, R, glon, glat, r_water=6, r_dam=36, block_size=None, scratch_dir=None):
+    """
+    水库识别: 水体掩膜按半径 r_water 的菱形膨胀后做 8 连通标记，
+    与 dam 点的距离（棋盘 L1 距离）不超过 r_dam 的连通区记为水库（r_dam = 36 等价于半径 6 的菱形连续膨胀 6 次）
+
+    只投影落在瓦片范围内的 dam 点，并只在每个 dam 点周围的窗口内查找相邻的连通区；
+    瓦片内没有 dam 点时返回 None（不做膨胀和标记）
+    block_size : 给定时分块膨胀和标记（见 fc_blockwise_label_nov20）
+    返回: uint8 数组，水库连通区为 1
+    """
+    rows, cols = dam_pixels(mask.shape, R, glon, glat)
+    if len(rows) == 0:
+        return None
+
+    se = strel_disk_4(r_water).astype(bool)
+    if block_size is None:
+        res_mask_labeled = label(binary_dilation(mask, se), connectivity=2)
+        n = res_mask_labeled.max()
+    else:
+        res_mask = fc_blockwise_label_nov20.binary_dilation_blocks(mask, se, block_size, scratch_dir)
+        res_mask_labeled, n = fc_blockwise_label_nov20.label_blocks(res_mask, block_size, scratch_dir)
+        del res_mask
+
+    disk = strel_disk_4(r_dam).astype(bool)
+    n_rows, n_cols = mask.shape
+    tagged = np.zeros(n + 1, dtype=bool)
+    for r, c in set(zip(rows.tolist(), cols.tolist())):
+        r0, r1 = max(r - r_dam, 0), min(r + r_dam + 1, n_rows)
+        c0, c1 = max(c - r_dam, 0), min(c + r_dam + 1, n_cols)
+        window = disk[r0 - r + r_dam:r1 - r + r_dam, c0 - c + r_dam:c1 - c + r_dam]
+        tagged[res_mask_labeled[r0:r1, c0:c1][window]] = True
+    tagged[0] = False
+
+    if block_size is None:
+        return tagged[res_mask_labeled].astype(np.uint8)
+    return fc_blockwise_label_nov20.relabel_blocks(res_mask_labeled, tagged.astype(np.uint8), block_size, scratch_dir)
+
+
+def dam_pixels(shape, R, glon, glat):
+    """将落在瓦片内的 dam 点投影到行列号（先按瓦片经纬度范围粗筛）"""
+    n_rows, n_cols = shape
+    lons = (R.c, R.c + n_cols * R.a)
+    lats = (R.f, R.f + n_rows * R.e)
+    pad_lon, pad_lat = abs(R.a), abs(R.e)
+    near = ((glon >= min(lons) - pad_lon) & (glon <= max(lons) + pad_lon) &
+            (glat >= min(lats) - pad_lat) & (glat <= max(lats) + pad_lat))
+
+    cols, rows = (~R) * (glon[near], glat[near])
+    cols = np.floor(cols).astype(int)
+    rows = np.floor(rows).astype(int)
+
+    valid = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+    return rows[valid], cols[valid]
 
 
+def label_mask_and_identify_goodd(mask, R, glon, glat, coast_gdf, edit, block_size=None, scratch_dir=None,
+                                  coast_backend='shapely'):
+    """
+    block_size : 给定时按 block_size × block_size 分块执行腐蚀、膨胀和标记，中间数组使用最小可用整数类型，
+        整幅数组存放在临时文件中、逐块读写（结果与整幅计算相同）；输入 mask 应为按块读取的 np.memmap
+        （见 fc_tile_pipeline_nov20.read_mask），否则仍占用整幅内存
+    scratch_dir : 分块模式下整幅中间数组（以及返回的 mask_l）所在的临时文件目录（np.memmap），None 时为系统临时目录
+    coast_backend : 海岸线判断的点在多边形内算法，'shapely' 或 'inpoly'（见 _in_any_polygon）
+    """
+    if block_size is not None:
+        return _label_mask_blocks(mask, R, glon, glat, coast_gdf, edit, block_size, scratch_dir, coast_backend)
+
     # STEP 1: 保留大于75%的水体
-    mask[(mask < 75) | (mask == 255)] = 0
+    mask[(mask < OCCURRENCE_THRESHOLD) | (mask == 255)] = 0
     mask[mask > 1] = 1
     mask = mask.astype(np.uint8)
 
@@ -35,29 +104,9 @@ def label_mask_and_identify_goodd(mask, R, glon, glat, coast_gdf, edit):
         mask[30698:30883, 27495:27911] = 0
         mask[28528:29102, 29695:30535] = 0
 
-    # STEP 2: 水库识别，膨胀掩膜
-    se = strel_disk_4(6).astype(bool)
-    res_mask = binary_dilation(mask, se)
-
-    # 将 dam 点投影到行列号
-    cols, rows = (~R) * (glon, glat)
-    cols = np.floor(cols).astype(int)
-    rows = np.floor(rows).astype(int)
-
-    valid = (cols >= 0) & (cols < mask.shape[1]) & (rows >= 0) & (rows < mask.shape[0])
-    cols, rows = cols[valid], rows[valid]
-
-    r_mask = np.zeros_like(mask)
-    r_mask[rows, cols] = 1
-
-    for _ in range(6):
-        r_mask = binary_dilation(r_mask, se)
-
-    res_mask_labeled = label(res_mask, connectivity=2)
-
-    stats = regionprops(res_mask_labeled, intensity_image=r_mask)
-    idx = [i.label for i in stats if i.max_intensity == 1]
-    res_mask_out = np.isin(res_mask_labeled, idx).astype(np.uint8)
+    # STEP 2: 水库识别: 膨胀掩膜后与 dam 点邻近的连通区
+    with fc_metrics_nov20.stage('reservoir'):
+        res_mask_out = reservoir_mask(mask, R, glon, glat)
 
     # STEP 3: 腐蚀掩膜并标记 8连通
     se = strel_disk_4(1).astype(bool)
@@ -66,61 +115,14 @@ def label_mask_and_identify_goodd(mask, R, glon, glat, coast_gdf, edit):
 
     stats = regionprops(mask_l)
     idx = [i.label for i in stats if i.extent > 0.05 and i.area > 20]
+    fc_metrics_nov20.count('regions_in', len(stats))
+    fc_metrics_nov20.count('regions_filtered', len(idx))
     mask = np.isin(mask_l, idx)
     mask_l = label(mask, connectivity=2)
 
     print('removing coastline...')
-    stats = regionprops(mask_l)
-    test_ocean = np.zeros(len(stats))
-
-    coast_sindex = coast_gdf.sindex
-
-    for i, region in enumerate(tqdm(stats)):
-        vert = region.coords
-        if len(vert) > 5000:
-            vert = vert[::6, :]
-        else:
-            vert = vert[::3, :]
-
-        lons, lats = xy(R, vert[:, 0], vert[:, 1], offset='center')
-        verts = np.vstack((lons, lats)).T
-
-        minx, miny = np.min(verts, axis=0)
-        maxx, maxy = np.max(verts, axis=0)
-        bounds = (minx, miny, maxx, maxy)
-
-        possible_matches_idx = list(coast_sindex.intersection(bounds))
-        possible_matches = coast_gdf.iloc[possible_matches_idx]
-
-        if possible_matches.empty:
-            continue
-
-        # 加速判定用 cKDTree
-        verts_tree = cKDTree(verts)
-        in_any_coast = np.zeros(len(verts), dtype=bool)
-
-        # 初始化累积矩阵，注意是 False 数组（相当于 MATLAB 的 basins = zeros）
-        basins = np.zeros(len(verts), dtype=int)
-
-        for poly in possible_matches.geometry:
-            if poly.is_empty:
-                continue
-
-            # 判断哪些点在多边形内
-            in_poly = contains(poly, verts[:, 0], verts[:, 1])
-
-            # 累加到 basins
-            basins += in_poly.astype(int)
-
-        # 超过 1 的地方强制设为 1，和 MATLAB 版一样
-        basins[basins > 1] = 1
-
-        # 判断覆盖比例是否 ≥ 90%
-        if np.sum(basins) < 0.9 * len(basins):
-            test_ocean[i] = 0
-        else:
-            test_ocean[i] = 1
-
+    with fc_metrics_nov20.stage('coastline'):
+        test_ocean = coast_coverage_test(mask_l, R, coast_gdf, backend=coast_backend)
     idx = np.where(test_ocean == 1)[0] + 1
 
     mask = np.isin(mask_l, idx)
@@ -140,15 +142,21 @@ def label_mask_and_identify_goodd(mask, R, glon, glat, coast_gdf, edit):
         mask_l = mask_l.astype(np.uint32)
 
     # STEP 4: 提取属性
-    stats = regionprops(mask_l, intensity_image=res_mask_out)
-    X, Y, lake_area, extent, goodd_res = [], [], [], [], []
+    stats = regionprops(mask_l)
+    fc_metrics_nov20.count('regions_out', len(stats))
+    X, Y, lake_area, extent = [], [], [], []
 
     for s in stats:
         X.append(s.centroid[1])
         Y.append(s.centroid[0])
         lake_area.append(10**-6 * 30 * 30 * s.area)
         extent.append(s.extent)
-        goodd_res.append(s.max_intensity if s.max_intensity is not None else np.nan)
+
+    # 每个水体内 res_mask_out 的最大值（按 label 归约）
+    if res_mask_out is None or not stats:
+        goodd_res = np.zeros(len(stats))
+    else:
+        goodd_res = np.asarray(ndimage.maximum(res_mask_out, mask_l, [s.label for s in stats]), dtype=float)
 
     if stats:
         lons, lats = xy(R, [s.centroid[0] for s in stats], [s.centroid[1] for s in stats], offset='center')
@@ -156,4 +164,196 @@ def label_mask_and_identify_goodd(mask, R, glon, glat, coast_gdf, edit):
     else:
         lon, lat = 0, 0
 
-    return mask_l, np.array(lake_area), np.array(goodd_res), lat, lon, np.array(extent)
\ No newline at end of file
+    return mask_l, np.array(lake_area), np.array(goodd_res), lat, lon, np.array(extent)
+
+
+def coast_coverage_test(mask_l, R, coast_gdf, block_rows=None, backend='shapely'):
+    """
+    判断每个水体是否落在海岸线多边形（GSHHS 陆地）内: 采样点中 ≥ 90% 在多边形内记为 1，否则为 0
+
+    采样方式与逐水体循环相同（每个水体的像元按行优先排列，超过 5000 个像元时每 6 个取 1 个，否则每 3 个取 1 个），
+    但所有水体的采样点一次性转换坐标，并对每个候选多边形只做一次批量的点在多边形内判断
+
+    mask_l : 连续编号（1..N）的 label 图
+    block_rows : 给定时按该行数分条处理（跨条带累计每个水体的像元序号），内存只与条带大小有关
+    backend : 点在多边形内的算法，'shapely' 或 'inpoly'
+    返回: 长度为 N 的数组，第 i 个元素对应 label i + 1
+    """
+    n_labels = int(mask_l.max())
+    test_ocean = np.zeros(n_labels)
+    if n_labels == 0:
+        return test_ocean
+
+    n_rows, n_cols = mask_l.shape
+    block_rows = block_rows or n_rows
+    counts = np.zeros(n_labels + 1, dtype=np.int64)
+    for r0 in range(0, n_rows, block_rows):
+        counts += np.bincount(np.asarray(mask_l[r0:r0 + block_rows]).ravel(), minlength=n_labels + 1)
+    step = np.where(counts > 5000, 6, 3)
+
+    seen = np.zeros(n_labels + 1, dtype=np.int64)
+    n_inside = np.zeros(n_labels + 1, dtype=np.int64)
+    n_sample = np.zeros(n_labels + 1, dtype=np.int64)
+    for r0 in range(0, n_rows, block_rows):
+        strip = np.asarray(mask_l[r0:r0 + block_rows])
+
+        # 水体像元（行优先），按 label 稳定排序后即为各水体的 region.coords 顺序
+        flat = np.flatnonzero(strip)
+        if len(flat) == 0:
+            continue
+        labels = strip.ravel()[flat].astype(np.int64)
+        order = np.argsort(labels, kind='stable')
+        flat, labels = flat[order], labels[order]
+        del order
+
+        strip_counts = np.bincount(labels, minlength=n_labels + 1)
+        starts = np.concatenate(([0], np.cumsum(strip_counts)[:-1]))
+        rank = np.arange(len(flat)) - starts[labels] + seen[labels]
+        seen += strip_counts
+        keep = rank % step[labels] == 0
+        flat, labels = flat[keep], labels[keep]
+        del rank, keep
+
+        rows, cols = np.divmod(flat, n_cols)
+        lons, lats = xy(R, rows + r0, cols, offset='center')
+        inside = _in_any_polygon(np.asarray(lons), np.asarray(lats), coast_gdf, backend)
+        n_inside += np.bincount(labels[inside], minlength=n_labels + 1)
+        n_sample += np.bincount(labels, minlength=n_labels + 1)
+
+    # 判断覆盖比例是否 ≥ 90%
+    test_ocean[n_inside[1:] >= 0.9 * n_sample[1:]] = 1
+    return test_ocean
+
+
+def _in_any_polygon(lons, lats, coast_gdf, backend='shapely'):
+    """
+    点是否落在任一多边形内
+
+    backend : 'shapely'（逐个候选多边形调用 shapely.vectorized.contains）或
+        'inpoly'（所有候选多边形一次调用 inpoly.inpoly2_many，边界上的点不计入，与 contains 相同）
+    """
+    # 点在多边形内时必在其包围盒内，因此候选多边形只需与所有点的包围盒相交
+    bounds = (lons.min(), lats.min(), lons.max(), lats.max())
+    possible_matches = coast_gdf.iloc[list(coast_gdf.sindex.intersection(bounds))]
+
+    in_any_coast = np.zeros(len(lons), dtype=bool)
+    by_lon = np.argsort(lons, kind='stable')
+    lons_sorted = lons[by_lon]
+    subs, polys = [], []
+    for poly in possible_matches.geometry:
+        if poly is None or poly.is_empty:
+            continue
+        minx, miny, maxx, maxy = poly.bounds
+        sub = by_lon[np.searchsorted(lons_sorted, minx, side='left'):np.searchsorted(lons_sorted, maxx, side='right')]
+        sub = sub[(lats[sub] >= miny) & (lats[sub] <= maxy) & ~in_any_coast[sub]]
+        if len(sub) == 0:
+            continue
+        if backend == 'inpoly':
+            subs.append(sub)
+            polys.append(poly)
+        else:
+            in_any_coast[sub] = contains(poly, lons[sub], lats[sub])
+
+    if backend == 'inpoly' and subs:
+        nodes, edges = zip(*[_polygon_edges(poly) for poly in polys])
+        verts = [np.column_stack((lons[sub], lats[sub])) for sub in subs]
+        for sub, (stat, bnds) in zip(subs, inpoly.inpoly2_many(verts, list(nodes), list(edges))):
+            in_any_coast[sub[stat & ~bnds]] = True
+    return in_any_coast
+
+
+def _polygon_edges(poly):
+    """(Multi)Polygon 的所有环（外环和内环）-> inpoly 的 node、edge"""
+    rings = [np.asarray(ring.coords)[:, :2] for ring in get_rings(get_parts(poly))]
+    node = np.concatenate(rings)
+    starts = np.r_[0, np.cumsum([len(r) for r in rings])[:-1]]
+    # 环的坐标首尾重合，每个环 len - 1 条边
+    first = np.concatenate([start + np.arange(len(r) - 1) for start, r in zip(starts, rings)])
+    return node, np.column_stack((first, first + 1))
+
+
+def _label_mask_blocks(mask, R, glon, glat, coast_gdf, edit, block_size, scratch_dir, coast_backend='shapely'):
+    """label_mask_and_identify_goodd 的分块实现"""
+    blocks = fc_blockwise_label_nov20
+
+    # STEP 1: 保留大于75%的水体（uint8 输入原地修改）
+    water = mask if mask.dtype == np.uint8 else blocks.empty_array(mask.shape, np.uint8, scratch_dir)
+    for rs, cs in blocks.block_slices(mask.shape, block_size):
+        m = mask[rs, cs]
+        water[rs, cs] = (m >= OCCURRENCE_THRESHOLD) & (m != 255)
+
+    if edit == 1:
+        water[13924:14008, 22545:22635] = 0
+        water[30698:30883, 27495:27911] = 0
+        water[28528:29102, 29695:30535] = 0
+
+    # STEP 2: 水库识别
+    with fc_metrics_nov20.stage('reservoir'):
+        res_mask_out = reservoir_mask(water, R, glon, glat, block_size=block_size, scratch_dir=scratch_dir)
+
+    # STEP 3: 腐蚀掩膜并标记 8连通，保留 extent > 0.05 且 area > 20 的水体
+    se = strel_disk_4(1).astype(bool)
+    eroded = blocks.binary_erosion_blocks(water, se, block_size, scratch_dir)
+    labels, n = blocks.label_blocks(eroded, block_size, scratch_dir)
+    del eroded
+
+    props = blocks.region_stats_blocks(labels, n, block_size)
+    area = props['area'][1:]
+    extent = area / ((props['max_row'][1:] - props['min_row'][1:] + 1) * (props['max_col'][1:] - props['min_col'][1:] + 1))
+    keep = (extent > 0.05) & (area > 20)
+    n = int(keep.sum())
+    fc_metrics_nov20.count('regions_in', len(keep))
+    fc_metrics_nov20.count('regions_filtered', n)
+    lut = np.zeros(len(keep) + 1, dtype=blocks.smallest_uint(n))
+    lut[1:][keep] = np.arange(1, n + 1)
+    mask_l = blocks.relabel_blocks(labels, lut, block_size, scratch_dir)
+    del labels
+
+    print('removing coastline...')
+    with fc_metrics_nov20.stage('coastline'):
+        test_ocean = coast_coverage_test(mask_l, R, coast_gdf, block_rows=block_size, backend=coast_backend)
+    lut = np.where(np.concatenate(([0], test_ocean)) == 1, np.arange(n + 1), 0).astype(mask_l.dtype)
+    for rs, cs in blocks.block_slices(mask_l.shape, block_size):
+        mask_l[rs, cs] = lut[mask_l[rs, cs]]
+
+    # 再腐蚀一次
+    eroded = blocks.binary_erosion_blocks(mask_l, se, block_size, scratch_dir)
+    m = 0
+    for rs, cs in blocks.block_slices(mask_l.shape, block_size):
+        block = mask_l[rs, cs]
+        block[~eroded[rs, cs]] = 0
+        m = max(m, int(block.max()))
+    del eroded
+
+    # 类型压缩
+    if m < 256:
+        dtype = np.uint8
+    elif m < 65536:
+        dtype = np.uint16
+    else:
+        dtype = np.uint32
+    if mask_l.dtype != dtype:
+        mask_l = blocks.astype_blocks(mask_l, dtype, block_size, scratch_dir)
+
+    # STEP 4: 提取属性（按 label 逐块累计）
+    props = blocks.region_stats_blocks(mask_l, m, block_size, intensity=res_mask_out)
+    present = np.nonzero(props['area'] > 0)[0]
+    fc_metrics_nov20.count('regions_out', len(present))
+    area = props['area'][present]
+    rows = props['row_sum'][present] / area
+    cols = props['col_sum'][present] / area
+    lake_area = 10**-6 * 30 * 30 * area
+    extent = area / ((props['max_row'][present] - props['min_row'][present] + 1) *
+                     (props['max_col'][present] - props['min_col'][present] + 1))
+    if res_mask_out is None:
+        goodd_res = np.zeros(len(present))
+    else:
+        goodd_res = props['max_intensity'][present]
+
+    if len(present):
+        lons, lats = xy(R, rows, cols, offset='center')
+        lon, lat = np.array(lons), np.array(lats)
+    else:
+        lon, lat = 0, 0
+
+    return mask_l, lake_area, goodd_res, lat, lon, extent
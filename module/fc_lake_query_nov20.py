@@ -0,0 +1,320 @@
+"""
+已处理水体结果（results_<tag>_v1.h5 / .pkl）的空间和时间查询
+
+build_lake_index 读取每个结果文件的水体汇总（位置、观测日期），建立持久化索引:
+    - 空间: 与 granule 索引相同的经纬度分桶网格，每个水体按 lon / lat 放入一个网格单元（CSR 成员表）；
+    - 时间: 每个水体的观测日期升序存放，键为 行号 * 2^20 + 日期（1970-01-01 起的天数），
+      查询时对候选水体二分查找，判断是否有观测落在日期范围内。
+查询只访问索引（毫秒级），时间序列由 iter_series 按瓦片懒加载（HDF5 结果只读取选中的水体）。
+serve_lake_index 以 JSON 提供 HTTP 查询，供看板使用。
+"""
+
+import os
+import glob
+import json
+import pickle
+import numpy as np
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from module import fc_ragged_table_nov20, fc_organize_IS2_data_nov20, fc_result_store_nov20
+
+# 索引中每个水体的汇总字段
+LAKE_FIELDS = ('mask_id', 'lon', 'lat', 'med_height', 'num_obs', 'area')
+# 时间键: 行号 * DATE_KEY + 日期
+DATE_KEY = 2 ** 20
+
+
+def build_lake_index(results_output, index=None, cell_size=1.0):
+    """
+    为结果目录中的所有结果文件建立水体索引（同一瓦片同时有 .h5 和 .pkl 时使用 .h5）
+
+    index : 已有的索引（可选），大小和修改时间未变的文件直接沿用其中的记录，只读取新增或更新的文件
+    返回: dict，列式存储的水体汇总（RaggedTable，变长字段 dates 为升序观测日期）+ 网格成员表
+    """
+    files = _result_files(results_output)
+    old = {}
+    if index is not None and index['cell_size'] == cell_size:
+        lakes = index['lakes']
+        for k, f in enumerate(index['files']):
+            old[(f['path'], f['size'], f['mtime'])] = lakes.take(lakes.column('file') == k)
+
+    parts = []
+    for k, f in enumerate(files):
+        key = (f['path'], f['size'], f['mtime'])
+        part = old[key] if key in old else _read_lakes(f['path'])
+        if len(part):
+            parts.append(part.assign(file=np.full(len(part), k)))
+    lakes = fc_ragged_table_nov20.RaggedTable.concatenate(parts)
+
+    nx = int(np.ceil(360.0 / cell_size))
+    ny = int(np.ceil(180.0 / cell_size))
+    if len(lakes):
+        ix, iy = _cell_xy(lakes.column('lon'), lakes.column('lat'), cell_size, nx, ny)
+        cells = iy * nx + ix
+        order = np.argsort(cells, kind='stable')
+        lakes = lakes.take(order)
+        cells = cells[order]
+    else:
+        cells = np.zeros(0, dtype=np.int64)
+
+    row = np.repeat(np.arange(len(lakes), dtype=np.int64), lakes.lengths())
+    return {
+        'cell_size': cell_size,
+        'nx': nx,
+        'ny': ny,
+        'offsets': np.searchsorted(cells, np.arange(nx * ny + 1)).astype(np.int64),
+        'files': files,
+        'lakes': lakes,
+        'date_key': row * DATE_KEY + lakes.ragged.get('dates', np.zeros(0, dtype=np.int64))
+    }
+
+
+def update_lake_index(index_path, results_output, cell_size=1.0):
+    """读取已保存的索引（如存在），只重新读取有变化的结果文件，保存并返回新索引"""
+    index = load_lake_index(index_path) if os.path.exists(index_path) else None
+    index = build_lake_index(results_output, index, cell_size)
+    save_lake_index(index, index_path)
+    return index
+
+
+def save_lake_index(index, output_path):
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, output_path)
+
+
+def load_lake_index(index_path):
+    with open(index_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def query_bbox(index, lon_limits, lat_limits, date_range=None):
+    """
+    查询位置在经纬度范围内（闭区间）的水体，返回索引中的行号（升序）
+
+    lon_limits : (西, 东)；西 > 东 时表示跨越日界线（如 (170, -170)），超出 [-180, 180] 的经度按 360° 换算
+    lat_limits : (南, 北)，南 > 北 时报错
+    date_range : (start, end)，datetime.date，闭区间，任一端可为 None；只保留在该范围内有观测的水体
+    """
+    lat0, lat1 = float(lat_limits[0]), float(lat_limits[1])
+    if not (np.isfinite([lat0, lat1, *lon_limits]).all() and lat0 <= lat1):
+        raise ValueError(f"invalid bbox: lon {tuple(lon_limits)}, lat {tuple(lat_limits)}")
+    lakes = index['lakes']
+    if len(lakes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    cs, nx, ny = index['cell_size'], index['nx'], index['ny']
+    lon_ranges = _lon_ranges(float(lon_limits[0]), float(lon_limits[1]))
+    _, iy0 = _cell_xy(0.0, lat0, cs, nx, ny)
+    _, iy1 = _cell_xy(0.0, lat1, cs, nx, ny)
+
+    offsets = index['offsets']
+    parts = []
+    for w, e in lon_ranges:
+        ix0, _ = _cell_xy(w, 0.0, cs, nx, ny)
+        ix1, _ = _cell_xy(e, 0.0, cs, nx, ny)
+        parts += [np.arange(offsets[cy * nx + ix0], offsets[cy * nx + ix1 + 1]) for cy in range(iy0, iy1 + 1)]
+    cand = np.unique(np.concatenate(parts)).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+    lon = lakes.column('lon')[cand]
+    lat = lakes.column('lat')[cand]
+    inside = np.zeros(len(cand), dtype=bool)
+    for w, e in lon_ranges:
+        inside |= (lon >= w) & (lon <= e)
+    cand = cand[inside & (lat >= lat0) & (lat <= lat1)]
+    return _filter_dates(index, cand, date_range)
+
+
+def query_point(index, lon, lat, k=1, max_distance=0.1, date_range=None):
+    """查询距 (lon, lat) 最近的 k 个水体（经纬度距离不超过 max_distance 度），返回按距离排序的行号"""
+    rows = query_bbox(index, (lon - max_distance, lon + max_distance), (lat - max_distance, lat + max_distance),
+                      date_range)
+    lakes = index['lakes']
+    dlon = (lakes.column('lon')[rows] - lon + 180.0) % 360.0 - 180.0
+    d = np.hypot(dlon, lakes.column('lat')[rows] - lat)
+    keep = d <= max_distance
+    rows, d = rows[keep], d[keep]
+    return rows[np.argsort(d, kind='stable')[:k]]
+
+
+def lake_records(index, rows):
+    """索引行 -> 水体汇总 dict 列表（含瓦片 tile、首末观测日期），不读取结果文件"""
+    lakes = index['lakes']
+    out = []
+    for i in np.asarray(rows, dtype=np.int64):
+        dates = lakes.values('dates', i)
+        record = {name: lakes.column(name)[i].item() for name in LAKE_FIELDS if name in lakes.columns}
+        record['tile'] = index['files'][lakes.column('file')[i]]['tag']
+        record['first_date'] = _to_date(dates[0]).isoformat() if len(dates) else None
+        record['last_date'] = _to_date(dates[-1]).isoformat() if len(dates) else None
+        out.append(record)
+    return out
+
+
+def iter_series(index, rows, date_range=None):
+    """
+    按瓦片懒加载水体的时间序列，生成 dict: tile, mask_id, lon, lat, 以及 heights / stds / doys / months / years
+    （date_range 给定时只保留该范围内的观测）。每个结果文件只打开一次，HDF5 结果只读取选中水体的行组
+    """
+    lakes = index['lakes']
+    rows = np.asarray(rows, dtype=np.int64)
+    file_ids = lakes.column('file')[rows]
+    for k in np.unique(file_ids):
+        f = index['files'][k]
+        mask_ids = lakes.column('mask_id')[rows[file_ids == k]]
+        columns = ('mask_id', 'lon', 'lat') + fc_organize_IS2_data_nov20.OBS_FIELDS
+        if f['path'].endswith('.h5'):
+            table = fc_result_store_nov20.read_table(f['path'], 'lakes', columns, mask_ids)
+        else:
+            table = _as_table(fc_result_store_nov20.load_results(f['path'])['complete_output'])
+            table = table.take(np.isin(table.column('mask_id'), mask_ids))
+        for record in table:
+            series = {'tile': f['tag'], 'mask_id': record['mask_id'], 'lon': record['lon'], 'lat': record['lat']}
+            keep = _in_range(_days(record['years'], record['doys']), date_range)
+            for name in fc_organize_IS2_data_nov20.OBS_FIELDS:
+                series[name] = np.asarray(record[name])[keep]
+            yield series
+
+
+def serve_lake_index(index, host='127.0.0.1', port=8765):
+    """
+    本地 HTTP 查询服务（JSON），阻塞运行:
+        /lakes?bbox=lon0,lat0,lon1,lat1[&start=2020-01-01][&end=2023-12-31]
+        /nearest?lon=..&lat=..[&k=1][&max_distance=0.1][&start=..][&end=..]
+        /series?bbox=...|lon=..&lat=..[&start=..][&end=..]  （时间序列，按上述条件选取水体）
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            q = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                date_range = (_parse_date(q.get('start')), _parse_date(q.get('end')))
+                if 'bbox' in q:
+                    lon0, lat0, lon1, lat1 = map(float, q['bbox'].split(','))
+                    rows = query_bbox(index, (lon0, lon1), (lat0, lat1), date_range)
+                else:
+                    rows = query_point(index, float(q['lon']), float(q['lat']), int(q.get('k', 1)),
+                                       float(q.get('max_distance', 0.1)), date_range)
+                if url.path in ('/lakes', '/nearest'):
+                    body = lake_records(index, rows)
+                elif url.path == '/series':
+                    body = [{key: (v.tolist() if isinstance(v, np.ndarray) else _json_value(v)) for key, v in s.items()}
+                            for s in iter_series(index, rows, date_range)]
+                else:
+                    self.send_error(404)
+                    return
+                status, data = 200, json.dumps(body).encode()
+            except (KeyError, ValueError) as e:
+                status, data = 400, json.dumps({'error': str(e)}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving lake queries on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def _result_files(results_output):
+    """结果文件及其大小、修改时间；同一瓦片有 .h5 时忽略 .pkl"""
+    paths = {}
+    for path in sorted(glob.glob(os.path.join(results_output, 'results_*_v1.pkl')) +
+                       glob.glob(os.path.join(results_output, 'results_*_v1.h5'))):
+        tag = os.path.basename(path)[len('results_'):].rsplit('_v1.', 1)[0]
+        if tag not in paths or path.endswith('.h5'):
+            paths[tag] = path
+    files = []
+    for tag in sorted(paths):
+        st = os.stat(paths[tag])
+        files.append({'tag': tag, 'path': paths[tag], 'size': st.st_size, 'mtime': st.st_mtime})
+    return files
+
+
+def _read_lakes(path):
+    """读取一个结果文件的水体汇总和升序观测日期"""
+    if path.endswith('.h5'):
+        table = fc_result_store_nov20.read_table(path, 'lakes', LAKE_FIELDS + ('years', 'doys'))
+    else:
+        table = _as_table(fc_result_store_nov20.load_results(path)['complete_output'])
+    if len(table) == 0:
+        return table
+
+    days = _days(table.ragged['years'], table.ragged['doys'])
+    row = np.repeat(np.arange(len(table)), table.lengths())
+    days = days[np.lexsort((days, row))]
+    return fc_ragged_table_nov20.RaggedTable(
+        {name: table.column(name) for name in LAKE_FIELDS if name in table.columns}, {'dates': days}, table.offsets
+    )
+
+
+def _as_table(complete_output):
+    if isinstance(complete_output, fc_ragged_table_nov20.RaggedTable):
+        return complete_output
+    return fc_ragged_table_nov20.RaggedTable.from_records(complete_output, fc_organize_IS2_data_nov20.OBS_FIELDS)
+
+
+def _filter_dates(index, rows, date_range):
+    """只保留在 date_range 内有观测的行（对每行的升序日期二分查找）"""
+    if date_range is None or (date_range[0] is None and date_range[1] is None):
+        return rows
+    start = _day(date_range[0]) if date_range[0] is not None else 0
+    end = _day(date_range[1]) if date_range[1] is not None else DATE_KEY - 1
+    lo = np.searchsorted(index['date_key'], rows * DATE_KEY + start, side='left')
+    hi = np.searchsorted(index['date_key'], rows * DATE_KEY + end, side='right')
+    return rows[hi > lo]
+
+
+def _in_range(days, date_range):
+    keep = np.ones(len(days), dtype=bool)
+    if date_range is not None:
+        if date_range[0] is not None:
+            keep &= days >= _day(date_range[0])
+        if date_range[1] is not None:
+            keep &= days <= _day(date_range[1])
+    return keep
+
+
+def _days(years, doys):
+    """年 + 年积日 -> 1970-01-01 起的天数"""
+    years = np.asarray(years, dtype=np.int64)
+    jan1 = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    return jan1 + np.asarray(doys, dtype=np.int64) - 1
+
+
+def _day(d):
+    return int(np.datetime64(d, 'D').astype(np.int64))
+
+
+def _to_date(day):
+    return date.fromordinal(date(1970, 1, 1).toordinal() + int(day))
+
+
+def _parse_date(text):
+    return date.fromisoformat(text) if text else None
+
+
+def _json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _lon_ranges(lon0, lon1):
+    """经度范围 -> [-180, 180] 内不跨越日界线的 [(西, 东), ...]"""
+    width = lon1 - lon0 if lon0 <= lon1 else lon1 - lon0 + 360.0
+    if width >= 360.0:
+        return [(-180.0, 180.0)]
+    west = (lon0 + 180.0) % 360.0 - 180.0
+    east = west + width
+    if east <= 180.0:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east - 360.0)]
+
+
+def _cell_xy(lon, lat, cell_size, nx, ny):
+    ix = np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / cell_size).astype(np.int64)
+    iy = np.floor((np.asarray(lat, dtype=np.float64) + 90.0) / cell_size).astype(np.int64)
+    return np.clip(ix, 0, nx - 1), np.clip(iy, 0, ny - 1)
@@ -0,0 +1,305 @@
+"""
+跨瓦片水体合并: 各 GSWO 瓦片独立标记，跨 10° 瓦片边界的水体会被拆成多个 mask_id
+
+1. 逐瓦片执行 STEP 1-3 时（stitch 模式）保存 water_data 和边界水体的 MERIT 像元值（save_tile_water_data）；
+2. stitch_tiles 只读取相邻 labeled mask 的边界行/列（窗口读取），用并查集建立全局水体编号表；
+3. organize_stitched_tile 按全局编号执行 STEP 4: 跨瓦片水体的 ICESat-2 数据、面积、MERIT 像元合并后统计，
+   结果写入编号最小的成员所在瓦片的 results 文件。
+
+全局编号 = 瓦片偏移量 + 瓦片内 label；合并后的水体使用其成员中最小的全局编号。
+"""
+
+import os
+import glob
+import pickle
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from module import (
+    fc_blockwise_label_nov20,
+    fc_get_merit_heights_nov20,
+    fc_organize_IS2_data_nov20,
+    fc_ragged_table_nov20,
+    fc_result_store_nov20,
+    fc_metrics_nov20
+)
+
+
+def edge_labels(mask_l):
+    """落在瓦片边界行/列上的 label"""
+    edges = np.concatenate([mask_l[0], mask_l[-1], mask_l[:, 0], mask_l[:, -1]])
+    labels = np.unique(edges)
+    return labels[labels > 0]
+
+
+def save_tile_water_data(tile, paths, water_data, count):
+    """stitch 模式下代替 STEP 4: 保存瓦片的 water_data 和说明文件，等待 stitch_tiles 后统一整理"""
+    tag = tile['tag']
+    water_data_path = os.path.join(paths['mask_output'], f"water_data_{tag}_v1.pkl")
+    with open(water_data_path, 'wb') as f:
+        pickle.dump({'water_data': water_data, 'count': count, 'edge_pixels': tile['edge_pixels']}, f)
+
+    header = {
+        'tag': tag,
+        'mask_file': tile['mask_file'],
+        'labeled_path': tile['labeled_path'],
+        'stats_path': tile['stats_path'],
+        'merit_path': tile['merit_path'],
+        'water_data_path': water_data_path
+    }
+    with open(os.path.join(paths['mask_output'], f"stitch_tile_{tag}_v1.pkl"), 'wb') as f:
+        pickle.dump(header, f)
+
+
+def load_tile_headers(mask_output):
+    """读取 save_tile_water_data 写出的所有瓦片说明"""
+    headers = []
+    for path in sorted(glob.glob(os.path.join(mask_output, 'stitch_tile_*_v1.pkl'))):
+        with open(path, 'rb') as f:
+            headers.append(pickle.load(f))
+    return headers
+
+
+def stitch_tiles(headers):
+    """
+    比较相邻瓦片的边界像元（8 邻域，含只共享一个角点的瓦片），建立全局水体编号表
+
+    返回 lake_table:
+        'tiles' : {tag: {'header', 'offset', 'max_label', 'transform', 'shape'}}
+        'global_id' : {tag: 数组，瓦片内 label -> 全局编号（0 为背景）}
+        'members' : {全局编号: [(tag, label), ...]}，只包含跨瓦片的水体
+    """
+    headers = sorted(headers, key=lambda h: h['tag'])
+    tiles, edges = {}, {}
+    offset = 0
+    for header in headers:
+        with open(header['stats_path'], 'rb') as f:
+            mask_ids = pickle.load(f)['mask_ids']
+        max_label = int(mask_ids.max()) if len(mask_ids) else 0
+        edges[header['tag']], transform, shape = read_edge_strips(header['labeled_path'])
+        tiles[header['tag']] = {'header': header, 'offset': offset, 'max_label': max_label,
+                                'transform': transform, 'shape': shape}
+        offset += max_label
+
+    pairs = []
+    tags = list(tiles)
+    for i, a in enumerate(tags):
+        for b in tags[i + 1:]:
+            for first, second in ((a, b), (b, a)):
+                for x, y in _edge_pairs(tiles[first], edges[first], tiles[second], edges[second]):
+                    pairs.append((tiles[first]['offset'] + x, tiles[second]['offset'] + y))
+
+    pairs = np.unique(np.array(pairs, dtype=np.int64).reshape(-1, 2), axis=0)
+    parent = fc_blockwise_label_nov20.union_find(pairs, offset)
+
+    global_id = {}
+    members = {}
+    for tag, tile in tiles.items():
+        lut = np.zeros(tile['max_label'] + 1, dtype=np.int64)
+        lut[1:] = parent[tile['offset'] + 1:tile['offset'] + tile['max_label'] + 1]
+        global_id[tag] = lut
+    merged = np.unique(parent[np.unique(pairs)]) if len(pairs) else np.zeros(0, dtype=np.int64)
+    merged = set(merged.tolist())
+    for tag, lut in global_id.items():
+        for local in np.nonzero(np.isin(lut, list(merged)))[0]:
+            members.setdefault(int(lut[local]), []).append((tag, int(local)))
+
+    print(f"{len(members)} lakes cross tile boundaries")
+    return {'tiles': tiles, 'global_id': global_id, 'members': members}
+
+
+def save_lake_table(lake_table, path):
+    with open(path, 'wb') as f:
+        pickle.dump(lake_table, f)
+
+
+def load_lake_table(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def read_edge_strips(labeled_path):
+    """只读取 labeled mask 的首末行和首末列"""
+    with rasterio.open(labeled_path) as src:
+        rows, cols = src.height, src.width
+        strips = {
+            'top': src.read(1, window=Window(0, 0, cols, 1))[0],
+            'bottom': src.read(1, window=Window(0, rows - 1, cols, 1))[0],
+            'left': src.read(1, window=Window(0, 0, 1, rows))[:, 0],
+            'right': src.read(1, window=Window(cols - 1, 0, 1, rows))[:, 0],
+        }
+        return strips, src.transform, (rows, cols)
+
+
+def organize_stitched_tile(header, lake_table, paths, result_format='hdf5'):
+    """
+    STEP 4（stitch 模式）: 按全局编号整理一个瓦片的 ICESat-2 数据并保存结果
+
+    跨瓦片的水体只由编号最小的成员所在瓦片整理: 合并所有成员的 water_data，
+    面积求和，goodd_res 取最大值，extent 由合并后的外包框计算，MERIT 高程由所有成员的像元重新统计
+    """
+    tag = header['tag']
+    lut = lake_table['global_id'][tag]
+    members = lake_table['members']
+    cache = {}
+
+    lakes = _tile_lakes(header, cache)
+    own = _load_water_data(header, cache)['water_data']
+    local_ids = own.column('mask_id') if len(own) else np.zeros(0, dtype=np.int64)
+    gids = lut[local_ids].astype(np.int64)
+    keep = ~np.isin(gids, list(members))
+    water_data = [own.take(keep).assign(mask_id=gids[keep], tile=tag, tile_mask_id=local_ids[keep])]
+
+    lake_area, extent, goodd_res, merit_heights = {}, {}, {}, {}
+    for local, lake in lakes.items():
+        gid = int(lut[local])
+        if gid not in members:
+            lake_area[gid], extent[gid], goodd_res[gid], merit_heights[gid] = (
+                lake['area'], lake['extent'], lake['goodd_res'], lake['merit'])
+
+    # 本瓦片负责的跨瓦片水体: 成员中最小的全局编号在本瓦片
+    for gid, member_list in members.items():
+        if member_list[0][0] != tag:
+            continue
+        parts = []
+        for member_tag, local in member_list:
+            member_header = lake_table['tiles'][member_tag]['header']
+            part = _tile_lakes(member_header, cache)[local]
+            parts.append((member_tag, local, part))
+            member_wd = _load_water_data(member_header, cache)['water_data']
+            if len(member_wd):
+                member_wd = member_wd.take(member_wd.column('mask_id') == local)
+                water_data.append(member_wd.assign(mask_id=gid, tile=member_tag, tile_mask_id=local))
+
+        lake_area[gid] = sum(part['area'] for _, _, part in parts)
+        goodd_res[gid] = max(part['goodd_res'] for _, _, part in parts)
+        extent[gid] = _merged_extent([part for _, _, part in parts])
+        px = np.concatenate([_load_water_data(lake_table['tiles'][t]['header'], cache)['edge_pixels'][local]
+                             for t, local, _ in parts])
+        merit_heights[gid] = fc_get_merit_heights_nov20.merit_stats(px)
+
+    print(f"Organizing IS2 for {tag} (stitched)...")
+    water_data = fc_ragged_table_nov20.RaggedTable.concatenate(water_data)
+    if len(water_data) > 1:
+        # 按全局编号排成行，与其他模式相同通过 mask_ids 映射
+        gids = sorted(lake_area)
+        with fc_metrics_nov20.stage('organize', tag):
+            complete_output = fc_organize_IS2_data_nov20.organize_IS2_data(
+                water_data, [merit_heights[g] for g in gids], [extent[g] for g in gids],
+                [goodd_res[g] for g in gids], [lake_area[g] for g in gids], np.array(gids, dtype=np.int64)
+            )
+            fc_metrics_nov20.count('lakes_out', len(complete_output))
+        if complete_output:
+            # 跨瓦片水体的成员 [(瓦片, 瓦片内 label), ...]，其他水体为 None
+            complete_output = complete_output.assign(
+                members=[members.get(int(mask_id)) for mask_id in complete_output.column('mask_id')]
+            )
+            fc_result_store_nov20.save_results(paths['results_output'], tag, complete_output, water_data, result_format)
+
+
+def _tile_lakes(header, cache):
+    """瓦片内每个水体的统计，按瓦片内 label 索引"""
+    key = ('lakes', header['tag'])
+    if key not in cache:
+        with open(header['stats_path'], 'rb') as f:
+            stats = pickle.load(f)
+        with open(header['merit_path'], 'rb') as f:
+            merit = pickle.load(f)
+        with rasterio.open(header['labeled_path']) as src:
+            transform = src.transform
+        lakes = {}
+        for i, local in enumerate(stats['mask_ids']):
+            lakes[int(local)] = {
+                'area': stats['lake_area'][i],
+                'extent': stats['extent'][i],
+                'goodd_res': stats['goodd_res'][i],
+                'merit': merit[i],
+                'bounds': _bbox_bounds(stats['bbox'][i], transform)
+            }
+        cache[key] = lakes
+    return cache[key]
+
+
+def _load_water_data(header, cache):
+    key = ('water_data', header['tag'])
+    if key not in cache:
+        with open(header['water_data_path'], 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data['water_data'], fc_ragged_table_nov20.RaggedTable):
+            data['water_data'] = fc_ragged_table_nov20.RaggedTable.from_records(
+                data['water_data'], fc_organize_IS2_data_nov20.RAW_FIELDS)
+        cache[key] = data
+    return cache[key]
+
+
+def _bbox_bounds(bbox, transform):
+    """瓦片内外包框 (min_row, min_col, max_row, max_col) -> 经纬度范围和像元大小"""
+    min_row, min_col, max_row, max_col = bbox
+    west, north = transform * (min_col, min_row)
+    east, south = transform * (max_col, max_row)
+    return min(west, east), min(south, north), max(west, east), max(south, north), abs(transform.a), abs(transform.e)
+
+
+def _merged_extent(parts):
+    """extent = 像元数 / 外包框像元数；合并后的外包框为各成员外包框的并"""
+    n_pixels = 0
+    for part in parts:
+        west, south, east, north, dx, dy = part['bounds']
+        n_pixels += part['extent'] * round((east - west) / dx) * round((north - south) / dy)
+    west = min(p['bounds'][0] for p in parts)
+    south = min(p['bounds'][1] for p in parts)
+    east = max(p['bounds'][2] for p in parts)
+    north = max(p['bounds'][3] for p in parts)
+    dx, dy = parts[0]['bounds'][4], parts[0]['bounds'][5]
+    return n_pixels / (round((east - west) / dx) * round((north - south) / dy))
+
+
+def _edge_pairs(a, edges_a, b, edges_b):
+    """
+    瓦片 b 在瓦片 a 的右侧、下方、右下角或左下角相邻时，返回边界两侧 8 邻域相连的 (a 的 label, b 的 label)
+    """
+    ta, tb = a['transform'], b['transform']
+    rows_a, cols_a = a['shape']
+    rows_b, cols_b = b['shape']
+    west_a, north_a = ta.c, ta.f
+    east_a, south_a = ta.c + cols_a * ta.a, ta.f + rows_a * ta.e
+    west_b, north_b = tb.c, tb.f
+    east_b, south_b = tb.c + cols_b * tb.a, tb.f + rows_b * tb.e
+    tol_x, tol_y = abs(ta.a) / 2, abs(ta.e) / 2
+
+    def same_lon(x, y):
+        return abs((x - y + 180) % 360 - 180) < tol_x
+
+    pairs = []
+    # b 在 a 的右侧: a 的最后一列与 b 的第一列
+    if same_lon(east_a, west_b) and south_b < north_a and south_a < north_b:
+        lat = north_a + (np.arange(rows_a) + 0.5) * ta.e
+        j = np.floor((lat - north_b) / tb.e).astype(np.int64)
+        pairs += _strip_pairs(edges_a['right'], edges_b['left'], j)
+    # b 在 a 的下方: a 的最后一行与 b 的第一行
+    if abs(south_a - north_b) < tol_y and west_b < east_a and west_a < east_b:
+        lon = west_a + (np.arange(cols_a) + 0.5) * ta.a
+        j = np.floor((lon - west_b) / tb.a).astype(np.int64)
+        pairs += _strip_pairs(edges_a['bottom'], edges_b['top'], j)
+    # 只共享一个角点: a 的右下角与 b 的左上角、a 的左下角与 b 的右上角
+    if abs(south_a - north_b) < tol_y:
+        corners = []
+        if same_lon(east_a, west_b):
+            corners.append((edges_a['bottom'][-1], edges_b['top'][0]))
+        if same_lon(west_a, east_b):
+            corners.append((edges_a['bottom'][0], edges_b['top'][-1]))
+        pairs += [(int(x), int(y)) for x, y in corners if x > 0 and y > 0]
+    return pairs
+
+
+def _strip_pairs(strip_a, strip_b, j):
+    """strip_a[i] 与 strip_b[j[i] - 1 .. j[i] + 1] 中同为水体的 label 对"""
+    pairs = []
+    for d in (-1, 0, 1):
+        k = j + d
+        valid = (k >= 0) & (k < len(strip_b))
+        x = strip_a[valid]
+        y = strip_b[k[valid]]
+        keep = (x > 0) & (y > 0)
+        pairs += list(zip(x[keep].tolist(), y[keep].tolist()))
+    return pairs
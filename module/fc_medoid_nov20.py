@@ -0,0 +1,108 @@
+import numpy as np
+
+# 精确计算时每批距离数组的元素数上限（float64，约 128 MB）
+MAX_PAIRS = 2 ** 24
+
+
+def medoids(x, y, offsets, method='exact', max_pairs=MAX_PAIRS):
+    """
+    每组点的 medoid（到组内其他点平均距离最小的点），返回组内下标
+
+    x, y : 所有组的点拼接后的坐标
+    offsets : 第 k 组为 [offsets[k], offsets[k + 1])，每组至少一个点
+    method :
+        'exact' : 与 pdist + squareform 后按行取平均、argmin 相同（并列时取第一个），
+            但不生成 n × n 矩阵: 小组按 max_pairs 成批计算，大组按行分块计算，内存上限为 max_pairs 个距离
+        'projection' : 近似，点投影到组的主轴（ICESat-2 沿轨方向）上取中位点，O(n log n)。
+            若各点到主轴的距离不超过 w，所选点的平均距离比精确 medoid 最多大 2w
+            （任意两点距离与投影距离之差不超过两点到主轴距离之和）
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if method == 'exact':
+        return _medoids_exact(x, y, offsets, max_pairs)
+    if method == 'projection':
+        return _medoids_projection(x, y, offsets)
+    raise ValueError(f"unknown medoid method: {method}")
+
+
+def _medoids_exact(x, y, offsets, max_pairs):
+    counts = np.diff(offsets)
+    result = np.zeros(len(counts), dtype=np.int64)
+
+    # 连续的小组合并为一批，每批距离数不超过 max_pairs；距离数超过 max_pairs 的组单独按行分块
+    pairs = counts * counts
+    k = 0
+    while k < len(counts):
+        if pairs[k] > max_pairs:
+            result[k] = _medoid_rows(x[offsets[k]:offsets[k + 1]], y[offsets[k]:offsets[k + 1]], max_pairs)
+            k += 1
+            continue
+        end = k + 1
+        total = pairs[k]
+        while end < len(counts) and pairs[end] <= max_pairs and total + pairs[end] <= max_pairs:
+            total += pairs[end]
+            end += 1
+        result[k:end] = _medoid_batch(x, y, offsets[k:end + 1])
+        k = end
+    return result
+
+
+def _medoid_batch(x, y, offsets):
+    """一批组: 展开所有组内点对 (i, j)，按行求平均距离后每组取 argmin"""
+    counts = np.diff(offsets)
+    n_groups = len(counts)
+    pair_counts = counts * counts
+    pair_group = np.repeat(np.arange(n_groups), pair_counts)
+    local = np.arange(pair_counts.sum()) - np.repeat(np.r_[0, np.cumsum(pair_counts)[:-1]], pair_counts)
+    n = counts[pair_group]
+    i = offsets[pair_group] + local // n
+    j = offsets[pair_group] + local % n
+
+    dx = x[i] - x[j]
+    dy = y[i] - y[j]
+    d = np.sqrt(dx * dx + dy * dy)
+
+    # 点对按 (组, i, j) 顺序排列，每行 n 个距离
+    row_starts = np.r_[0, np.cumsum(np.repeat(counts, counts))[:-1]]
+    row_mean = np.add.reduceat(d, row_starts) / np.repeat(counts, counts)
+
+    group_row_starts = np.r_[0, np.cumsum(counts)[:-1]]
+    group_min = np.minimum.reduceat(row_mean, group_row_starts)
+    row_local = np.arange(len(row_mean)) - np.repeat(group_row_starts, counts)
+    candidate = np.where(row_mean == np.repeat(group_min, counts), row_local, np.iinfo(np.int64).max)
+    return np.minimum.reduceat(candidate, group_row_starts)
+
+
+def _medoid_rows(x, y, max_pairs):
+    """单个大组: 每次计算 max_pairs // n 行的距离"""
+    n = len(x)
+    rows = max(1, max_pairs // n)
+    row_mean = np.empty(n)
+    for r0 in range(0, n, rows):
+        r1 = min(r0 + rows, n)
+        dx = x[r0:r1, None] - x[None, :]
+        dy = y[r0:r1, None] - y[None, :]
+        row_mean[r0:r1] = np.sqrt(dx * dx + dy * dy).mean(axis=1)
+    return int(np.argmin(row_mean))
+
+
+def _medoids_projection(x, y, offsets):
+    counts = np.diff(offsets)
+    group = np.repeat(np.arange(len(counts)), counts)
+
+    # 每组的主轴方向（协方差矩阵的主特征向量）
+    cx = np.bincount(group, x, len(counts)) / counts
+    cy = np.bincount(group, y, len(counts)) / counts
+    dx = x - cx[group]
+    dy = y - cy[group]
+    sxx = np.bincount(group, dx * dx, len(counts))
+    syy = np.bincount(group, dy * dy, len(counts))
+    sxy = np.bincount(group, dx * dy, len(counts))
+    theta = 0.5 * np.arctan2(2 * sxy, sxx - syy)
+    t = dx * np.cos(theta)[group] + dy * np.sin(theta)[group]
+
+    # 投影的中位点（偶数个点时取较小的一个）
+    order = np.lexsort((t, group))
+    return order[offsets[:-1] + (counts - 1) // 2] - offsets[:-1]
@@ -0,0 +1,269 @@
+"""
+瓦片处理的分阶段计时和计数
+
+每个瓦片（granule 处理模式下为每批瓦片）一条记录，处理结束后以一行 JSON 追加到
+metrics_dir/metrics_<host>_<pid>.jsonl（每个进程一个文件，多进程、多节点互不影响）:
+    stages   : 各阶段（label、reservoir、coastline、merit、is2_read、organize）的墙钟时间、CPU 时间和峰值 RSS，
+               reservoir / coastline 嵌套在 label 中；
+    counters : 打开的 granule 数、读取的波束数和点数、保留的点数、水体数（标记、筛选后、输出）等；
+    status   : 'ok'，或出错时的异常类型（记录后异常照常抛出）。
+summarize 汇总一次运行的所有记录（按阶段统计总时间、CPU 占比和最大峰值内存，最慢的瓦片）。
+
+峰值 RSS: Linux 上每个阶段开始时清零进程的 VmHWM（/proc/self/clear_refs），得到阶段内的峰值；
+其他系统上为进程启动以来的峰值（peak_rss_scope 为 'process'）。
+指定的瓦片（profile_tiles）另外用 cProfile 和 tracemalloc 分析，输出 profile_<瓦片>.prof 和 profile_<瓦片>_memory.txt。
+未调用 configure 时所有函数不做任何事。
+"""
+
+import os
+import sys
+import time
+import json
+import glob
+import socket
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+# 本进程的配置和当前记录，由 configure 设置
+_METRICS = {'metrics_dir': None, 'profile_tiles': set(), 'memory_frames': 0, 'record': None, 'stack': [],
+            'reset_peak': None}
+
+
+def configure(metrics_dir, profile_tiles=(), memory_frames=10):
+    """
+    metrics_dir : JSON lines 输出目录，None 时不记录
+    profile_tiles : 需要 cProfile / tracemalloc 分析的瓦片（mask 文件名，如 'occurrence_100W_40Nv1_4_2021.tif'）
+    memory_frames : tracemalloc 保留的调用栈深度，0 时只用 cProfile
+    """
+    if metrics_dir is not None:
+        os.makedirs(metrics_dir, exist_ok=True)
+    _METRICS.update({
+        'metrics_dir': metrics_dir,
+        'profile_tiles': set(profile_tiles or ()),
+        'memory_frames': memory_frames,
+        'record': None,
+        'stack': []
+    })
+
+
+def metrics_path(metrics_dir):
+    return os.path.join(metrics_dir, f"metrics_{socket.gethostname()}_{os.getpid()}.jsonl")
+
+
+@contextmanager
+def tile_metrics(name):
+    """记录一个瓦片（或一批瓦片）的处理，结束时写出一行 JSON"""
+    if _METRICS['metrics_dir'] is None or _METRICS['record'] is not None:
+        yield
+        return
+
+    record = {'tile': name, 'host': socket.gethostname(), 'pid': os.getpid(), 'start': time.time(),
+              'stages': [], 'counters': {}, 'status': 'ok'}
+    _METRICS['record'] = record
+    profiler = _start_profile(name)
+    try:
+        with stage('total'):
+            yield
+    except BaseException as e:
+        record['status'] = type(e).__name__
+        raise
+    finally:
+        if profiler is not None:
+            _stop_profile(name, profiler, record)
+        _METRICS['record'] = None
+        _METRICS['stack'] = []
+        with open(metrics_path(_METRICS['metrics_dir']), 'a') as f:
+            f.write(json.dumps(record, default=_json_default) + '\n')
+
+
+@contextmanager
+def stage(name, tile=None):
+    """
+    记录一个阶段的墙钟时间、CPU 时间和峰值 RSS（字节）
+
+    tile : 一条记录包含多个瓦片时（granule 处理模式）标明阶段所属的瓦片
+    """
+    record = _METRICS['record']
+    if record is None:
+        yield
+        return
+
+    entry = {'stage': name}
+    if tile is not None:
+        entry['tile'] = tile
+    stack = _METRICS['stack']
+    stack.append(entry)
+    # 嵌套阶段清零 VmHWM 前先把外层阶段目前的峰值记下
+    for outer in stack[:-1]:
+        outer['_peak'] = max(outer.get('_peak', 0), _peak_rss() or 0)
+    scope = 'stage' if _reset_peak() else 'process'
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        entry['wall'] = time.perf_counter() - wall
+        entry['cpu'] = time.process_time() - cpu
+        peak = max(entry.pop('_peak', 0), _peak_rss() or 0)
+        entry['peak_rss'] = peak or None
+        entry['peak_rss_scope'] = scope
+        stack.pop()
+        for outer in stack:
+            outer['_peak'] = max(outer.get('_peak', 0), peak)
+        record['stages'].append(entry)
+
+
+def add_stage(name, wall, cpu=None, tile=None):
+    """记录在其他线程或进程中计时的阶段（如 prefetch 模式下 I/O 线程预读输入的时间）"""
+    record = _METRICS['record']
+    if record is not None:
+        entry = {'stage': name, 'wall': wall, 'cpu': cpu, 'peak_rss': None, 'peak_rss_scope': None}
+        if tile is not None:
+            entry['tile'] = tile
+        record['stages'].append(entry)
+
+
+def count(name, n=1):
+    """当前记录的计数器加 n"""
+    record = _METRICS['record']
+    if record is not None:
+        record['counters'][name] = record['counters'].get(name, 0) + int(n)
+
+
+def load_records(metrics_dir, since=None):
+    """读取目录中所有 JSON lines 记录；since 为 time.time() 时间，只保留之后开始的记录"""
+    records = []
+    for path in sorted(glob.glob(os.path.join(metrics_dir, 'metrics_*.jsonl'))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # 进程被终止时最后一行可能不完整
+                    continue
+                if since is None or record['start'] >= since:
+                    records.append(record)
+    return records
+
+
+def summarize(metrics_dir, since=None, slowest=10):
+    """
+    汇总一次运行的记录
+
+    返回 dict:
+        tiles    : 记录数和各状态的数量
+        stages   : {阶段: {'n', 'wall', 'cpu', 'cpu_ratio', 'max_wall', 'max_peak_rss'}}，
+                   cpu_ratio 远小于 1 时该阶段主要在等待 I/O
+        counters : 各计数器的总和
+        slowest  : 总时间最长的瓦片 [(瓦片, 秒), ...]
+    """
+    records = load_records(metrics_dir, since)
+    status, stages, counters, totals = {}, {}, {}, []
+    for record in records:
+        status[record['status']] = status.get(record['status'], 0) + 1
+        for entry in record['stages']:
+            s = stages.setdefault(entry['stage'], {'n': 0, 'wall': 0.0, 'cpu': None, 'max_wall': 0.0,
+                                                   'max_peak_rss': None})
+            s['n'] += 1
+            s['wall'] += entry['wall']
+            if entry['cpu'] is not None:
+                s['cpu'] = (s['cpu'] or 0.0) + entry['cpu']
+            s['max_wall'] = max(s['max_wall'], entry['wall'])
+            if entry['peak_rss'] is not None:
+                s['max_peak_rss'] = max(s['max_peak_rss'] or 0, entry['peak_rss'])
+            if entry['stage'] == 'total':
+                totals.append((record['tile'], entry['wall']))
+        for name, n in record['counters'].items():
+            counters[name] = counters.get(name, 0) + n
+    for s in stages.values():
+        s['cpu_ratio'] = s['cpu'] / s['wall'] if s['cpu'] is not None and s['wall'] > 0 else None
+    totals.sort(key=lambda t: -t[1])
+    return {
+        'tiles': {'n': len(records), 'status': status},
+        'stages': stages,
+        'counters': counters,
+        'slowest': totals[:slowest]
+    }
+
+
+def print_summary(summary):
+    tiles = summary['tiles']
+    print(f"Metrics: {tiles['n']} records {tiles['status']}")
+    print(f"{'stage':<16}{'n':>6}{'wall s':>12}{'cpu s':>12}{'cpu/wall':>10}{'max s':>10}{'peak MB':>10}")
+    for name, s in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall']):
+        cpu = f"{s['cpu']:.1f}" if s['cpu'] is not None else '-'
+        ratio = f"{s['cpu_ratio']:.2f}" if s['cpu_ratio'] is not None else '-'
+        peak = f"{s['max_peak_rss'] / 2 ** 20:.0f}" if s['max_peak_rss'] is not None else '-'
+        print(f"{name:<16}{s['n']:>6}{s['wall']:>12.1f}{cpu:>12}{ratio:>10}{s['max_wall']:>10.1f}{peak:>10}")
+    for name, n in sorted(summary['counters'].items()):
+        print(f"{name}: {n}")
+    if summary['slowest']:
+        print("Slowest:", ', '.join(f"{tile} ({wall:.1f}s)" for tile, wall in summary['slowest']))
+
+
+def _start_profile(name):
+    if name not in _METRICS['profile_tiles']:
+        return None
+    if _METRICS['memory_frames'] and not tracemalloc.is_tracing():
+        tracemalloc.start(_METRICS['memory_frames'])
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profile(name, profiler, record):
+    profiler.disable()
+    stem = os.path.join(_METRICS['metrics_dir'], f"profile_{os.path.splitext(name)[0]}")
+    profiler.dump_stats(stem + '.prof')
+    record['profile'] = stem + '.prof'
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        record['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with open(stem + '_memory.txt', 'w') as f:
+            for stat in snapshot.statistics('traceback')[:30]:
+                f.write(f"{stat.size / 2 ** 20:.1f} MB in {stat.count} blocks\n")
+                f.write('\n'.join(stat.traceback.format()) + '\n\n')
+
+
+def _reset_peak():
+    """清零进程的峰值 RSS（Linux 4.0 以上），不支持时返回 False"""
+    if _METRICS['reset_peak'] is False:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _METRICS['reset_peak'] = True
+    except OSError:
+        _METRICS['reset_peak'] = False
+    return _METRICS['reset_peak']
+
+
+def _peak_rss():
+    """进程的峰值 RSS（字节），无法获取时返回 None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+
+def _json_default(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"cannot store {type(value).__name__} in metrics")
@@ -1,51 +1,75 @@
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
 from pyproj import Transformer
+from module import fc_ragged_table_nov20, fc_medoid_nov20, fc_geoid_nov20
+
+# water_data 中每条记录的原始点字段
+RAW_FIELDS = ('raw_x_pts', 'raw_y_pts', 'raw_heights', 'terrain_flag', 'uncertainty')
+# complete_output 中每个水体的逐次观测字段
+OBS_FIELDS = ('heights', 'stds', 'doys', 'months', 'years')
 
-def organize_IS2_data(water_data, merit_heights, extent, goodd_res, lake_area):
-    complete_output = []
 
-    mask_ids = np.array([wd['mask_id'] for wd in water_data])
-    unique_mask_ids = np.unique(mask_ids)
+def organize_IS2_data(water_data, merit_heights, extent, goodd_res, lake_area, mask_ids, medoid_method='exact',
+                      grid_file=None):
+    """
+    按水体整理 ICESat-2 数据
+
+    water_data : fc_ragged_table_nov20.RaggedTable（或旧格式的 list of dict）
+    merit_heights, extent, goodd_res, lake_area : 每个水体一行，行顺序与 mask_ids 相同
+    mask_ids : 每行对应的水体 label（即统计量中的 stats['mask_ids']），water_data 的 mask_id 经此映射到行
+    medoid_method : 每次过境代表点和水体位置的 medoid 计算方式，'exact' 或 'projection'（见 fc_medoid_nov20.medoids）
+    grid_file : EGM96 格网文件，默认为本进程 fc_geoid_nov20.set_geoid_file 设置的文件（不在 init_worker 中调用时需给出）
+    返回: complete_output，RaggedTable，每个水体一条记录，heights / stds / doys / months / years 为变长字段
+    """
+    if not isinstance(water_data, fc_ragged_table_nov20.RaggedTable):
+        water_data = fc_ragged_table_nov20.RaggedTable.from_records(water_data, RAW_FIELDS)
+    if len(water_data) == 0:  # 空表没有标量字段
+        return fc_ragged_table_nov20.RaggedTable.from_records([], OBS_FIELDS)
+    complete_output = []
 
-    for mask_id in unique_mask_ids:
-        indices = np.where(mask_ids == mask_id)[0]
+    wd_mask_ids = water_data.column('mask_id')
+    unique_mask_ids = np.unique(wd_mask_ids)
+    rows = lake_rows(mask_ids, unique_mask_ids)
+    wd_height = water_data.column('height')
+    wd_std = water_data.column('std')
+    good = (wd_std < 0.25) & (water_data.column('num_points') >= 3) & (-15 < wd_height) & (wd_height < 8000)
+
+    # 所有合格过境的代表点（原始点的 medoid）一次计算
+    accepted = np.flatnonzero(good)
+    rep_x = np.zeros(len(water_data))
+    rep_y = np.zeros(len(water_data))
+    if len(accepted) > 0:
+        raw = water_data.take(accepted)
+        rep = fc_medoid_nov20.medoids(raw.ragged['raw_x_pts'], raw.ragged['raw_y_pts'], raw.offsets, medoid_method)
+        rep_index = raw.offsets[:-1] + rep
+        rep_x[accepted] = raw.ragged['raw_x_pts'][rep_index]
+        rep_y[accepted] = raw.ragged['raw_y_pts'][rep_index]
+    lake_x, lake_y, out_rows = [], [], []
+
+    order = np.argsort(wd_mask_ids, kind='stable')
+    bounds = np.searchsorted(wd_mask_ids[order], unique_mask_ids, side='left')
+    bounds = np.r_[bounds, len(order)]
+
+    for m, mask_id in enumerate(unique_mask_ids):
+        indices = order[bounds[m]:bounds[m + 1]]
+        row = rows[m]
         result = {
             'mask_id': mask_id,
-            'area': lake_area[mask_id],
-            'extent': extent[mask_id],
-            'goodd_res': goodd_res[mask_id],
+            'area': lake_area[row],
+            'extent': extent[row],
+            'goodd_res': goodd_res[row],
             'flag': 0
         }
 
-        heights, stds, xpts, ypts, doys, months, years = [], [], [], [], [], [], []
-
-        for idx in indices:
-            wd = water_data[idx]
-            if wd['std'] < 0.25 and wd['num_points'] >= 3 and -15 < wd['height'] < 8000:
-                result['flag'] = 1
-                heights.append(wd['height'])
-                stds.append(wd['std'])
-
-                raw_x, raw_y = np.array(wd['raw_x_pts']), np.array(wd['raw_y_pts'])
-                D = pdist(np.column_stack((raw_x, raw_y)))
-                D_mean = np.mean(squareform(D), axis=1)
-                min_idx = np.argmin(D_mean)
-                xpts.append(raw_x[min_idx])
-                ypts.append(raw_y[min_idx])
-
-                doys.append(wd['doy'])
-                months.append(wd['month'])
-                years.append(wd['year'])
-
-        if result['flag'] == 1:
-            heights = np.array(heights)
-            stds = np.array(stds)
-            xpts = np.array(xpts)
-            ypts = np.array(ypts)
-            doys = np.array(doys)
-            months = np.array(months)
-            years = np.array(years)
+        indices = indices[good[indices]]
+        if len(indices) > 0:
+            result['flag'] = 1
+            heights = wd_height[indices]
+            stds = wd_std[indices]
+            xpts = rep_x[indices]
+            ypts = rep_y[indices]
+            doys = water_data.column('doy')[indices]
+            months = water_data.column('month')[indices]
+            years = water_data.column('year')[indices]
 
             ht_std = np.std(heights)
             IP = (heights <= heights.mean() + 3 * ht_std) & (heights >= heights.mean() - 3 * ht_std)
@@ -55,50 +79,72 @@ def organize_IS2_data(water_data, merit_heights, extent, goodd_res, lake_area):
             result['height_range'] = np.max(heights[IP]) - np.min(heights[IP])
             result['std'] = np.mean(stds[IP])
 
-            xp, yp = xpts[IP], ypts[IP]
-            if len(xp) > 1:
-                D = pdist(np.column_stack((xp, yp)))
-                D_mean = np.mean(squareform(D), axis=1)
-                min_idx = np.argmin(D_mean)
-                result['lon'] = float(xp[min_idx])
-                result['lat'] = float(yp[min_idx])
-            else:
-                result['lon'] = float(xp[0])
-                result['lat'] = float(yp[0])
-
-            result['heights'] = heights[IP].tolist()
-            result['stds'] = stds[IP].tolist()
-            result['doys'] = doys[IP].tolist()
-            result['months'] = months[IP].tolist()
-            result['years'] = years[IP].tolist()
+            # 水体位置: 保留的过境代表点的 medoid，所有水体在循环后一次计算
+            lake_x.append(xpts[IP])
+            lake_y.append(ypts[IP])
+            result['lon'] = result['lat'] = np.nan
+
+            result['heights'] = heights[IP]
+            result['stds'] = stds[IP]
+            result['doys'] = doys[IP]
+            result['months'] = months[IP]
+            result['years'] = years[IP]
             result['num_obs'] = len(heights[IP])
 
             complete_output.append(result)
+            out_rows.append(row)
 
     # 移除空湖泊 (flag == 0)
     complete_output = [co for co in complete_output if co['flag'] == 1]
 
+    if complete_output:
+        lake_offsets = np.r_[0, np.cumsum([len(xp) for xp in lake_x])]
+        lake_x = np.concatenate(lake_x)
+        lake_y = np.concatenate(lake_y)
+        lake_index = lake_offsets[:-1] + fc_medoid_nov20.medoids(lake_x, lake_y, lake_offsets, medoid_method)
+        for co, k in zip(complete_output, lake_index):
+            co['lon'] = float(lake_x[k])
+            co['lat'] = float(lake_y[k])
+
     # 加上 MERIT 高程+geoid 偏移
     if complete_output:
         lats = np.array([co['lat'] for co in complete_output])
         lons = np.array([co['lon'] for co in complete_output])
         lons[lons < 0] += 360  # 将负经度转为0-360
 
-        geoidoffsets = geoidheight_batch(lats, lons)
+        geoidoffsets = geoidheight_batch(lats, lons, grid_file=grid_file)
 
-        for i, co in enumerate(complete_output):
-            merit = merit_heights[co['mask_id']]
+        for i, (co, row) in enumerate(zip(complete_output, out_rows)):
+            merit = merit_heights[row]
             co['merit_height'] = merit['height'] + geoidoffsets[i]
             co['merit_std'] = merit['std']
             co['geoid_offset'] = geoidoffsets[i]
 
-    return complete_output
+    return fc_ragged_table_nov20.RaggedTable.from_records(complete_output, OBS_FIELDS)
+
 
+def lake_rows(mask_ids, labels):
+    """labels 中每个水体 label 在 mask_ids（每行的 label）中的行号，label 不存在时报错"""
+    mask_ids = np.asarray(mask_ids, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int64)
+    sorter = np.argsort(mask_ids, kind='stable')
+    pos = np.minimum(np.searchsorted(mask_ids, labels, sorter=sorter), len(mask_ids) - 1)
+    rows = sorter[pos] if len(mask_ids) else pos
+    missing = mask_ids[rows] != labels if len(mask_ids) else np.ones(len(labels), dtype=bool)
+    if missing.any():
+        raise ValueError(f"mask_id {labels[missing][:5].tolist()} not found in lake statistics")
+    return rows
 
-def geoidheight_batch(lats, lons, model='egm96'):
+
+def geoidheight_batch(lats, lons, model='egm96', grid_file=None):
     """
-    批量计算EGM96大地水准面高度偏移，单位: meters
-    这里为了简化，示意用固定值或近似模型代替。你可以替换成真正的geoid模型。
+    批量计算 EGM96 大地水准面高度偏移，单位: meters（格网双线性插值，见 fc_geoid_nov20.geoid_heights）
+
+    grid_file : EGM96 格网文件，默认为本进程 fc_geoid_nov20.set_geoid_file 设置的文件
     """
-    # 例子：假设全用0（如果你有真实egm96栅格或者pyproj+egm96 geoid，可以在此调用）
-    return np.zeros_like(lats)
+    if model != 'egm96':
+        raise ValueError(f"unsupported geoid model: {model}")
+    grid_file = grid_file if grid_file is not None else fc_geoid_nov20.geoid_file()
+    if grid_file is None:
+        raise ValueError("EGM96 grid file not set, pass grid_file or call fc_geoid_nov20.set_geoid_file first")
+    return fc_geoid_nov20.geoid_heights(lats, lons, fc_geoid_nov20.load_geoid_grid(grid_file))
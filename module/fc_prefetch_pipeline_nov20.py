@@ -0,0 +1,124 @@
+import os
+import queue
+import threading
+import traceback
+import rasterio
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from module import fc_tile_pipeline_nov20
+
+# 预读 MERIT 拼接高程的大小（4 个 6000×6000 float32 块）
+_MERIT_NBYTES = 4 * 6000 * 6000 * 4
+
+
+def run_prefetch_pipeline(mask_files, paths, granule_index, worker_args, date_range=None,
+                          io_threads=2, compute_workers=4, queue_depth=2, memory_limit=16 * 2 ** 30, merit_cache=None):
+    """
+    分阶段流水线: I/O 线程预读瓦片输入，进程池执行计算，二者重叠
+
+    I/O 线程读取 GSWO mask、MERIT 高程块和候选 granule 的波束窗口（fc_tile_pipeline_nov20.load_tile_inputs），
+    放入有界队列；主线程把队列中的瓦片提交到进程池执行 STEP 1-4 的计算和写出
+    （fc_tile_pipeline_nov20.run_loaded_tile）。因此瓦片 N 在标记、整理时，瓦片 N+1 的输入已在读取。
+
+    worker_args : fc_tile_pipeline_nov20.init_worker 的参数（每个计算进程加载一次）
+    io_threads : I/O 线程数
+    compute_workers : 计算进程数（同时最多有这么多瓦片在计算）
+    queue_depth : 已读取、等待计算的瓦片数上限
+    memory_limit : 本进程中预读数据（含等待发送给计算进程的数据）占用的内存上限（字节）；
+        单个瓦片超过上限时仍会读取，但此时不会同时预读其他瓦片
+    merit_cache : I/O 线程共用的 fc_get_merit_heights_nov20.MeritCache（可选）
+
+    返回: {mask_file: None（成功）或错误信息}
+    """
+    budget = _MemoryBudget(memory_limit)
+    todo = queue.Queue()
+    for mask_file in mask_files:
+        todo.put(mask_file)
+    loaded_q = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def io_worker():
+        while not stop.is_set():
+            try:
+                mask_file = todo.get_nowait()
+            except queue.Empty:
+                return
+            # 估计大小时也可能出错（mask 无法读取），出错时同样放入队列，主线程按瓦片数取出结果
+            nbytes = 0
+            try:
+                nbytes = _estimate_nbytes(mask_file)
+                budget.acquire(nbytes)
+                loaded = fc_tile_pipeline_nov20.load_tile_inputs(mask_file, paths, granule_index, date_range,
+                                                                  merit_cache)
+                actual = fc_tile_pipeline_nov20.loaded_nbytes(loaded)
+                budget.adjust(actual - nbytes)
+                nbytes = actual
+                error = None
+            except Exception:
+                loaded = None
+                error = traceback.format_exc()
+            loaded_q.put((mask_file, loaded, nbytes, error))
+
+    threads = [threading.Thread(target=io_worker, daemon=True) for _ in range(io_threads)]
+    for t in threads:
+        t.start()
+
+    results = {}
+    in_flight = threading.Semaphore(compute_workers)
+
+    def on_done(mask_file, nbytes):
+        def callback(future):
+            error = future.exception()
+            results[mask_file] = None if error is None else ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            print(f"Finished {os.path.basename(mask_file)}" + ("" if error is None else " (failed)"))
+            budget.release(nbytes)
+            in_flight.release()
+        return callback
+
+    try:
+        with ProcessPoolExecutor(max_workers=compute_workers, initializer=fc_tile_pipeline_nov20.init_worker,
+                                 initargs=worker_args) as executor:
+            for _ in range(len(mask_files)):
+                mask_file, loaded, nbytes, error = loaded_q.get()
+                if error is not None:
+                    results[mask_file] = error
+                    budget.release(nbytes)
+                    print(f"Failed to read {os.path.basename(mask_file)}")
+                    continue
+                in_flight.acquire()
+                future = executor.submit(fc_tile_pipeline_nov20.run_loaded_tile, loaded)
+                del loaded
+                future.add_done_callback(on_done(mask_file, nbytes))
+    finally:
+        stop.set()
+
+    return results
+
+
+class _MemoryBudget:
+    """按字节计数的内存预算；超出上限时阻塞，直到已有数据被释放"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.cond:
+            while self.used > 0 and self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+
+    def adjust(self, delta):
+        with self.cond:
+            self.used += delta
+            self.cond.notify_all()
+
+    def release(self, nbytes):
+        self.adjust(-nbytes)
+
+
+def _estimate_nbytes(mask_file):
+    """读取前估计瓦片输入的大小: mask 栅格 + MERIT 拼接高程"""
+    with rasterio.open(mask_file) as src:
+        return src.height * src.width * np.dtype(src.dtypes[0]).itemsize + _MERIT_NBYTES
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+class RaggedTable:
+    """
+    列式存储的记录表（代替 list of dict 形式的 water_data / complete_output）
+
+    - 每条记录的标量按字段存放在一个数组中（columns）；
+    - 每条记录的变长数组（如 ICESat-2 原始点 raw_x_pts、raw_heights）按字段拼接为一个数组（ragged），
+      第 i 条记录的部分为 [offsets[i], offsets[i + 1])。
+
+    table[i] 返回与原来 dict 相同字段的 dict（变长字段为共享数组的视图），
+    因此 len(table)、for wd in table、wd['height'] 等原有用法不变；批量计算时用 column / values 直接取数组
+    """
+
+    def __init__(self, columns, ragged=None, offsets=None):
+        self.columns = dict(columns)
+        self.ragged = dict(ragged or {})
+        n = len(next(iter(self.columns.values()))) if self.columns else 0
+        self.offsets = np.zeros(n + 1, dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+        self.fields = list(self.columns) + list(self.ragged)
+
+    @classmethod
+    def from_records(cls, records, ragged_fields=()):
+        """由 list of dict 生成；ragged_fields 为变长数组字段"""
+        records = list(records)
+        if not records:
+            return cls({}, {name: np.zeros(0) for name in ragged_fields})
+        ragged_fields = [name for name in records[0] if name in ragged_fields]
+        columns = {name: _column([r[name] for r in records]) for name in records[0] if name not in ragged_fields}
+        ragged, offsets = {}, None
+        for name in ragged_fields:
+            parts = [np.asarray(r[name]) for r in records]
+            ragged[name] = np.concatenate(parts)
+            if offsets is None:
+                offsets = np.r_[0, np.cumsum([len(p) for p in parts])]
+        table = cls(columns, ragged, offsets)
+        table.fields = list(records[0])
+        return table
+
+    @classmethod
+    def concatenate(cls, tables):
+        """按顺序拼接字段相同的表（空表忽略）"""
+        tables = [t for t in tables if len(t) > 0]
+        if not tables:
+            return cls({})
+        if len(tables) == 1:
+            return tables[0]
+        columns = {name: np.concatenate([t.columns[name] for t in tables]) for name in tables[0].columns}
+        ragged = {name: np.concatenate([t.ragged[name] for t in tables]) for name in tables[0].ragged}
+        lengths = np.concatenate([np.diff(t.offsets) for t in tables])
+        table = cls(columns, ragged, np.r_[0, np.cumsum(lengths)])
+        table.fields = list(tables[0].fields)
+        return table
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return {
+            name: (self.ragged[name][start:stop] if name in self.ragged else self.columns[name][i])
+            for name in self.fields
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"RaggedTable({len(self)} records, fields={self.fields})"
+
+    def column(self, name):
+        """标量字段的数组"""
+        return self.columns[name]
+
+    def values(self, name, i):
+        """第 i 条记录的变长字段（视图）"""
+        return self.ragged[name][self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        """每条记录变长字段的长度"""
+        return np.diff(self.offsets)
+
+    def take(self, index):
+        """按下标数组或布尔数组选取记录，返回新表"""
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        starts = self.offsets[index]
+        lengths = self.offsets[index + 1] - starts
+        offsets = np.r_[0, np.cumsum(lengths)]
+        point_index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        table = RaggedTable(
+            {name: values[index] for name, values in self.columns.items()},
+            {name: values[point_index] for name, values in self.ragged.items()},
+            offsets
+        )
+        table.fields = list(self.fields)
+        return table
+
+    def assign(self, **columns):
+        """替换或增加标量字段（标量值广播到所有记录），返回新表；变长数组共享"""
+        table = RaggedTable(self.columns, self.ragged, self.offsets)
+        table.fields = list(self.fields)
+        for name, values in columns.items():
+            if isinstance(values, list):
+                values = _column(values)
+            elif np.ndim(values) == 0:
+                values = np.full(len(self), values)
+            table.columns[name] = np.asarray(values)
+            if name not in table.fields:
+                table.fields.append(name)
+        return table
+
+    def to_records(self):
+        """转换为 list of dict"""
+        return list(self)
+
+
+def _column(values):
+    """标量列表 -> 数组；列表、字典等对象（或 None）按 object 数组存放"""
+    if any(v is None or isinstance(v, (list, tuple, dict)) for v in values):
+        column = np.empty(len(values), dtype=object)
+        for i, v in enumerate(values):
+            column[i] = v
+        return column
+    return np.asarray(values)
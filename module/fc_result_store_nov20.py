@@ -0,0 +1,176 @@
+"""
+按列压缩存放的瓦片结果（代替 results_*.pkl）
+
+每个瓦片一个 HDF5 文件 results_<tag>_v1.h5，写入临时文件后改名，只新增、不修改其他瓦片的文件:
+    lakes          每个水体一行的汇总（complete_output 的标量字段），offsets 指向 observations
+    observations   每次观测一行（heights, stds, doys, months, years）
+    crossings      每次过境一行（water_data 的标量字段），按 mask_id 稳定排序，offsets 指向 points
+    points         ICESat-2 原始点（raw_x_pts, raw_y_pts, raw_heights, terrain_flag, uncertainty）
+
+每一列是一个按 CHUNK_ROWS 行分块、gzip 压缩的数据集（块即行组），读取时只解压用到的列和行组:
+read_table 按列名和 mask_id 选取，iter_results 逐个瓦片读取整个结果目录。
+"""
+
+import os
+import glob
+import json
+import pickle
+import socket
+import numpy as np
+import h5py
+from module import fc_ragged_table_nov20, fc_organize_IS2_data_nov20
+
+# 每个行组的行数
+CHUNK_ROWS = 65536
+COMPRESSION = {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+
+# 表名 -> 变长字段所在的表
+TABLES = {'lakes': 'observations', 'crossings': 'points'}
+
+
+def result_path(results_output, tag, result_format='hdf5'):
+    """瓦片结果文件路径，result_format 为 'hdf5' 或 'pickle'"""
+    ext = {'hdf5': 'h5', 'pickle': 'pkl'}[result_format]
+    return os.path.join(results_output, f"results_{tag}_v1.{ext}")
+
+
+def save_results(results_output, tag, complete_output, water_data, result_format='hdf5'):
+    """保存一个瓦片的 complete_output 和 water_data，返回文件路径"""
+    path = result_path(results_output, tag, result_format)
+    if result_format == 'pickle':
+        with open(path, 'wb') as f:
+            pickle.dump({'complete_output': complete_output, 'water_data': water_data}, f)
+    else:
+        write_results(path, complete_output, water_data, tag)
+    return path
+
+
+def write_results(path, complete_output, water_data, tag=None):
+    """写出 HDF5 结果文件（先写临时文件再改名，读者不会看到写了一半的文件）"""
+    water_data = _as_table(water_data, fc_organize_IS2_data_nov20.RAW_FIELDS)
+    complete_output = _as_table(complete_output, fc_organize_IS2_data_nov20.OBS_FIELDS)
+    if len(water_data):
+        water_data = water_data.take(np.argsort(water_data.column('mask_id'), kind='stable'))
+
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with h5py.File(tmp_path, 'w') as f:
+        if tag is not None:
+            f.attrs['tag'] = tag
+        _write_table(f, 'lakes', complete_output)
+        _write_table(f, 'crossings', water_data)
+    os.replace(tmp_path, path)
+
+
+def read_table(path, name='lakes', columns=None, mask_ids=None, ragged=True):
+    """
+    读取结果文件中的一个表，返回 RaggedTable
+
+    name : 'lakes'（变长字段为 observations）或 'crossings'（变长字段为 points）
+    columns : 只读取这些标量字段和变长字段，None 为全部
+    mask_ids : 只读取这些水体的行，None 为全部；先读取 mask_id 列，再只读取选中行所在的行组
+    ragged : False 时不读取变长字段
+    """
+    with h5py.File(path, 'r') as f:
+        group, values_group = f[name], f[TABLES[name]]
+        offsets = group['offsets'][:]
+        n = len(offsets) - 1
+        if mask_ids is None or n == 0:
+            runs = [(0, n)] if n else []
+        else:
+            selected = np.isin(group['mask_id'][:], np.asarray(mask_ids))
+            runs = _runs(np.flatnonzero(selected))
+
+        names = [c for c in group.attrs['fields'] if columns is None or c in columns]
+        table_columns = {
+            c: _read_runs(group[c], runs) for c in names if c in group
+        }
+        lengths = np.concatenate([np.diff(offsets[a:b + 1]) for a, b in runs]) if runs else np.zeros(0, np.int64)
+        point_runs = [(offsets[a], offsets[b]) for a, b in runs]
+        table_ragged = {
+            c: _read_runs(values_group[c], point_runs) for c in names if c in values_group and ragged
+        }
+
+    table = fc_ragged_table_nov20.RaggedTable(table_columns, table_ragged, np.r_[0, np.cumsum(lengths)])
+    table.fields = [c for c in names if c in table_columns or c in table_ragged]
+    return table
+
+
+def load_results(path):
+    """读取一个瓦片的结果 {'complete_output': ..., 'water_data': ...}，支持 .h5 和旧的 .pkl"""
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    return {'complete_output': read_table(path, 'lakes'), 'water_data': read_table(path, 'crossings')}
+
+
+def iter_results(results_output, name='lakes', columns=None, mask_ids=None, ragged=True):
+    """逐个瓦片读取结果目录中所有 HDF5 结果文件的一个表，生成 (瓦片标识, RaggedTable)"""
+    for path in sorted(glob.glob(os.path.join(results_output, 'results_*_v1.h5'))):
+        with h5py.File(path, 'r') as f:
+            tag = f.attrs.get('tag', os.path.basename(path)[len('results_'):-len('_v1.h5')])
+        yield tag, read_table(path, name, columns, mask_ids, ragged)
+
+
+def _as_table(records, ragged_fields):
+    if isinstance(records, fc_ragged_table_nov20.RaggedTable):
+        return records
+    return fc_ragged_table_nov20.RaggedTable.from_records(records, ragged_fields)
+
+
+def _write_table(f, name, table):
+    group = f.create_group(name)
+    values_group = f.create_group(TABLES[name])
+    group.attrs['fields'] = list(table.fields)
+    _write_column(group, 'offsets', np.asarray(table.offsets, dtype=np.int64))
+    for c, values in table.columns.items():
+        _write_column(group, c, values)
+    for c, values in table.ragged.items():
+        _write_column(values_group, c, values)
+
+
+def _write_column(group, name, values):
+    """写出一列: 字符串存为 UTF-8 字节，对象（列表、None 等）存为 JSON 字符串"""
+    values = np.asarray(values)
+    kind = None
+    if values.dtype.kind == 'U':
+        values, kind = np.char.encode(values, 'utf-8'), 'str'
+    elif values.dtype == object:
+        values = np.array([json.dumps(v, default=_json_default) for v in values], dtype=h5py.string_dtype())
+        kind = 'json'
+    options = dict(COMPRESSION, chunks=(min(CHUNK_ROWS, len(values)),)) if len(values) else {}
+    dataset = group.create_dataset(name, data=values, **options)
+    if kind is not None:
+        dataset.attrs['kind'] = kind
+
+
+def _read_runs(dataset, runs):
+    """读取若干 [start, stop) 行段并拼接（只解压涉及的行组）"""
+    parts = [dataset[a:b] for a, b in runs]
+    values = np.concatenate(parts) if parts else dataset[0:0]
+    kind = dataset.attrs.get('kind')
+    if kind == 'str':
+        return np.char.decode(values, 'utf-8')
+    if kind == 'json':
+        column = np.empty(len(values), dtype=object)
+        for i, v in enumerate(values):
+            column[i] = json.loads(v)
+        return column
+    return values
+
+
+def _runs(index):
+    """升序下标 -> 连续段 [(start, stop), ...]"""
+    if len(index) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    starts = index[np.r_[0, breaks]]
+    stops = index[np.r_[breaks - 1, len(index) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"cannot store {type(value).__name__} in result store")
@@ -0,0 +1,361 @@
+"""
+通过共享目录（如 NFS）协调多个节点上的 worker，不需要消息队列
+
+job_dir/
+    manifest.json          任务清单 [{'name', 'args', 'size'}]，只创建一次
+    leases/<name>.lease    任务租约，O_EXCL 原子创建；worker 定期更新其 mtime 作为心跳，
+                           mtime 超过 lease_ttl 未更新视为 worker 已失效，任务可被其他 worker 接管
+    done/<name>.json       任务完成标记
+    failed/<name>.json     失败记录（累计尝试次数 + traceback）；worker 执行中被杀（内存不足等）时不会写入，
+                           由回收其过期租约的 worker 记为一次失败，因此 max_attempts 对这类任务同样有效
+    clock/<worker>         用于读取共享文件系统的服务器时间，避免节点间时钟偏差
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+
+def create_manifest(job_dir, tasks):
+    """
+    创建任务清单；清单已存在时（其他节点已创建）直接读取已有清单
+
+    tasks : dict，name -> (args, size)，args 需要能被 JSON 序列化
+    返回清单中的任务列表
+    """
+    for sub in ('leases', 'done', 'failed', 'clock'):
+        os.makedirs(os.path.join(job_dir, sub), exist_ok=True)
+
+    manifest_path = os.path.join(job_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        entries = [{'name': name, 'args': list(args), 'size': size} for name, (args, size) in tasks.items()]
+        # 大任务优先
+        entries.sort(key=lambda e: e['size'] or 0, reverse=True)
+        tmp_path = f"{manifest_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'tasks': entries}, f)
+        try:
+            os.link(tmp_path, manifest_path)  # 原子操作，已存在则失败
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    return load_manifest(job_dir)
+
+
+def load_manifest(job_dir):
+    with open(os.path.join(job_dir, 'manifest.json')) as f:
+        return json.load(f)['tasks']
+
+
+def run_worker(job_dir, func, worker_id=None, lease_ttl=600, poll_interval=30, max_attempts=2):
+    """
+    领取并执行清单中的任务，直到所有任务完成或达到失败次数上限
+
+    func(*args) 执行单个任务；任务租约在执行期间每 lease_ttl / 4 秒续期一次，
+    超过 lease_ttl 未续期的租约会被其他 worker 回收（记为一次失败），未达到尝试次数上限时重新执行
+
+    返回本 worker 完成的任务数
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    tasks = load_manifest(job_dir)
+    n_done = 0
+
+    while True:
+        waiting = False
+        retry = False
+        for task in tasks:
+            name = task['name']
+            if _finished(job_dir, name, max_attempts):
+                continue
+            if not _acquire_lease(job_dir, name, worker_id, lease_ttl):
+                waiting = True
+                continue
+
+            # 获得租约后再检查一次，避免重复执行刚被其他 worker 完成的任务
+            if _finished(job_dir, name, max_attempts):
+                _release_lease(job_dir, name, worker_id)
+                continue
+
+            print(f"[{worker_id}] running {name}")
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat, args=(job_dir, name, lease_ttl / 4, stop), daemon=True)
+            heartbeat.start()
+            try:
+                func(*task['args'])
+                _write_json(os.path.join(job_dir, 'done', f"{name}.json"),
+                            {'worker': worker_id, 'finished': time.time()})
+                n_done += 1
+                print(f"[{worker_id}] done {name}")
+            except Exception:
+                attempts = _record_failure(job_dir, name, worker_id, traceback.format_exc())
+                print(f"[{worker_id}] failed {name} (attempt {attempts})")
+                # 未达到尝试次数上限: 下一轮重新执行
+                retry = retry or attempts < max_attempts
+            finally:
+                stop.set()
+                heartbeat.join()
+                _release_lease(job_dir, name, worker_id)
+
+        if retry:
+            continue
+        if not waiting:
+            return n_done
+        # 其他 worker 持有的租约: 等待其完成或过期
+        time.sleep(poll_interval)
+
+
+def run_workers(job_dir, func, n_workers, initializer=None, initargs=(), max_restarts=None, **kwargs):
+    """
+    在本机启动 n_workers 个 worker 进程（每个进程先执行 initializer）
+
+    worker 异常退出（如内存不足被杀）时报告其退出码；清单中仍有未结束的任务时重新启动一个 worker
+    （累计最多 max_restarts 次，默认 n_workers），被杀时持有的任务在租约过期后由其他 worker 回收
+    返回异常退出的 worker [(pid, exitcode), ...]
+    """
+    max_restarts = n_workers if max_restarts is None else max_restarts
+
+    def start():
+        p = multiprocessing.Process(target=_worker_main, args=(job_dir, func, initializer, initargs, kwargs))
+        p.start()
+        return p
+
+    procs = [start() for _ in range(n_workers)]
+    dead = []
+    while procs:
+        multiprocessing.connection.wait([p.sentinel for p in procs])
+        for p in [p for p in procs if not p.is_alive()]:
+            p.join()
+            procs.remove(p)
+            if p.exitcode == 0:
+                continue
+            dead.append((p.pid, p.exitcode))
+            print(f"worker {p.pid} exited with code {p.exitcode}")
+            progress = job_progress(job_dir, kwargs.get('max_attempts', 2))
+            if len(dead) <= max_restarts and (progress['pending'] or progress['leased']):
+                procs.append(start())
+    return dead
+
+
+def run_final_task(job_dir, name, func, worker_id=None, lease_ttl=600, max_attempts=2):
+    """
+    清单中所有任务结束（完成或达到失败次数上限）后执行一次的收尾任务（如跨瓦片水体合并）
+
+    每个节点的 worker 返回后都可调用: 仍有未领取或租约未结束的任务时不执行（由最后结束的节点执行）；
+    多个节点同时调用时用与普通任务相同的租约保证只有一个节点执行，完成后写入 done/<name>.json，不再重复执行。
+    执行失败时释放租约并抛出异常，重新调用时再次执行
+
+    返回是否由本节点执行
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    done_path = os.path.join(job_dir, 'done', f"{name}.json")
+    progress = job_progress(job_dir, max_attempts)
+    if progress['pending'] or progress['leased'] or os.path.exists(done_path):
+        return False
+    if not _acquire_lease(job_dir, name, worker_id, lease_ttl):
+        return False
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job_dir, name, lease_ttl / 4, stop), daemon=True)
+    heartbeat.start()
+    try:
+        if os.path.exists(done_path):
+            return False
+        print(f"[{worker_id}] running {name}")
+        func()
+        _write_json(done_path, {'worker': worker_id, 'finished': time.time()})
+        return True
+    finally:
+        stop.set()
+        heartbeat.join()
+        _release_lease(job_dir, name, worker_id)
+
+
+def job_progress(job_dir, max_attempts=2):
+    """统计任务状态: {'done', 'failed', 'leased', 'pending'}"""
+    counts = {'done': 0, 'failed': 0, 'leased': 0, 'pending': 0}
+    for task in load_manifest(job_dir):
+        name = task['name']
+        if os.path.exists(os.path.join(job_dir, 'done', f"{name}.json")):
+            counts['done'] += 1
+        elif _finished(job_dir, name, max_attempts):
+            counts['failed'] += 1
+        elif os.path.exists(_lease_path(job_dir, name)):
+            counts['leased'] += 1
+        else:
+            counts['pending'] += 1
+    return counts
+
+
+def _worker_main(job_dir, func, initializer, initargs, kwargs):
+    if initializer is not None:
+        initializer(*initargs)
+    run_worker(job_dir, func, **kwargs)
+
+
+def _finished(job_dir, name, max_attempts):
+    if os.path.exists(os.path.join(job_dir, 'done', f"{name}.json")):
+        return True
+    failed = _read_json(os.path.join(job_dir, 'failed', f"{name}.json"), None)
+    return failed is not None and failed.get('attempts', 0) >= max_attempts
+
+
+def _lease_path(job_dir, name):
+    return os.path.join(job_dir, 'leases', f"{name}.lease")
+
+
+def _acquire_lease(job_dir, name, worker_id, lease_ttl):
+    path = _lease_path(job_dir, name)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # 租约过期: 改名为本 worker 独有的文件名后确认改名的正是判断为过期的那个租约，再重新创建。
+        # 判断过期和改名之间其他 worker 可能已回收并新建了租约，此时改名得到的是新租约，放回原处
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        content = _read_text(path)
+        if _server_now(job_dir, worker_id) - st.st_mtime <= lease_ttl:
+            return False
+        stale = f"{path}.{worker_id}.stale"
+        try:
+            os.rename(path, stale)
+        except OSError:
+            return False
+        moved = os.stat(stale)
+        if (moved.st_ino, moved.st_mtime_ns) != (st.st_ino, st.st_mtime_ns) or _read_text(stale) != content:
+            try:
+                os.link(stale, path)  # 原处已有另一个租约时不覆盖
+            except OSError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        print(f"[{worker_id}] reclaiming expired lease {name}")
+        # 持有者未续期即退出（被杀或节点失效），记为一次失败
+        if not os.path.exists(os.path.join(job_dir, 'done', f"{name}.json")):
+            try:
+                holder = json.loads(content).get('worker')
+            except (TypeError, ValueError):
+                holder = None
+            _record_failure(job_dir, name, worker_id, f"lease of worker {holder} expired (worker killed or lost)")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+    # 执行前在租约中记下这是第几次尝试
+    attempt = _read_json(os.path.join(job_dir, 'failed', f"{name}.json"), {}).get('attempts', 0) + 1
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': worker_id, 'acquired': time.time(), 'attempt': attempt}, f)
+    return True
+
+
+def _record_failure(job_dir, name, worker_id, error):
+    """累计一次失败，返回累计的尝试次数"""
+    failed_path = os.path.join(job_dir, 'failed', f"{name}.json")
+    attempts = _read_json(failed_path, {}).get('attempts', 0) + 1
+    _write_json(failed_path, {'worker': worker_id, 'attempts': attempts, 'error': error})
+    return attempts
+
+
+def _release_lease(job_dir, name, worker_id):
+    path = _lease_path(job_dir, name)
+    if _read_json(path, {}).get('worker') == worker_id:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _heartbeat(job_dir, name, interval, stop):
+    path = _lease_path(job_dir, name)
+    while not stop.wait(interval):
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            # 其他 worker 检查过期租约时可能短暂改名后放回，继续续期
+            continue
+
+
+def _server_now(job_dir, worker_id):
+    """在共享目录中更新一个文件并读取其 mtime，作为文件服务器的当前时间"""
+    path = os.path.join(job_dir, 'clock', worker_id)
+    with open(path, 'a'):
+        pass
+    os.utime(path, None)
+    return os.stat(path).st_mtime
+
+
+def _write_json(path, obj):
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def local_test(n_workers=3, lease_ttl=2, max_attempts=2):
+    """
+    在临时目录中启动多个本机 worker 进程检验租约机制（python -m module.fc_shared_manifest_nov20）:
+    正常任务各执行一次；抛出异常的任务重试后完成；执行中进程被杀的任务在租约过期后被回收，
+    每次回收记为一次失败，达到 max_attempts 后不再执行
+    """
+    import shutil
+    import tempfile
+    job_dir = tempfile.mkdtemp(prefix='shared_manifest_test_')
+    tasks = {f"ok_{i}": (('ok', job_dir, f"ok_{i}"), 1) for i in range(4)}
+    tasks['flaky'] = (('flaky', job_dir, 'flaky'), 1)
+    tasks['killed'] = (('killed', job_dir, 'killed'), 2)
+    create_manifest(job_dir, tasks)
+    dead = run_workers(job_dir, _test_task, n_workers, lease_ttl=lease_ttl, poll_interval=lease_ttl / 4,
+                       max_attempts=max_attempts)
+
+    progress = job_progress(job_dir, max_attempts)
+    killed = _read_json(os.path.join(job_dir, 'failed', 'killed.json'), {})
+    runs = {name: len(os.listdir(os.path.join(job_dir, 'runs', name))) for name in tasks}
+    print(progress, runs, dead)
+    assert progress == {'done': 5, 'failed': 1, 'leased': 0, 'pending': 0}, progress
+    assert all(runs[f"ok_{i}"] == 1 for i in range(4)) and runs['flaky'] == 2, runs
+    assert runs['killed'] == max_attempts and killed.get('attempts') == max_attempts, (runs, killed)
+    assert 'expired' in killed.get('error', '') and len(dead) == max_attempts, (killed, dead)
+    shutil.rmtree(job_dir)
+    print("shared manifest local test passed")
+
+
+def _test_task(kind, job_dir, name):
+    runs = os.path.join(job_dir, 'runs', name)
+    os.makedirs(runs, exist_ok=True)
+    n = len(os.listdir(runs))
+    open(os.path.join(runs, f"{n}.{os.getpid()}"), 'w').close()
+    time.sleep(0.2)
+    if kind == 'flaky' and n == 0:
+        raise RuntimeError("first attempt fails")
+    if kind == 'killed':
+        os._exit(9)  # 模拟被杀（内存不足），不写入失败记录
+
+
+if __name__ == "__main__":
+    local_test()
@@ -0,0 +1,166 @@
+"""
+STEP 1（水体标记）和 STEP 2（MERIT 高程）输出的缓存
+
+每个阶段的输出旁保存一个清单 stage_<stage>_<tag>_v1.json，记录:
+    - inputs  : 输入文件的大小、修改时间和 SHA-256（GSWO 瓦片、GDW、GSHHS 及其附属文件、MERIT 高程块）；
+    - code    : 该阶段用到的模块源码的 SHA-256；
+    - params  : 参数（如 75% 阈值、edit、label_options）以及上游阶段的摘要；
+    - outputs : 输出文件的大小和修改时间。
+再次运行时清单一致且输出文件未被改动则直接读取输出，不重新计算。
+输入文件大小和修改时间不变时不重新计算哈希；只有修改时间变了时按哈希判断内容是否改变。
+"""
+
+import os
+import json
+import glob
+import hashlib
+
+# 清单格式版本，格式改变时所有缓存失效
+CACHE_VERSION = 1
+HASH_BLOCK = 2 ** 20
+
+
+class StageCache:
+    """
+    阶段输出缓存（每个进程一个，清单为 JSON 文件，多个进程处理不同瓦片时互不影响）
+
+    shared_inputs : 所有瓦片共用的输入文件（如 GDW、GSHHS 的 .shp，同名的 .dbf / .shx / .prj 等一起记录）
+    force : True 时所有阶段重新计算；也可为阶段名集合，如 {'merit'}
+    hash_files : False 时只按文件大小和修改时间判断输入是否改变
+    """
+
+    def __init__(self, shared_inputs=(), force=False, hash_files=True):
+        self.shared_inputs = [p for path in shared_inputs for p in _with_sidecars(path)]
+        self.force = force
+        self.hash_files = hash_files
+        self._code = {}
+        # 文件哈希按 (路径, 大小, 修改时间) 缓存，共用的 GDW、GSHHS 和 MERIT 高程块每个进程只计算一次
+        self._hashes = {}
+
+    def manifest(self, stage, inputs, params, modules):
+        """生成阶段清单（不含 outputs）；inputs 为文件路径列表，modules 为该阶段用到的模块"""
+        return {
+            'version': CACHE_VERSION,
+            'stage': stage,
+            'code': {m.__name__: self._code_hash(m) for m in modules},
+            'params': json.loads(json.dumps(params, sort_keys=True, default=str)),
+            'inputs': [{'path': os.path.abspath(p)} for p in inputs]
+        }
+
+    def lookup(self, output_dir, tag, manifest):
+        """
+        缓存一致时返回已保存的清单（含 outputs 和 result），否则返回 None
+
+        输入文件大小或修改时间变了但哈希相同时，更新清单中的修改时间
+        """
+        if self.force is True or (self.force and manifest['stage'] in self.force):
+            return None
+        path = manifest_path(output_dir, manifest['stage'], tag)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            saved = json.load(f)
+        if any(saved.get(key) != manifest[key] for key in ('version', 'stage', 'code', 'params')):
+            return None
+        if [i['path'] for i in saved['inputs']] != [i['path'] for i in manifest['inputs']]:
+            return None
+        if not all(_same_stamp(o, _stamp(o['path'])) for o in saved['outputs']):
+            return None
+
+        touched = False
+        for i in saved['inputs']:
+            stamp = _stamp(i['path'])
+            if _same_stamp(i, stamp):
+                continue
+            if not self.hash_files or stamp is None or stamp['size'] != i.get('size') or \
+                    self._file_hash(i['path'], stamp) != i.get('sha256'):
+                return None
+            i.update(stamp)
+            touched = True
+        if touched:
+            _write_json(path, saved)
+        return saved
+
+    def store(self, output_dir, tag, manifest, outputs, result=None):
+        """计算完成、输出写出后保存清单；result 为可 JSON 序列化的附加信息（如瓦片是否有水体）"""
+        manifest = dict(manifest, result=result)
+        manifest['inputs'] = [dict(i, **self._fingerprint(i['path'])) for i in manifest['inputs']]
+        manifest['outputs'] = [dict({'path': os.path.abspath(p)}, **(_stamp(p) or {})) for p in outputs]
+        manifest['digest'] = digest(manifest)
+        _write_json(manifest_path(output_dir, manifest['stage'], tag), manifest)
+        return manifest
+
+    def _fingerprint(self, path):
+        stamp = _stamp(path)
+        if stamp is None:
+            return {'missing': True}
+        if self.hash_files:
+            stamp['sha256'] = self._file_hash(path, stamp)
+        return stamp
+
+    def _file_hash(self, path, stamp):
+        key = (os.path.abspath(path), stamp['size'], stamp['mtime'])
+        if key not in self._hashes:
+            self._hashes[key] = _file_hash(path)
+        return self._hashes[key]
+
+    def _code_hash(self, module):
+        name = module.__name__
+        if name not in self._code:
+            self._code[name] = _file_hash(module.__file__)
+        return self._code[name]
+
+
+def manifest_path(output_dir, stage, tag):
+    return os.path.join(output_dir, f"stage_{stage}_{tag}_v1.json")
+
+
+def digest(manifest):
+    """阶段清单的摘要（代码、参数、输入内容），作为下游阶段的参数，上游输入不变时下游缓存仍然有效"""
+    inputs = [(i['path'], i.get('sha256') or (i.get('size'), i.get('mtime')), i.get('missing', False))
+              for i in manifest['inputs']]
+    key = json.dumps([manifest['stage'], manifest['code'], manifest['params'], inputs, manifest.get('result')],
+                     sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def invalidate(output_dir, stage=None, tag=None):
+    """删除清单（stage / tag 为 None 时匹配全部），下次运行时重新计算"""
+    pattern = manifest_path(output_dir, stage or '*', tag or '*')
+    for path in glob.glob(pattern):
+        os.remove(path)
+
+
+def _with_sidecars(path):
+    """shapefile 等由多个同名文件组成的数据集: 同一目录下主文件名相同的所有文件"""
+    stem = os.path.splitext(path)[0]
+    return sorted(p for p in glob.glob(glob.escape(stem) + '.*') if os.path.splitext(p)[0] == stem) or [path]
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+def _same_stamp(record, stamp):
+    if stamp is None:
+        return record.get('missing', False)
+    return record.get('size') == stamp['size'] and record.get('mtime') == stamp['mtime']
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,490 @@
+import os
+import time
+import pickle
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import geopandas as gpd
+from scipy import ndimage
+from module import (
+    fc_label_mask_and_identify_goodd_nov20,
+    fc_blockwise_label_nov20,
+    inpoly,
+    fc_grouped_stats_nov20,
+    fc_stage_cache_nov20,
+    fc_get_mask_metadata_func_nov20,
+    fc_get_merit_heights_nov20,
+    fc_get_IS2_water_data_nov20,
+    fc_organize_IS2_data_nov20,
+    fc_granule_index_nov20,
+    fc_lake_stitching_nov20,
+    fc_geoid_nov20,
+    fc_result_store_nov20,
+    fc_incremental_update_nov20,
+    fc_metrics_nov20
+)
+
+# 各阶段计算用到的模块（源码哈希记入阶段缓存清单）
+LABEL_MODULES = (fc_label_mask_and_identify_goodd_nov20, fc_blockwise_label_nov20, inpoly)
+MERIT_MODULES = (fc_get_merit_heights_nov20, fc_grouped_stats_nov20)
+
+# 子进程（或串行模式下本进程）共享的输入数据，由 init_worker 加载
+_WORKER = {}
+
+
+def init_worker(paths, gdw_file, coast_file, granule_index_path, edit=0, date_range=None, label_options=None,
+                stitch=False, merit_cache=None, geoid_file=None, result_format='hdf5', stage_cache=None, metrics=None):
+    """
+    加载每个进程只需读取一次的输入: GDW 大坝、海岸线、granule 空间索引（granule_index_path 为 None 时不加载）、
+    EGM96 大地水准面格网（geoid_file，.npy 缓存写在 mask_output 下，只读内存映射，各进程共享）
+
+    label_options : 传给 label_mask_and_identify_goodd 的参数，如 {'block_size': 4096, 'scratch_dir': ..., 'coast_backend': 'inpoly'}
+    stitch : 跨瓦片水体合并模式，STEP 4 推迟到 fc_lake_stitching_nov20 中执行
+    merit_cache : MeritCache 的参数，如 {'max_bytes': 2 * 2 ** 30, 'disk_dir': ...}；本进程处理的所有瓦片共用一个缓存
+    result_format : 结果文件格式，'hdf5'（见 fc_result_store_nov20）或 'pickle'
+    stage_cache : StageCache 的参数，如 {'force': False, 'hash_files': True}，None 时不使用 STEP 1-2 缓存
+    metrics : fc_metrics_nov20.configure 的参数，如 {'metrics_dir': ..., 'profile_tiles': [...]}，None 时不记录分阶段指标
+    """
+    # 读取 GDW dam dataset
+    gdw = gpd.read_file(gdw_file)
+    fc_geoid_nov20.set_geoid_file(geoid_file, cache_dir=paths['mask_output'])
+    if metrics is not None:
+        fc_metrics_nov20.configure(**metrics)
+
+    _WORKER.update({
+        'paths': paths,
+        'glat': gdw['LAT_RIV'].values,
+        'glon': gdw['LONG_RIV'].values,
+        'coast': gpd.read_file(coast_file),  # 读取海岸线
+        'granule_index': (fc_granule_index_nov20.load_granule_index(granule_index_path)
+                          if granule_index_path is not None else None),
+        'edit': edit,
+        'date_range': date_range,
+        'label_options': label_options or {},
+        'stitch': stitch,
+        'merit_cache': (fc_get_merit_heights_nov20.MeritCache(**merit_cache) if merit_cache is not None else None),
+        'result_format': result_format,
+        'stage_cache': (fc_stage_cache_nov20.StageCache([gdw_file, coast_file], **stage_cache)
+                        if stage_cache is not None else None)
+    })
+
+
+def run_tile(mask_file):
+    """用 init_worker 加载的输入逐瓦片执行 STEP 1-4"""
+    w = _WORKER
+    with fc_metrics_nov20.tile_metrics(os.path.basename(mask_file)):
+        process_tile(mask_file, w['paths'], w['granule_index'], w['glon'], w['glat'], w['coast'], w['edit'],
+                     w['date_range'], w['label_options'], w['stitch'], w['merit_cache'], w['result_format'],
+                     w['stage_cache'])
+
+
+def run_loaded_tile(loaded):
+    """用 init_worker 加载的输入和 load_tile_inputs 预读的数据执行 STEP 1-4（只做计算和写出）"""
+    w = _WORKER
+    with fc_metrics_nov20.tile_metrics(os.path.basename(loaded['mask_file'])):
+        # 预读在主进程的 I/O 线程中完成，只记录其墙钟时间和打开的 granule 数
+        fc_metrics_nov20.add_stage('prefetch_read', loaded.get('read_time'))
+        fc_metrics_nov20.count('granules_opened', loaded.get('granules_opened', 0))
+        tile = label_tile(loaded['mask_file'], w['paths'], w['glon'], w['glat'], w['coast'], w['edit'], loaded,
+                          w['label_options'], w['stitch'], stage_cache=w['stage_cache'])
+        if tile is None:
+            return
+        water_data, count = read_tile_IS2(tile, w['paths'], None, loaded=loaded)
+        organize_tile(tile, w['paths'], water_data, count, w['stitch'], w['result_format'])
+
+
+def run_update_tile(mask_file):
+    """用 init_worker 加载的输入增量更新一个瓦片: 只读取新 granule（见 fc_incremental_update_nov20）"""
+    w = _WORKER
+    with fc_metrics_nov20.tile_metrics(os.path.basename(mask_file)):
+        tile = load_labeled_tile(mask_file, w['paths'], w['label_options'])
+        if tile is None:
+            return
+        fc_incremental_update_nov20.update_tile(tile, w['paths'], w['granule_index'], w['date_range'],
+                                                w['result_format'])
+
+
+def run_granule_batch(mask_files):
+    """用 init_worker 加载的输入以 granule 为主循环执行一批瓦片"""
+    w = _WORKER
+    with fc_metrics_nov20.tile_metrics(f"{os.path.basename(mask_files[0])}..{os.path.basename(mask_files[-1])}"):
+        process_tiles_by_granule(mask_files, w['paths'], w['granule_index'], w['glon'], w['glat'], w['coast'],
+                                 w['edit'], w['date_range'], w['label_options'], w['stitch'], w['merit_cache'],
+                                 w['result_format'], w['stage_cache'])
+
+
+def read_mask(mask_file, block_size=None, scratch_dir=None):
+    """
+    读取 GSWO water mask 及其地理参考
+
+    block_size 给定时（分块模式）按块窗口读取到 scratch_dir 下的临时文件（np.memmap，见
+    fc_blockwise_label_nov20.empty_array），不整幅读入内存
+    """
+    with rasterio.open(mask_file) as src:
+        if block_size is None:
+            mask = src.read(1)
+        else:
+            mask = fc_blockwise_label_nov20.empty_array(src.shape, src.dtypes[0], scratch_dir)
+            for rs, cs in fc_blockwise_label_nov20.block_slices(src.shape, block_size):
+                mask[rs, cs] = src.read(1, window=Window.from_slices(rs, cs))
+        R = src.transform
+        profile = src.profile
+        bounds = src.bounds  # 左下右上
+        R1 = {
+            'lon_limits': (bounds.left, bounds.right),
+            'lat_limits': (bounds.bottom, bounds.top),
+            'shape': src.shape  # (rows, cols)
+        }
+    return mask, R, profile, R1
+
+
+def _block_options(label_options):
+    """label_options 中的 (block_size, scratch_dir)"""
+    options = label_options or {}
+    return options.get('block_size'), options.get('scratch_dir')
+
+
+def tile_tag(mask_metadata):
+    """输出文件名中的瓦片标识，如 100W_40N"""
+    return f"{mask_metadata['lonstr']}{mask_metadata['ew']}_{mask_metadata['latstr']}{mask_metadata['ns']}"
+
+
+def load_tile_inputs(mask_file, paths, granule_index, date_range=None, merit_cache=None):
+    """
+    读取一个瓦片的所有输入（只做 I/O）: GSWO mask、MERIT 拼接高程、候选 granule 的波束窗口
+
+    返回的 dict 可作为 label_tile / read_tile_IS2 的 loaded 参数（read_time 为读取用的秒数，granules_opened 为实际打开的 granule 数）
+    """
+    start = time.perf_counter()
+    mask, R, profile, R1 = read_mask(mask_file)
+    mask_metadata = fc_get_mask_metadata_func_nov20.get_mask_metadata_func_nov20(os.path.basename(mask_file))
+    elev = fc_get_merit_heights_nov20.read_merit_mosaic(paths['merit'], mask_metadata, merit_cache)
+    candidates = fc_granule_index_nov20.query_granule_index(granule_index, R1, date_range)
+    opened = []
+    beams = list(fc_get_IS2_water_data_nov20.iter_tile_beams(candidates, R1, R, date_range, atl08_folder=paths['atl08'],
+                                                             opened=opened))
+    return {
+        'mask_file': mask_file,
+        'mask': (mask, R, profile, R1),
+        'mask_metadata': mask_metadata,
+        'elev': elev,
+        'beams': beams,
+        'granules': [meta['filename'] for meta in candidates],
+        'granules_opened': len(opened),
+        'read_time': time.perf_counter() - start
+    }
+
+
+def loaded_nbytes(loaded):
+    """load_tile_inputs 结果占用的内存（字节）"""
+    nbytes = loaded['mask'][0].nbytes + loaded['elev'].nbytes
+    for _, _, beam in loaded['beams']:
+        nbytes += sum(values.nbytes for values in beam.values())
+    return nbytes
+
+
+def label_tile(mask_file, paths, glon, glat, coast, edit=0, loaded=None, label_options=None, stitch=False,
+               merit_cache=None, stage_cache=None):
+    """
+    STEP 1-2: 生成并保存 labeled water mask 和统计量，提取 MERIT 高程
+
+    paths : dict，包含 'mask_output', 'merit' 等路径
+    loaded : load_tile_inputs 预读的输入（可选）
+    label_options : 传给 label_mask_and_identify_goodd 的参数（可选）
+    stitch : 同时保留边界水体的 MERIT 像元值（跨瓦片水体合并时使用）
+    merit_cache : 多个瓦片共用的 MeritCache（可选）
+    stage_cache : fc_stage_cache_nov20.StageCache（可选），输入、参数和代码未变时直接读取已保存的 STEP 1 / STEP 2 输出
+    返回瓦片信息 dict；瓦片中没有水体时返回 None
+    """
+    print("Reading in mask:", os.path.basename(mask_file))
+    if loaded is not None:
+        mask_metadata = loaded['mask_metadata']
+    else:
+        mask_metadata = fc_get_mask_metadata_func_nov20.get_mask_metadata_func_nov20(os.path.basename(mask_file))
+    tag = tile_tag(mask_metadata)
+    labeled_tif_path = os.path.join(paths['mask_output'], os.path.basename(mask_file).replace('.tif', 'labeled.tif'))
+    stats_path = os.path.join(paths['mask_output'], os.path.basename(mask_file).replace('.tif', 'stats.pkl'))
+
+    # STEP 1: CREATE WATER MASK
+    with fc_metrics_nov20.stage('label', tag):
+        label_manifest = None
+        if stage_cache is not None:
+            # 分块参数不改变结果，不计入清单
+            options = {k: v for k, v in (label_options or {}).items() if k not in ('block_size', 'scratch_dir')}
+            label_manifest = stage_cache.manifest(
+                'label', [mask_file] + stage_cache.shared_inputs,
+                {'threshold': fc_label_mask_and_identify_goodd_nov20.OCCURRENCE_THRESHOLD, 'edit': edit,
+                 'label_options': options},
+                LABEL_MODULES
+            )
+            cached = stage_cache.lookup(paths['mask_output'], tag, label_manifest)
+        else:
+            cached = None
+
+        if cached is not None:
+            print("Using cached mask")
+            fc_metrics_nov20.count('label_cache_hits')
+            if loaded is not None:
+                loaded.pop('mask')
+            if not cached['result']['has_lakes']:
+                return None
+            label_manifest = cached
+            mask_l, R, _, R1 = read_mask(labeled_tif_path, *_block_options(label_options))
+            with open(stats_path, 'rb') as f:
+                stats = pickle.load(f)
+        else:
+            if loaded is not None:
+                mask, R, profile, R1 = loaded.pop('mask')
+            else:
+                mask, R, profile, R1 = read_mask(mask_file, *_block_options(label_options))
+
+            mask_l, lake_area, goodd_res, lat, lon, extent = \
+                fc_label_mask_and_identify_goodd_nov20.label_mask_and_identify_goodd(
+                    mask, R, glon, glat, coast, edit, **(label_options or {})
+                )
+            del mask
+
+            if not _has_lakes(lat):
+                if stage_cache is not None:
+                    stage_cache.store(paths['mask_output'], tag, label_manifest, [], {'has_lakes': False})
+                return None
+
+            print("Writing mask...")
+            # 保存 GeoTIFF（label 可能超过原始 mask 的数据类型范围）
+            profile.update(dtype=mask_l.dtype.name, count=1)
+            with rasterio.open(labeled_tif_path, 'w', **profile) as dst:
+                dst.write(mask_l, 1)
+
+            # 每个水体的 label 和外包框 (min_row, min_col, max_row, max_col)，与 lake_area 等顺序相同
+            mask_ids, bbox = lake_objects(mask_l)
+
+            # 保存统计数据
+            stats = {
+                'lake_area': lake_area,
+                'goodd_res': goodd_res,
+                'lat': lat,
+                'lon': lon,
+                'extent': extent,
+                'mask_ids': mask_ids,
+                'bbox': bbox
+            }
+            with open(stats_path, 'wb') as f:
+                pickle.dump(stats, f)
+            if stage_cache is not None:
+                label_manifest = stage_cache.store(paths['mask_output'], tag, label_manifest,
+                                                   [labeled_tif_path, stats_path], {'has_lakes': True})
+    shape = R1['shape']
+
+    print(os.path.basename(mask_file))
+
+    # STEP 2: GET HEIGHT FROM MERIT HYDROGRAPHY DATASET
+    print("Getting merit heights...")
+    elev = loaded.pop('elev') if loaded is not None else None
+    merit_path = os.path.join(paths['mask_output'], f"merit_heights_{tag}_v1.pkl")
+    # stitch 模式下边界水体的 MERIT 像元值另存一个文件，供缓存读取
+    edge_path = os.path.join(paths['mask_output'], f"merit_edge_pixels_{tag}_v1.pkl")
+
+    with fc_metrics_nov20.stage('merit', tag):
+        merit_manifest = cached = None
+        if stage_cache is not None:
+            merit_manifest = stage_cache.manifest(
+                'merit',
+                [f for row in fc_get_merit_heights_nov20.merit_files(paths['merit'], mask_metadata) for f in row],
+                {'label': label_manifest['digest'], 'stitch': stitch,
+                 'nodata': fc_get_merit_heights_nov20.MERIT_NODATA},
+                MERIT_MODULES
+            )
+            cached = stage_cache.lookup(paths['mask_output'], tag, merit_manifest)
+
+        edge_pixels = None
+        if cached is not None:
+            print("Using cached merit heights")
+            fc_metrics_nov20.count('merit_cache_hits')
+            with open(merit_path, 'rb') as f:
+                merit_heights = pickle.load(f)
+            if stitch:
+                with open(edge_path, 'rb') as f:
+                    edge_pixels = pickle.load(f)
+        else:
+            if stitch:
+                merit_heights, edge_pixels = fc_get_merit_heights_nov20.get_merit_heights_nov20(
+                    paths['merit'], mask_metadata, mask_l, shape, elev,
+                    set(fc_lake_stitching_nov20.edge_labels(mask_l).tolist()), merit_cache
+                )
+            else:
+                merit_heights = fc_get_merit_heights_nov20.get_merit_heights_nov20(
+                    paths['merit'], mask_metadata, mask_l, shape, elev, cache=merit_cache
+                )
+            if merit_cache is not None:
+                print("MERIT cache:", merit_cache.stats())
+            with open(merit_path, 'wb') as f:
+                pickle.dump(merit_heights, f)
+            if stage_cache is not None:
+                outputs = [merit_path]
+                if stitch:
+                    with open(edge_path, 'wb') as f:
+                        pickle.dump(edge_pixels, f)
+                    outputs.append(edge_path)
+                stage_cache.store(paths['mask_output'], tag, merit_manifest, outputs)
+    del elev
+
+    return {
+        'mask_file': mask_file,
+        'labeled_path': labeled_tif_path,
+        'mask_metadata': mask_metadata,
+        'tag': tag,
+        'stats_path': stats_path,
+        'merit_path': merit_path,
+        'edge_pixels': edge_pixels,
+        'mask_l': mask_l,
+        'R': R,
+        'R1': R1,
+        'stats': stats,
+        'merit_heights': merit_heights
+    }
+
+
+def lake_objects(mask_l):
+    """labeled mask 中每个水体的 label 和外包框 (min_row, min_col, max_row, max_col)，按 label 排序"""
+    objects = [(i + 1, sl) for i, sl in enumerate(ndimage.find_objects(mask_l)) if sl is not None]
+    mask_ids = np.array([i for i, _ in objects], dtype=np.int64)
+    bbox = np.array([(sl[0].start, sl[1].start, sl[0].stop, sl[1].stop) for _, sl in objects],
+                    dtype=np.int64).reshape(-1, 4)
+    return mask_ids, bbox
+
+
+def load_labeled_tile(mask_file, paths, label_options=None):
+    """
+    读取 STEP 1-2 已保存的输出（labeled mask、统计量、MERIT 高程），返回与 label_tile 相同字段的 dict（增量更新时使用）；
+    瓦片没有水体（未写出 labeled mask）时返回 None
+
+    label_options : 与 label_tile 相同，分块模式下 labeled mask 按块读取到临时文件
+    """
+    labeled_path = os.path.join(paths['mask_output'], os.path.basename(mask_file).replace('.tif', 'labeled.tif'))
+    if not os.path.exists(labeled_path):
+        return None
+    mask_l, R, _, R1 = read_mask(labeled_path, *_block_options(label_options))
+    mask_metadata = fc_get_mask_metadata_func_nov20.get_mask_metadata_func_nov20(os.path.basename(mask_file))
+    stats_path = os.path.join(paths['mask_output'], os.path.basename(mask_file).replace('.tif', 'stats.pkl'))
+    merit_path = os.path.join(paths['mask_output'], f"merit_heights_{tile_tag(mask_metadata)}_v1.pkl")
+    with open(stats_path, 'rb') as f:
+        stats = pickle.load(f)
+    if 'mask_ids' not in stats:  # 较早版本的统计量没有保存每行的 label
+        stats['mask_ids'], stats['bbox'] = lake_objects(mask_l)
+    with open(merit_path, 'rb') as f:
+        merit_heights = pickle.load(f)
+    return {
+        'mask_file': mask_file,
+        'labeled_path': labeled_path,
+        'mask_metadata': mask_metadata,
+        'tag': tile_tag(mask_metadata),
+        'stats_path': stats_path,
+        'merit_path': merit_path,
+        'edge_pixels': None,
+        'mask_l': mask_l,
+        'R': R,
+        'R1': R1,
+        'stats': stats,
+        'merit_heights': merit_heights
+    }
+
+
+def read_tile_IS2(tile, paths, granule_index, date_range=None, loaded=None):
+    """STEP 3: 逐瓦片读取 ICESat-2 数据（loaded 提供预读的波束时不再读取 HDF5）"""
+    print("Reading in IS2...")
+    with fc_metrics_nov20.stage('is2_read', tile['tag']):
+        if loaded is not None:
+            tile['granules'] = loaded.get('granules')
+            return fc_get_IS2_water_data_nov20.get_IS2_water_data_nov20(
+                tile['mask_l'], None, tile['R1'], tile['R'], beams=loaded.pop('beams')
+            )
+        candidates = fc_granule_index_nov20.query_granule_index(granule_index, tile['R1'], date_range)
+        tile['granules'] = [meta['filename'] for meta in candidates]
+        print(f"{len(candidates)} candidate granules")
+        return fc_get_IS2_water_data_nov20.get_IS2_water_data_nov20(
+            tile['mask_l'], candidates, tile['R1'], tile['R'], atl08_folder=paths['atl08']
+        )
+
+
+def organize_tile(tile, paths, water_data, count, stitch=False, result_format='hdf5'):
+    """STEP 4: 按水体整理 ICESat-2 数据并保存结果（stitch 模式下只保存 water_data，合并后再整理）"""
+    if stitch:
+        fc_lake_stitching_nov20.save_tile_water_data(tile, paths, water_data, count)
+        return
+    print("Organizing IS2...")
+    if count > 1:
+        stats = tile['stats']
+        with fc_metrics_nov20.stage('organize', tile['tag']):
+            complete_output = fc_organize_IS2_data_nov20.organize_IS2_data(
+                water_data, tile['merit_heights'], stats['extent'], stats['goodd_res'], stats['lake_area'],
+                stats['mask_ids']
+            )
+            fc_metrics_nov20.count('lakes_out', len(complete_output))
+            if complete_output:
+                fc_result_store_nov20.save_results(
+                    paths['results_output'], tile_tag(tile['mask_metadata']), complete_output, water_data,
+                    result_format
+                )
+    # 记录读取过的 granule，供增量更新（只有一次过境时不保存结果，也不记录，增量更新时重新读取）
+    if tile.get('granules') is not None and count != 1:
+        fc_incremental_update_nov20.save_ingested(paths['mask_output'], tile['tag'], tile['granules'])
+
+
+def process_tile(mask_file, paths, granule_index, glon, glat, coast, edit=0, date_range=None, label_options=None,
+                 stitch=False, merit_cache=None, result_format='hdf5', stage_cache=None):
+    """逐瓦片执行 STEP 1-4"""
+    tile = label_tile(mask_file, paths, glon, glat, coast, edit, label_options=label_options, stitch=stitch,
+                      merit_cache=merit_cache, stage_cache=stage_cache)
+    if tile is None:
+        return
+    water_data, count = read_tile_IS2(tile, paths, granule_index, date_range)
+    organize_tile(tile, paths, water_data, count, stitch, result_format)
+
+
+def process_tiles_by_granule(mask_files, paths, granule_index, glon, glat, coast, edit=0, date_range=None,
+                             label_options=None, stitch=False, merit_cache=None, result_format='hdf5',
+                             stage_cache=None):
+    """
+    以 granule 为主循环执行一批瓦片: 先对每个瓦片执行 STEP 1-2（写出 labeled mask），
+    再让每个 granule 只打开一次，把波束点分配到所有相交的瓦片（STEP 3），最后逐瓦片执行 STEP 4
+    """
+    tiles = {}
+    for mask_file in mask_files:
+        tile = label_tile(mask_file, paths, glon, glat, coast, edit, label_options=label_options, stitch=stitch,
+                          merit_cache=merit_cache, stage_cache=stage_cache)
+        if tile is not None:
+            tile.pop('mask_l')  # STEP 3 从磁盘窗口读取 labeled mask
+            tiles[tile['labeled_path']] = tile
+
+    if not tiles:
+        return
+
+    print(f"Reading in IS2 for {len(tiles)} tiles (granule-major)...")
+    with fc_metrics_nov20.stage('is2_read'):
+        results = fc_get_IS2_water_data_nov20.get_IS2_water_data_by_granule(
+            list(tiles), granule_index, date_range, atl08_folder=paths['atl08']
+        )
+
+    for labeled_path, tile in tiles.items():
+        water_data, count = results[labeled_path]
+        tile['granules'] = [meta['filename'] for meta in
+                            fc_granule_index_nov20.query_granule_index(granule_index, tile['R1'], date_range)]
+        organize_tile(tile, paths, water_data, count, stitch, result_format)
+        print(f"Finished {os.path.basename(tile['mask_file'])}")
+
+
+def granule_major_batches(mask_files, batch_size):
+    """按经度、纬度排序后分批，使同一批瓦片尽量共享 granule"""
+    def key(mask_file):
+        meta = fc_get_mask_metadata_func_nov20.get_mask_metadata_func_nov20(os.path.basename(mask_file))
+        lon = meta.get('lon', 0) * (-1 if meta.get('ew') == 'W' else 1)
+        lat = meta.get('lat', 0) * (-1 if meta.get('ns') == 'S' else 1)
+        return lon, lat
+
+    ordered = sorted(mask_files, key=key)
+    return [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+
+
+def _has_lakes(lat):
+    lat = np.atleast_1d(lat)
+    return len(lat) > 0 and (lat[0] != 0 or len(lat) > 1)
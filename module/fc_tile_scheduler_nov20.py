@@ -0,0 +1,195 @@
+import os
+import time
+import sqlite3
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# 子进程中通知父进程任务已开始执行的队列（_init_child 中设置）
+_STARTED = {'queue': None}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    size INTEGER,
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    started REAL,
+    finished REAL
+);
+"""
+
+
+def run_scheduled(tasks, func, status_path, max_workers=4, initializer=None, initargs=(), retry_failed=True,
+                  max_attempts=2):
+    """
+    用进程池执行相互独立的任务，并在 SQLite 中记录每个任务的状态
+
+    tasks : dict，name -> (args, size)，func(*args) 在子进程中执行
+    status_path : 状态数据库路径；重启时跳过已完成（done）的任务，
+        上次中断时处于 running 的任务重新执行
+    retry_failed : 是否重新执行上次失败（failed）的任务
+    max_attempts : 子进程异常退出时，在途任务最多尝试的次数（累计）。只有确定导致崩溃的任务计一次尝试:
+        崩溃时只有一个任务在执行则计入该任务；多个任务同时在执行时不计，这些任务随后逐个单独重新执行；
+        只是提交到进程池、尚未开始执行的任务不计
+    任务按 size 从大到小提交，避免最后剩下一个大任务拖尾
+
+    返回: {status: 任务数}
+    """
+    con = _connect(status_path)
+    try:
+        todo = _pending_tasks(con, tasks, retry_failed)
+        print(f"{len(tasks) - len(todo)} of {len(tasks)} tasks already done, {len(todo)} to run")
+
+        suspects, idle_breaks = [], 0
+        while todo or suspects:
+            if suspects:
+                # 进程池崩溃时同时在执行的任务: 单独执行，再次崩溃时可确定是该任务导致
+                name = suspects.pop(0)
+                rest, more, started = _run_pool(con, tasks, [name], func, 1, initializer, initargs, max_attempts)
+                todo = rest + more + todo
+            else:
+                todo, suspects, started = _run_pool(con, tasks, todo, func, max_workers, initializer, initargs,
+                                                    max_attempts)
+            # 进程池反复在任何任务开始前崩溃（如 initializer 出错）: 不再重试
+            idle_breaks = 0 if started else idle_breaks + 1
+            if idle_breaks >= 3:
+                raise RuntimeError("process pool broke 3 times before any task started")
+
+        return dict(con.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+    finally:
+        con.close()
+
+
+def task_status(status_path):
+    """读取所有任务状态: {name: (status, error)}"""
+    con = _connect(status_path)
+    try:
+        return {name: (status, error) for name, status, error in con.execute("SELECT name, status, error FROM tasks")}
+    finally:
+        con.close()
+
+
+def _connect(status_path):
+    if os.path.dirname(status_path):
+        os.makedirs(os.path.dirname(status_path), exist_ok=True)
+    con = sqlite3.connect(status_path)
+    con.executescript(_SCHEMA)
+    return con
+
+
+def _pending_tasks(con, tasks, retry_failed):
+    status = dict(con.execute("SELECT name, status FROM tasks").fetchall())
+    with con:
+        for name, (_, size) in tasks.items():
+            if name not in status:
+                con.execute("INSERT INTO tasks (name, status, size) VALUES (?, ?, ?)", (name, PENDING, size))
+                status[name] = PENDING
+
+    rerun = {PENDING, RUNNING} | ({FAILED} if retry_failed else set())
+    todo = [name for name in tasks if status[name] in rerun]
+    # 大任务优先
+    todo.sort(key=lambda name: tasks[name][1] or 0, reverse=True)
+    return todo
+
+
+def _set_status(con, name, status, error=None):
+    now = time.time()
+    with con:
+        if status == RUNNING:
+            con.execute("UPDATE tasks SET status = ?, error = NULL, started = ? WHERE name = ?", (status, now, name))
+        else:
+            con.execute("UPDATE tasks SET status = ?, error = ?, finished = ? WHERE name = ?",
+                        (status, error, now, name))
+
+
+def _run_pool(con, tasks, todo, func, max_workers, initializer, initargs, max_attempts):
+    """
+    执行一轮进程池；若进程池崩溃，返回尚未完成的任务以便重建进程池后继续
+
+    返回 (重新排队的任务, 崩溃时同时在执行、需要单独重新执行的任务, 是否有任务开始执行或完成)
+    """
+    queue = list(todo)
+    running = {}
+    # 子进程开始执行任务时写入任务名（SimpleQueue 直接写管道，子进程随后被杀也不会丢失）
+    started = multiprocessing.SimpleQueue()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_child,
+                             initargs=(started, initializer, initargs)) as executor:
+        try:
+            while queue or running:
+                # 最多保持 2 * max_workers 个在途任务，使 running 状态接近真实情况
+                while queue and len(running) < 2 * max_workers:
+                    name = queue[0]
+                    future = executor.submit(_call, func, tasks[name][0], name)
+                    queue.pop(0)
+                    _set_status(con, name, RUNNING)
+                    running[future] = name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # 先取结果再移出 running: 进程池崩溃时 result() 抛出异常，该任务仍在 running 中，由下面重新排队
+                    ok, error = future.result()
+                    name = running.pop(future)
+                    _add_attempt(con, name)
+                    _set_status(con, name, DONE if ok else FAILED, error)
+                    print(f"{name}: {DONE if ok else FAILED}")
+        except BrokenProcessPool:
+            # 子进程异常退出（如内存不足）: 崩溃前已正常完成的任务照常记录；尚未开始执行的任务不计尝试，
+            # 直接重新排队；已开始执行的只有一个时计一次尝试，未达到上限的重新排队，其余记为失败；
+            # 多个任务同时在执行时无法确定是哪个导致，不计尝试，交给 run_scheduled 逐个单独执行
+            started_names = set()
+            while not started.empty():
+                started_names.add(started.get())
+            retry, in_flight = [], []
+            for future, name in running.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    ok, error = future.result()
+                    _add_attempt(con, name)
+                    _set_status(con, name, DONE if ok else FAILED, error)
+                    print(f"{name}: {DONE if ok else FAILED}")
+                    continue
+                _set_status(con, name, PENDING)
+                if name in started_names:
+                    in_flight.append(name)
+                else:
+                    retry.append(name)
+            if len(in_flight) != 1:
+                return retry + queue, in_flight, bool(started_names)
+            name = in_flight[0]
+            _add_attempt(con, name)
+            attempts = con.execute("SELECT attempts FROM tasks WHERE name = ?", (name,)).fetchone()[0]
+            if attempts < max_attempts:
+                retry.append(name)
+            else:
+                _set_status(con, name, FAILED, 'worker process terminated abruptly')
+                print(f"{name}: {FAILED} (worker process terminated abruptly)")
+            return retry + queue, [], True
+    return [], [], True
+
+
+def _add_attempt(con, name):
+    with con:
+        con.execute("UPDATE tasks SET attempts = attempts + 1 WHERE name = ?", (name,))
+
+
+def _init_child(started, initializer, initargs):
+    _STARTED['queue'] = started
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call(func, args, name=None):
+    if name is not None and _STARTED['queue'] is not None:
+        _STARTED['queue'].put(name)
+    try:
+        func(*args)
+        return True, None
+    except Exception:
+        return False, traceback.format_exc()
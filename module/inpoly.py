@@ -1,5 +1,7 @@
 import numpy as np
-from bisect import bisect_left
+
+# 每批展开的 (点, 边) 对数上限
+MAX_PAIRS = 2 ** 22
 
 
 def inpoly2(vert, node, edge=None, fTOL=None):
@@ -21,140 +23,200 @@ def inpoly2(vert, node, edge=None, fTOL=None):
             STAT : N×1 bool数组，True表示点在多边形内部
             BNDS : N×1 bool数组，True表示点在多边形边界上
     """
-    # 设置默认参数
-    if edge is None:
-        edge = np.vstack([np.arange(len(node)),
-                          np.roll(np.arange(len(node)), -1)]).T
+    return inpoly2_many([vert], [node], [edge], fTOL)[0]
+
+
+def inpoly2_many(verts, nodes, edges=None, fTOL=None, max_pairs=MAX_PAIRS):
+    """
+    一次计算多组 (点集, 多边形) 的位置关系，第 k 组为 verts[k] 与 (nodes[k], edges[k])
+
+    每组的结果与 inpoly2(verts[k], nodes[k], edges[k], fTOL) 相同；所有组的边合并后成批计算，
+    每批展开的 (点, 边) 对数不超过 max_pairs
+
+    返回: [(STAT, BNDS), ...]
+    """
+    if edges is None:
+        edges = [None] * len(nodes)
     if fTOL is None:
         fTOL = np.finfo(float).eps ** 0.85
 
-    # 输入验证
-    if not all(isinstance(arr, np.ndarray) for arr in [vert, node, edge]):
-        raise TypeError("输入必须是numpy数组")
-    if vert.shape[1] != 2 or node.shape[1] != 2 or edge.shape[1] != 2:
-        raise ValueError("输入数组必须是N×2格式")
-    if edge.min() < 0 or edge.max() >= len(node):
-        raise ValueError("边索引超出节点范围")
-
-    # 初始化输出
-    nvrt = len(vert)
-    STAT = np.zeros(nvrt, dtype=bool)
-    BNDS = np.zeros(nvrt, dtype=bool)
-
-    # 使用边界框快速排除明显在外的点
-    nmin, nmax = node.min(0), node.max(0)
-    ddxy = nmax - nmin
-    lbar = np.sum(ddxy) / 2.0
-    veps = fTOL * lbar
-
-    mask = ((vert[:, 0] >= nmin[0] - veps) &
-            (vert[:, 0] <= nmax[0] + veps) &
-            (vert[:, 1] >= nmin[1] - veps) &
-            (vert[:, 1] <= nmax[1] + veps))
-
-    vert_sub = vert[mask]
-    if len(vert_sub) == 0:
-        return STAT, BNDS
-
-    # 如果x范围大于y范围，交换坐标使y成为长轴
-    vmin, vmax = vert_sub.min(0), vert_sub.max(0)
-    ddxy = vmax - vmin
-    if ddxy[0] > ddxy[1]:
-        vert_sub = vert_sub[:, [1, 0]]
-        node = node[:, [1, 0]]
-
-    # 按y值排序点
-    sort_idx = np.argsort(vert_sub[:, 1])
-    vert_sorted = vert_sub[sort_idx]
-
-    # 调用核心算法
-    stat, bnds = inpoly2_core(vert_sorted, node, edge, fTOL, lbar)
-
-    # 恢复原始顺序
-    stat_reordered = np.zeros_like(stat)
-    bnds_reordered = np.zeros_like(bnds)
-    stat_reordered[sort_idx] = stat
-    bnds_reordered[sort_idx] = bnds
-
-    # 将结果放回完整输出数组
-    STAT[mask] = stat_reordered
-    BNDS[mask] = bnds_reordered
-
-    return STAT, BNDS
+    results = []
+    tasks = []
+    for k, (vert, node, edge) in enumerate(zip(verts, nodes, edges)):
+        # 设置默认参数
+        if edge is None:
+            edge = np.vstack([np.arange(len(node)),
+                              np.roll(np.arange(len(node)), -1)]).T
+
+        # 输入验证
+        if not all(isinstance(arr, np.ndarray) for arr in [vert, node, edge]):
+            raise TypeError("输入必须是numpy数组")
+        if vert.shape[1] != 2 or node.shape[1] != 2 or edge.shape[1] != 2:
+            raise ValueError("输入数组必须是N×2格式")
+        if edge.min() < 0 or edge.max() >= len(node):
+            raise ValueError("边索引超出节点范围")
+
+        # 初始化输出
+        nvrt = len(vert)
+        STAT = np.zeros(nvrt, dtype=bool)
+        BNDS = np.zeros(nvrt, dtype=bool)
+        results.append((STAT, BNDS))
+
+        # 使用边界框快速排除明显在外的点
+        nmin, nmax = node.min(0), node.max(0)
+        ddxy = nmax - nmin
+        lbar = np.sum(ddxy) / 2.0
+        veps = fTOL * lbar
+
+        mask = ((vert[:, 0] >= nmin[0] - veps) &
+                (vert[:, 0] <= nmax[0] + veps) &
+                (vert[:, 1] >= nmin[1] - veps) &
+                (vert[:, 1] <= nmax[1] + veps))
+
+        vert_sub = vert[mask]
+        if len(vert_sub) == 0:
+            continue
+
+        # 如果x范围大于y范围，交换坐标使y成为长轴
+        vmin, vmax = vert_sub.min(0), vert_sub.max(0)
+        ddxy = vmax - vmin
+        if ddxy[0] > ddxy[1]:
+            vert_sub = vert_sub[:, [1, 0]]
+            node = node[:, [1, 0]]
+
+        # 按y值排序点
+        sort_idx = np.argsort(vert_sub[:, 1])
+        tasks.append((k, np.flatnonzero(mask)[sort_idx], vert_sub[sort_idx], node, edge, lbar))
+
+    if not tasks:
+        return results
+
+    # 调用核心算法（所有组一起）
+    stat, bnds = _inpoly2_core_many(
+        [t[2] for t in tasks], [t[3] for t in tasks], [t[4] for t in tasks], fTOL, [t[5] for t in tasks], max_pairs
+    )
+
+    # 恢复原始顺序，将结果放回完整输出数组
+    start = 0
+    for k, index, vert_sorted, _, _, _ in tasks:
+        STAT, BNDS = results[k]
+        STAT[index] = stat[start:start + len(index)]
+        BNDS[index] = bnds[start:start + len(index)]
+        start += len(index)
+
+    return results
 
 
 def inpoly2_core(vert, node, edge, fTOL, lbar):
     """
-    核心实现 - 基于交叉数算法的点位置判断
+    核心实现 - 基于交叉数算法的点位置判断（vert 已按 y 排序）
+    """
+    return _inpoly2_core_many([vert], [node], [edge], fTOL, [lbar], MAX_PAIRS)
+
+
+def _inpoly2_core_many(verts, nodes, edges, fTOL, lbars, max_pairs):
+    """
+    交叉数算法的向量化实现，verts 中每组点已按 y 排序，返回所有组拼接后的 (stat, bnds)
+
+    对每条边，用 searchsorted 在同组已排序的点中找出 y 落在 [y1 - veps, y2 + veps] 内的点，
+    展开为 (点, 边) 对后批量判断:
+        - 点在边的外包框左侧且 y1 <= y < y2: 交叉数加一；
+        - 点在外包框内: 与边共线（容差 feps）或与端点重合时为边界点，否则在边左侧且 y1 <= y < y2 时交叉数加一。
+    边界点 stat 为 True；其他点 stat 为交叉数的奇偶性（与逐边逐点循环的结果相同）
+    """
+    n_points = np.array([len(v) for v in verts])
+    point_offsets = np.r_[0, np.cumsum(n_points)]
+    px = np.concatenate([v[:, 0] for v in verts])
+    py = np.concatenate([v[:, 1] for v in verts])
+
+    # 边: 确保 y1 <= y2，并记录所属组
+    x1, y1, x2, y2, group, eps = [], [], [], [], [], []
+    for k, (node, edge, lbar) in enumerate(zip(nodes, edges, lbars)):
+        swap = node[edge[:, 1], 1] < node[edge[:, 0], 1]
+        inod = np.where(swap, edge[:, 1], edge[:, 0])
+        jnod = np.where(swap, edge[:, 0], edge[:, 1])
+        x1.append(node[inod, 0])
+        y1.append(node[inod, 1])
+        x2.append(node[jnod, 0])
+        y2.append(node[jnod, 1])
+        group.append(np.full(len(edge), k))
+        eps.append(np.full(len(edge), fTOL * lbar))
+    x1, y1, x2, y2 = (np.concatenate(a) for a in (x1, y1, x2, y2))
+    group = np.concatenate(group)
+    veps = np.concatenate(eps)
+    feps = veps
+
+    # 计算边边界框（带容差）
+    xmin = np.minimum(x1, x2) - veps
+    xmax = np.maximum(x1, x2) + veps
+    ydel = y2 - y1
+    xdel = x2 - x1
+    edel = np.abs(xdel) + ydel
+
+    # 使用二分查找确定每条边 y 范围内的点 [lo, hi)
+    point_group = np.repeat(np.arange(len(verts)), n_points)
+    lo = _grouped_searchsorted(point_group, py, group, y1 - veps, 'left')
+    hi = _grouped_searchsorted(point_group, py, group, y2 + veps, 'right')
+
+    crossings = np.zeros(point_offsets[-1], dtype=np.int64)
+    bnds = np.zeros(point_offsets[-1], dtype=bool)
+    for e, p in _edge_point_pairs(lo, hi, max_pairs):
+        x, y = px[p], py[p]
+        left = x < xmin[e]
+        within = ~left & (x <= xmax[e])
+        in_y = (y1[e] <= y) & (y < y2[e])
+
+        # 计算边与水平线的交点关系
+        mul1 = ydel[e] * (x - x1[e])
+        mul2 = xdel[e] * (y - y1[e])
+
+        # 检查是否在边上（考虑容差）
+        on_edge = within & (
+            (np.abs(mul2 - mul1) <= feps[e] * edel[e]) |
+            ((y == y1[e]) & (x == x1[e])) | ((y == y2[e]) & (x == x2[e]))
+        )
+        toggle = in_y & (left | (within & ~on_edge & (mul1 < mul2)))
+
+        crossings += np.bincount(p[toggle], minlength=len(crossings))
+        bnds[p[on_edge]] = True
+
+    stat = bnds | (crossings % 2 == 1)
+    return stat, bnds
+
+
+def _grouped_searchsorted(point_group, values, query_group, queries, side):
+    """
+    每个查询值在同组已排序的 values 中的插入位置（返回拼接数组中的下标）
+
+    points 按 (组, 值) 排序；把查询与点一起按 (组, 值, 类型) 排序，查询前面的点数即插入位置
     """
-    nvrt = len(vert)
-    nedg = len(edge)
-
-    stat = np.zeros(nvrt, dtype=bool)
-    bnds = np.zeros(nvrt, dtype=bool)
-
-    feps = fTOL * (lbar ** 1)
-    veps = fTOL * lbar
-
-    # 预处理边，确保y1 <= y2
-    edge_sorted = edge.copy()
-    swap_mask = node[edge[:, 1], 1] < node[edge[:, 0], 1]
-    edge_sorted[swap_mask, :] = edge_sorted[swap_mask, ::-1]
-
-    # 提取所有y坐标用于二分查找
-    y_coords = vert[:, 1]
-
-    # 遍历每条边
-    for e in edge_sorted:
-        inod, jnod = e
-        y1, y2 = node[inod, 1], node[jnod, 1]
-        x1, x2 = node[inod, 0], node[jnod, 0]
-
-        # 计算边边界框（带容差）
-        xmin = min(x1, x2) - veps
-        xmax = max(x1, x2) + veps
-        ymin = y1 - veps
-        ymax = y2 + veps
-
-        ydel = y2 - y1
-        xdel = x2 - x1
-        edel = abs(xdel) + ydel
-
-        # 使用二分查找确定y范围内的点
-        start_idx = bisect_left(y_coords, ymin)
-
-        # 检查范围内的每个点
-        for j in range(start_idx, nvrt):
-            if bnds[j]:
-                continue
-
-            x, y = vert[j, 0], vert[j, 1]
-
-            if y > ymax:
-                break  # 由于已排序，可以提前终止
-
-            if x < xmin:
-                # 点在边左侧，可能影响交叉数
-                if y1 <= y < y2:
-                    stat[j] = not stat[j]
-                continue
-
-            if x > xmax:
-                continue
-
-            # 计算边与水平线的交点关系
-            mul1 = ydel * (x - x1)
-            mul2 = xdel * (y - y1)
-
-            # 检查是否在边上（考虑容差）
-            if abs(mul2 - mul1) <= feps * edel:
-                bnds[j] = True
-                stat[j] = True
-            elif (y == y1 and x == x1) or (y == y2 and x == x2):
-                bnds[j] = True
-                stat[j] = True
-            elif mul1 < mul2:
-                if y1 <= y < y2:
-                    stat[j] = not stat[j]
-
-    return stat, bnds
\ No newline at end of file
+    n = len(values)
+    # side='left' 时查询排在相等的值之前，'right' 时排在之后
+    kind = np.r_[np.ones(n, dtype=np.int8), np.full(len(queries), 0 if side == 'left' else 2, dtype=np.int8)]
+    order = np.lexsort((kind, np.r_[values, queries], np.r_[point_group, query_group]))
+    position = np.flatnonzero(order >= n)
+    result = np.empty(len(queries), dtype=np.int64)
+    result[order[position] - n] = position - np.arange(len(position))
+    return result
+
+
+def _edge_point_pairs(lo, hi, max_pairs):
+    """按批生成 (边下标, 点下标) 对，每批不超过 max_pairs 对（点数过多的边拆成多段）"""
+    counts = hi - lo
+    n_pieces = np.maximum(-(-counts // max_pairs), 0)
+    edge = np.repeat(np.arange(len(lo)), n_pieces)
+    piece = np.arange(len(edge)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    start = lo[edge] + piece * max_pairs
+    stop = np.minimum(start + max_pairs, hi[edge])
+
+    sizes = stop - start
+    cumulative = np.cumsum(sizes)
+    batch_start = 0
+    while batch_start < len(edge):
+        base = cumulative[batch_start - 1] if batch_start > 0 else 0
+        batch_end = max(int(np.searchsorted(cumulative, base + max_pairs, side='right')), batch_start + 1)
+        s, z = start[batch_start:batch_end], sizes[batch_start:batch_end]
+        e = np.repeat(edge[batch_start:batch_end], z)
+        p = np.repeat(s - np.r_[0, np.cumsum(z)[:-1]], z) + np.arange(z.sum())
+        yield e, p
+        batch_start = batch_end